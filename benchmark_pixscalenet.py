@@ -0,0 +1,410 @@
+import argparse
+import os
+import tempfile
+import time
+import h5py
+import numpy as np
+import torch
+
+from pix_transform.pix_transform_net import PixScaleNet, PixScaleEnsemble, grad_scaler, check_precision
+from pix_transform.export import export_inference_module, freeze_pixscalenet
+from pix_transform.quantization import quantize_pixscalenet
+from pix_transform.parallel_inference import predict_map_parallel
+from utils import LogL1, weighted_sample_sums, release_cached_memory
+
+
+def build_net(num_feats, loss, dropout, small_net, datanames=None, input_scaling=False, output_scaling=False, precision="fp32",
+    pop_target=False):
+    net = PixScaleNet(channels_in=num_feats, weights_regularizer=0., device="cpu", loss=loss, kernel_size=[1,1,1,1],
+        dropout=dropout, input_scaling=input_scaling, output_scaling=output_scaling, datanames=datanames, small_net=small_net,
+        precision=precision, pop_target=pop_target)
+    return net.eval()
+
+
+def random_tile(num_feats, size, building_ratio, seed=1610):
+    """
+    Random input tile of shape (1,C,size,size) with the building counts in the first channel and a valid data mask.
+    Only a fraction "building_ratio" of the pixels have buildings, as in the real countries.
+    """
+    gen = torch.Generator().manual_seed(seed)
+    inputs = torch.randn((1,num_feats,size,size), generator=gen)
+    buildings = torch.randint(1, 50, (size,size), generator=gen).float()
+    buildings[torch.rand((size,size), generator=gen)>building_ratio] = 0
+    inputs[0,0] = buildings
+    mask = buildings>0
+    return inputs, mask
+
+
+def timeit(fn, repeats, warmup=3):
+    # several warmup runs, the TorchScript profiling executor and torch.compile optimize on the first calls
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return np.median(times)
+
+
+def bench_linear(args):
+    """
+    Pixels/s of the convolutional path (PixScaleNet.forward with a mask) and the nn.Linear path (PixScaleMLP).
+    """
+    net = build_net(args.num_feats, args.loss, args.dropout, args.small_net)
+    mlp = net.as_linear().eval()
+    inputs, mask = random_tile(args.num_feats, args.size, args.building_ratio)
+    npix = mask.sum().item()
+
+    def conv_path():
+        return net(inputs, mask, forward_only=True)
+
+    def linear_path():
+        pixels = inputs[0][:,mask].t()
+        return mlp(pixels)[0].sum(0)
+
+    with torch.no_grad():
+        diff = (conv_path() - linear_path()).abs().max().item()
+        t_conv = timeit(conv_path, args.repeats)
+        t_lin = timeit(linear_path, args.repeats)
+
+    print("pixels per forward: {}, max abs diff: {:.3e}".format(npix, diff))
+    print("{:<10} {:>14}".format("path", "pixels/s"))
+    print("{:<10} {:>14.0f}".format("conv", npix/t_conv))
+    print("{:<10} {:>14.0f}".format("linear", npix/t_lin))
+
+
+def bench_sparse(args):
+    """
+    Full map prediction with forward_batchwise (all pixels) against forward_sparse (only pixels with buildings).
+    """
+    net = build_net(args.num_feats, args.loss, args.dropout, args.small_net)
+    inputs, mask = random_tile(args.num_feats, args.size, args.building_ratio)
+    npix = mask.numel()
+
+    def dense_path():
+        return net.forward_batchwise(inputs, predict_map=True, forward_only=True)[0]
+
+    def sparse_path():
+        return net.forward_sparse(inputs, mask)[0]
+
+    with torch.no_grad():
+        diff = (dense_path() - sparse_path()).abs().max().item()
+        t_dense = timeit(dense_path, args.repeats)
+        t_sparse = timeit(sparse_path, args.repeats)
+
+    print("map pixels: {}, pixels with buildings: {}, max abs diff: {:.3e}".format(npix, mask.sum().item(), diff))
+    print("{:<10} {:>14}".format("path", "map pixels/s"))
+    print("{:<10} {:>14.0f}".format("dense", npix/t_dense))
+    print("{:<10} {:>14.0f}".format("sparse", npix/t_sparse))
+
+
+def bench_frozen(args):
+    """
+    Latency of one region-sized forward pass: PixScaleNet.forward (with country scalings of an unseen country), the
+    specialized PixScaleNet, the PixScaleMLP and the frozen modules with the scalings folded into the weights.
+    """
+    net = build_net(args.num_feats, args.loss, args.dropout, args.small_net, datanames=["tza", "uga"], input_scaling=True, output_scaling=True)
+    inputs, mask = random_tile(args.num_feats, args.size, args.building_ratio)
+    pixels = inputs[0][:,mask].t().contiguous()
+    name = "zmb"
+    modes = ["eager", "script"] + (["compile"] if hasattr(torch, "compile") else [])
+
+    paths = {
+        "scalenet": lambda: net(inputs, mask, name=name, forward_only=True),
+        "specialized": lambda: specialized(inputs, mask, name=name, forward_only=True),
+        "linear": lambda: mlp(pixels, name=name)[0].sum(0),
+    }
+    specialized = net.specialize(name)
+    mlp = net.as_linear().eval()
+    for mode in modes:
+        paths["frozen_" + mode] = (lambda module: lambda: module(pixels)[0].sum(0))(export_inference_module(net, name, mode=mode))
+
+    print("pixels per forward: {}".format(pixels.shape[0]))
+    print("{:<16} {:>12} {:>14} {:>12}".format("path", "latency [ms]", "pixels/s", "max abs diff"))
+    with torch.no_grad():
+        reference = paths["scalenet"]()
+        for path, fn in paths.items():
+            diff = (fn() - reference).abs().max().item()
+            t = timeit(fn, args.repeats)
+            print("{:<16} {:>12.2f} {:>14.0f} {:>12.3e}".format(path, t*1000, pixels.shape[0]/t, diff))
+
+
+def bench_quantized(args):
+    """
+    Throughput of the frozen float32 network and its dynamic/static int8 versions on the pixels with buildings of a
+    random tile. The static version is calibrated on a second random tile.
+    """
+    net = build_net(args.num_feats, args.loss, args.dropout, args.small_net)
+    inputs, mask = random_tile(args.num_feats, args.size, args.building_ratio)
+    pixels = inputs[0][:,mask].t().contiguous()
+    calibration_inputs, calibration_mask = random_tile(args.num_feats, args.size, args.building_ratio, seed=42)
+    calibration_pixels = calibration_inputs[0][:,calibration_mask].t().contiguous()
+
+    models = {
+        "float32": freeze_pixscalenet(net),
+        "dynamic": quantize_pixscalenet(net, mode="dynamic"),
+        "static": quantize_pixscalenet(net, mode="static", calibration_pixels=calibration_pixels),
+    }
+
+    print("pixels per forward: {}".format(pixels.shape[0]))
+    print("{:<10} {:>14} {:>12} {:>12}".format("model", "pixels/s", "speedup", "max rel diff"))
+    with torch.no_grad():
+        reference = models["float32"](pixels)[0]
+        t_ref = None
+        for key, model in models.items():
+            diff = ((model(pixels)[0] - reference).abs() / reference.abs().clamp(min=1e-6)).max().item()
+            t = timeit(lambda: model(pixels), args.repeats)
+            t_ref = t if t_ref is None else t_ref
+            print("{:<10} {:>14.0f} {:>12.2f} {:>12.3e}".format(key, pixels.shape[0]/t, t_ref/t, diff))
+
+
+def bench_precision(args):
+    """
+    Region sum forward passes (as in the validation) and training steps (forward, backward, optimizer step) with the
+    occratenet in fp32, bf16 and fp16 autocast. The relative error of the region sum is measured against fp32.
+    """
+    inputs, mask = random_tile(args.num_feats, args.size, args.building_ratio)
+    npix = mask.sum().item()
+    reference = None
+
+    print("pixels per region: {}".format(npix))
+    print("{:<10} {:>16} {:>16} {:>14}".format("precision", "forward pix/s", "train pix/s", "sum rel err"))
+    for precision in ["fp32", "bf16", "fp16"]:
+        try:
+            check_precision(precision, "cpu")
+        except Exception as e:
+            print("{:<10} not supported: {}".format(precision, e))
+            continue
+        torch.manual_seed(1610)
+        net = build_net(args.num_feats, args.loss, args.dropout, args.small_net, precision=precision)
+        optimizer = torch.optim.Adam(net.parameters(), lr=1e-5)
+        scaler = grad_scaler("cpu", net.autocast_dtype)
+
+        def forward_path():
+            with torch.no_grad():
+                return net(inputs, mask, forward_only=True)
+
+        def train_step():
+            optimizer.zero_grad()
+            loss = torch.log(net(inputs, mask)+1).sum()
+            if scaler is not None:
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                loss.backward()
+                optimizer.step()
+
+        try:
+            region_sum = forward_path()
+        except RuntimeError as e:
+            print("{:<10} not supported: {}".format(precision, e))
+            continue
+        reference = region_sum if reference is None else reference
+        rel_err = ((region_sum - reference).abs() / reference.abs()).max().item()
+        t_forward = timeit(forward_path, args.repeats)
+        t_train = timeit(train_step, args.repeats)
+        print("{:<10} {:>16.0f} {:>16.0f} {:>14.3e}".format(precision, npix/t_forward, npix/t_train, rel_err))
+
+
+def bench_parallel(args):
+    """
+    Full map prediction from an hdf5 file: forward_sparse against the read/infer/write pipeline of predict_map_parallel
+    with 1 and more worker processes. Includes reading the features, the workers are started for every map.
+    """
+    net = build_net(args.num_feats, args.loss, args.dropout, args.small_net)
+    inputs, mask = random_tile(args.num_feats, args.size, args.building_ratio)
+    npix = mask.numel()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        h5_filename = os.path.join(tmpdir, "data.hdf5")
+        with h5py.File(h5_filename, "w") as f:
+            f.create_dataset("features", data=inputs.numpy(), chunks=(1,args.num_feats,min(512,args.size),min(512,args.size)))
+
+        with h5py.File(h5_filename, "r") as f:
+            features = f["features"]
+            paths = {"serial": lambda: net.forward_sparse(features)}
+            for num_workers in [int(n) for n in args.workers.split(",")]:
+                paths["workers_{}".format(num_workers)] = (lambda n: lambda: predict_map_parallel(net, features,
+                    num_workers=n, threads_per_worker=args.num_threads))(num_workers)
+
+            print("map pixels: {}, pixels with buildings: {}".format(npix, mask.sum().item()))
+            print("{:<12} {:>14} {:>12}".format("path", "map pixels/s", "max abs diff"))
+            with torch.no_grad():
+                reference = paths["serial"]()[0]
+                for path, fn in paths.items():
+                    diff = (fn()[0] - reference).abs().max().item()
+                    t = timeit(fn, args.repeats, warmup=1)
+                    print("{:<12} {:>14.0f} {:>12.3e}".format(path, npix/t, diff))
+
+
+def bench_mcdropout(args):
+    """
+    Monte Carlo dropout map (forward_mc_dropout) against the same number of forward passes of the network in train
+    mode, with input and output scaling. Both draw from the dropout distribution of the training, the relative
+    differences of the mean and variance maps are sampling noise (about 5% for the variance with 1000 samples).
+    """
+    size, num_samples = args.size//16, 1000
+    inputs, _ = random_tile(args.num_feats, size, 1.)
+    torch.manual_seed(1610)
+    net = build_net(args.num_feats, args.loss, args.dropout if args.dropout>0 else 0.3, args.small_net, datanames=["tza"],
+        input_scaling=True, output_scaling=True)
+    with torch.no_grad():
+        net.in_scale["tza"].uniform_(0.5, 2.)
+        net.in_bias["tza"].normal_()
+        net.out_scale["tza"].uniform_(0.5, 2.)
+
+    def mc_dropout():
+        net.eval()
+        return net.forward_mc_dropout(inputs, name="tza", num_samples=num_samples, samples_per_pass=100)
+
+    def train_mode_passes():
+        net.train()
+        samples = torch.stack([net(inputs, name="tza", predict_map=True, forward_only=True)[0] for _ in range(num_samples)])
+        return samples.mean(0), samples.var(0, unbiased=False)
+
+    with torch.no_grad():
+        reference = train_mode_passes()
+        result = mc_dropout()
+        diffs = [((a[:,0] - b[:,0]).abs().mean()/b[:,0].abs().mean()).item() for a,b in zip(result, reference)]
+    print("map pixels: {}, samples: {}".format(size*size, num_samples))
+    print("mean rel diff: {:.3e}, variance rel diff: {:.3e}".format(diffs[0], diffs[1]))
+
+
+def bench_ensemble(args):
+    """
+    5-fold holdout map of eval_generic_model: one forward pass per fold over the tile (each pixel takes the prediction of
+    its fold) against PixScaleEnsemble.forward_map, also with exptransform outputs and pop_target, where the pixels
+    without buildings are predicted as well.
+    """
+    size = args.size//2
+    inputs, mask = random_tile(args.num_feats, size, args.building_ratio)
+    gen = torch.Generator().manual_seed(1610)
+    fold_map = torch.randint(-1, 5, (size,size), generator=gen).to(torch.int8)
+    valid = torch.rand((size,size), generator=gen)>0.1
+    regions = torch.randint(0, 50, (size,size), generator=gen)
+
+    print("map pixels: {}, pixels with buildings: {}".format(size*size, mask.sum().item()))
+    print("{:<12} {:>10} {:>14} {:>14} {:>10}".format("loss", "pop_target", "max map rel", "max sum rel", "speedup"))
+    for loss, pop_target in [(args.loss, False), ("LogoutputL1", False), (args.loss, True)]:
+        torch.manual_seed(1610)
+        # without output scaling, which sets the predictions of the pixels without buildings to zero
+        nets = [build_net(args.num_feats, loss, args.dropout, args.small_net, datanames=["tza"], input_scaling=True,
+            pop_target=pop_target) for _ in range(5)]
+        with torch.no_grad():
+            for net in nets:
+                net.in_scale["tza"].uniform_(0.5, 2.)
+        ensemble = PixScaleEnsemble(nets)
+
+        def per_fold():
+            pop_est = torch.zeros((size,size))
+            for k, net in enumerate(nets):
+                select = (fold_map==k) & valid
+                pop_est[select] = net.forward(inputs, mask=None, name="tza", predict_map=True, forward_only=True)[0][0,0][select]
+            sums = torch.zeros((50,), dtype=torch.float64).index_add_(0, regions[fold_map>=0].reshape(-1),
+                pop_est[fold_map>=0].double())
+            return pop_est, sums
+
+        def ensemble_map():
+            # the pixel selection of eval_generic_model
+            sparse_mask = valid if (ensemble.pop_target or ensemble.exptransform_outputs) else valid & mask
+            out = ensemble.forward_map(inputs, fold_map, mask=sparse_mask, name="tza", regions=regions, num_regions=50)
+            return out["pop_est"][0], out["region_sums"]
+
+        with torch.no_grad():
+            reference, reference_sums = per_fold()
+            pop_est, sums = ensemble_map()
+            diff = ((pop_est - reference).abs()/reference.abs().clamp(min=1.)).max().item()
+            sum_diff = ((sums - reference_sums).abs()/reference_sums.abs().clamp(min=1.)).max().item()
+            speedup = timeit(per_fold, args.repeats, warmup=1)/timeit(ensemble_map, args.repeats, warmup=1)
+        print("{:<12} {:>10} {:>14.3e} {:>14.3e} {:>10.2f}".format(loss, str(pop_target), diff, sum_diff, speedup))
+
+
+def bench_train(args):
+    """
+    Training steps/s on pairs of regions (as with admin_augment): the previous step, which moved the region sums to the
+    host and emptied the cuda cache after every step, against the current step, where the loss stays on the device,
+    with one forward pass per region ("separate") or one pass for both regions ("merged", see forward_segments).
+    """
+    net = build_net(args.num_feats, args.loss, args.dropout, args.small_net, datanames=["tza"], input_scaling=True, output_scaling=True)
+    net.train()
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-5)
+    size = args.size//4
+    samples = []
+    for seed in range(8):
+        sample = []
+        for k in range(2):
+            inputs, mask = random_tile(args.num_feats, size, args.building_ratio, seed=2*seed+k)
+            sample.append((inputs, torch.tensor([1000.]), mask.unsqueeze(0), ["tza"], torch.tensor([1.])))
+        samples.append(sample)
+    samples_iter = [0]
+
+    def legacy_step():
+        sample = samples[samples_iter[0]%len(samples)]
+        samples_iter[0] += 1
+        y_pred_list = [net(inp[0], inp[2], inp[3][0]) for inp in sample]
+        y_pred = torch.stack([pred*samp[4] for pred,samp in zip(y_pred_list, sample)]).sum(0)
+        y_gt = torch.tensor([samp[1]*samp[4] for samp in sample]).sum().unsqueeze(0)
+        loss = LogL1(y_pred, y_gt)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        loss.item()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def current_step(merged):
+        sample = samples[samples_iter[0]%len(samples)]
+        samples_iter[0] += 1
+        y_pred, y_gt = weighted_sample_sums(net.forward_one_or_more(sample, merged=merged), sample)
+        loss = LogL1(y_pred, y_gt)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        release_cached_memory("logstep")
+
+    print("pixels per region: {}".format(size*size))
+    print("{:<10} {:>10}".format("step", "steps/s"))
+    for key, fn in [("legacy", legacy_step), ("separate", lambda: current_step(False)), ("merged", lambda: current_step(True))]:
+        t = timeit(fn, args.repeats)
+        print("{:<10} {:>10.1f}".format(key, 1/t))
+
+
+benchmarks = {
+    "linear": bench_linear,
+    "sparse": bench_sparse,
+    "frozen": bench_frozen,
+    "quantized": bench_quantized,
+    "precision": bench_precision,
+    "parallel": bench_parallel,
+    "mcdropout": bench_mcdropout,
+    "ensemble": bench_ensemble,
+    "train": bench_train,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", "-b", type=str, default="linear", help="Comma separated list of benchmarks. Options: " + ", ".join(benchmarks.keys()))
+    parser.add_argument("--num_feats", "-nf", type=int, default=16, help="Number of input features including the buildings")
+    parser.add_argument("--size", type=int, default=1000, help="Height and width of the input tile")
+    parser.add_argument("--building_ratio", "-br", type=float, default=0.1, help="Fraction of the pixels with buildings")
+    parser.add_argument("--loss", "-l", type=str, default="LogL1", help="Loss the network is set up for (e.g. gaussNLL for the bayesian head)")
+    parser.add_argument("--dropout", "-drop", type=float, default=0.0, help="dropout probability ")
+    parser.add_argument("--small_net", "-sn", type=bool, default=False, help="Using small variant.")
+    parser.add_argument("--repeats", type=int, default=10, help="Number of timed repetitions")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch.set_num_threads, threads per worker for --bench parallel")
+    parser.add_argument("--workers", type=str, default="1,2", help="Comma separated numbers of worker processes for --bench parallel")
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    for bench in args.bench.split(","):
+        print("**************** {} ****************".format(bench))
+        benchmarks[bench](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import os
+import pickle
+from pathlib import Path
+import torch
+from distutils.util import strtobool
+
+from pix_transform.pix_transform_net import PixScaleNet
+from pix_transform.export import export_inference_module, load_scalenet_checkpoint, export_onnx, check_onnx_parity
+
+
+def build_net_for_checkpoint(checkpoint_path, loss, dropout, small_net, input_scaling, output_scaling, datanames, pop_target):
+    """
+    Builds a PixScaleNet matching the checkpoint. The number of input channels is read from the first layer, the other
+    hyperparameters have to be the ones used for training.
+    """
+    state_dict = torch.load(checkpoint_path, map_location="cpu")['model_state_dict']
+    first_weight = [value for key,value in state_dict.items() if key.startswith("occratenet") and value.dim()==4][0]
+    channels_in = first_weight.shape[1] if pop_target else first_weight.shape[1] + 1
+    kernel_size = [first_weight.shape[-1]] + [1,1,1]
+
+    net = PixScaleNet(channels_in=channels_in, device="cpu", loss=loss, kernel_size=kernel_size, dropout=dropout,
+        input_scaling=input_scaling, output_scaling=output_scaling, datanames=datanames, small_net=small_net, pop_target=pop_target)
+    return load_scalenet_checkpoint(net, checkpoint_path)
+
+
+def load_geo_metadata(dataset_dir, country):
+    """
+    Geo metadata (geo_transform, projection) of the country from the evaluation variables written by
+    superpixel_disagg_model.py, None if the dataset is not prepared.
+    """
+    eval_var_filename = f"{dataset_dir}/{country}/additional_test_vars.pkl"
+    if not os.path.isfile(eval_var_filename):
+        return None
+    with open(eval_var_filename, "rb") as f:
+        geo_metadata = pickle.load(f)[8]
+    return {"country": country, "geo_transform": ",".join([str(v) for v in geo_metadata["geo_transform"]]),
+        "projection": geo_metadata["projection"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint", type=str, help="Checkpoint to export, e.g. checkpoints/Final/Maxstepstate_<name>.pth")
+    parser.add_argument("country", type=str, help="Country the exported module is specialized for (selects the country scalings)")
+    parser.add_argument("output", type=str, help="Output file of the exported module")
+    parser.add_argument("--train_dataset_name", "-train", type=str, default=None, help="Train Dataset name (separated by commas), needed with -is/-os")
+    parser.add_argument("--loss", "-l", type=str, default="NormL1", help="NormL1, NormL2, gaussNLL, laplaceNLL")
+    parser.add_argument("--dropout", "-drop", type=float, default=0.0, help="dropout probability ")
+    parser.add_argument("--small_net", "-sn", type=bool, default=False, help="Using small variant.")
+    parser.add_argument("--input_scaling", "-is", type=bool, default=False, help="Countrywise input feature scaling.")
+    parser.add_argument("--output_scaling", "-os", type=bool, default=False, help="Countrywise output scaling.")
+    parser.add_argument("--population_target", "-pop_target", type=lambda x: bool(strtobool(x)), default=False, help="Use population as target")
+    parser.add_argument("--format", "-f", type=str, default="script", help="script: TorchScript module, onnx: ONNX model with dynamic height and width")
+    parser.add_argument("--opset", type=int, default=13, help="ONNX opset version")
+    parser.add_argument("--dataset_dir", "-dd", type=str, default='datasets', help="Directory of the hdf5 files, the geo metadata of the country is stored in the ONNX model")
+    args = parser.parse_args()
+
+    datanames = args.train_dataset_name.split(",") if args.train_dataset_name is not None else None
+    net = build_net_for_checkpoint(args.checkpoint, args.loss, args.dropout, args.small_net, args.input_scaling, args.output_scaling,
+        datanames, args.population_target)
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    if args.format=="script":
+        module = export_inference_module(net, args.country, mode="script")
+        torch.jit.save(module, args.output)
+        print("saved TorchScript module for {} to {}".format(args.country, args.output))
+    elif args.format=="onnx":
+        metadata = load_geo_metadata(args.dataset_dir, args.country)
+        if metadata is None:
+            print("no geo metadata found for {}, pass a reference raster to run_onnx_inference.py".format(args.country))
+        export_onnx(net, args.output, args.country, opset_version=args.opset, metadata=metadata)
+        diffs = check_onnx_parity(net, args.output, args.country)
+        print("saved ONNX model for {} to {}, max abs diff to PixScaleNet: {}".format(args.country, args.output,
+            ", ".join(["{} {:.3e}".format(key, value) for key,value in diffs.items()])))
+    else:
+        raise Exception("unknown export format {}".format(args.format))
+
+
+if __name__ == "__main__":
+    main()
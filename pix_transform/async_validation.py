@@ -0,0 +1,102 @@
+import copy
+import logging
+import queue
+import traceback
+import h5py
+import torch
+import torch.multiprocessing as mp
+
+from pix_transform.evaluation import validate_model
+from pix_transform.checkpoints import snapshot_model
+
+
+def _worker_main(dataset, train_dataset_name, test_dataset_names, params, datanames, num_threads, tasks, results):
+    # forked before the training process initializes cuda, this process can create its own context
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    # hdf5 handles are not shared with the parent process
+    for name, features in dataset.features.items():
+        if isinstance(features, h5py.Dataset):
+            dataset.features[name] = h5py.File(features.file.filename, "r")[features.name]
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batchiter, snapshot, full = task
+        try:
+            mynet = snapshot_model(snapshot, device)
+            with torch.no_grad():
+                log_dict, checkpoints = validate_model(mynet, dataset, train_dataset_name, test_dataset_names, params, datanames, full=full)
+            results.put((batchiter, log_dict, checkpoints, None))
+        except Exception:
+            results.put((batchiter, None, None, traceback.format_exc()))
+
+
+class ValidationWorker:
+    """
+    Runs validate_model in a background process on snapshots of the network, such that the training does not wait for
+    the validation. The process is forked from the training process and shares its dataset (copy on write), so it has
+    to be started after the dataset is loaded and before cuda is initialized (before the network is moved to the gpu).
+    At most max_pending snapshots are evaluated or queued, later log steps are skipped until a result arrives.
+    """
+
+    def __init__(self, dataset, train_dataset_name, test_dataset_names, params, datanames, num_threads=None, max_pending=2):
+        if "fork" not in mp.get_all_start_methods():
+            raise Exception("asynchronous validation needs the fork start method")
+        if torch.cuda.is_initialized():
+            raise Exception("asynchronous validation has to be started before cuda is initialized")
+        ctx = mp.get_context("fork")
+        self.tasks, self.results = ctx.Queue(), ctx.Queue()
+        self.pending = {}
+        self.max_pending = max_pending
+        self.process = ctx.Process(target=_worker_main, args=(dataset, train_dataset_name, test_dataset_names, params, datanames,
+            num_threads, self.tasks, self.results), daemon=True)
+        self.process.start()
+
+
+    def submit(self, mynet, optimizer, epoch, batchiter, full=True):
+        """
+        Queues the validation of the current weights (full: see validate_model). The snapshot and the optimizer state
+        are kept until the result arrives, for the checkpoints. Returns False if the log step is skipped.
+        """
+        if len(self.pending)>=self.max_pending:
+            logging.info(f'Skipping the validation of batchiter {batchiter}, {len(self.pending)} validations are pending')
+            return False
+        snapshot = snapshot_model(mynet)
+        self.pending[batchiter] = (snapshot, copy.deepcopy(optimizer.state_dict()), epoch)
+        self.tasks.put((batchiter, snapshot, full))
+        return True
+
+
+    def collect(self, block=False):
+        """
+        Finished validations as (snapshot, optimizer state, epoch, batchiter, log_dict, checkpoints), in the order
+        of submission. block: wait for all pending validations.
+        """
+        finished = []
+        while len(self.pending)>0:
+            try:
+                batchiter, log_dict, checkpoints, error = self.results.get(block=block, timeout=1.)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise Exception("the validation worker died with exit code {}".format(self.process.exitcode))
+                if block:
+                    continue
+                break
+            snapshot, optimizerstate, epoch = self.pending.pop(batchiter)
+            if error is not None:
+                raise Exception("validation of batchiter {} failed:\n{}".format(batchiter, error))
+            finished.append((snapshot, optimizerstate, epoch, batchiter, log_dict, checkpoints))
+        return finished
+
+
+    def close(self):
+        """
+        Waits for the pending validations, stops the worker and returns the last results (see collect).
+        """
+        finished = self.collect(block=True)
+        self.tasks.put(None)
+        self.process.join()
+        return finished
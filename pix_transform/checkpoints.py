@@ -0,0 +1,231 @@
+import copy
+import hashlib
+import inspect
+import io
+import os
+import queue
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+
+def cpu_copy(obj):
+    """
+    Copy of a (nested) state with all tensors detached and copied to the cpu, such that it can be serialized while the
+    training continues.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((key, cpu_copy(value)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(value) for value in obj)
+    return obj
+
+
+def snapshot_model(mynet, device="cpu"):
+    """
+    Copy of the network for evaluation on "device", including the country scalings (kept outside of the state_dict).
+    The parameter groups of the optimizer and the cached mean scalings and specialized copies (rebuilt when needed)
+    are not copied.
+    """
+    memo = {id(mynet.params_with_regularizer): []} if hasattr(mynet, "params_with_regularizer") else {}
+    for key in ["mean_in_scale", "mean_in_bias", "mean_out_scale", "mean_out_bias"]:
+        if torch.is_tensor(getattr(mynet, key, None)):
+            memo[id(getattr(mynet, key))] = None
+    if getattr(mynet, "specialized_nets", None) is not None:
+        memo[id(mynet.specialized_nets)] = {}
+    snapshot = copy.deepcopy(mynet, memo=memo).to(device).eval()
+    snapshot.device = torch.device(device)
+    for key in ["in_scale", "in_bias", "out_scale", "out_bias"]:
+        if hasattr(snapshot, key):
+            setattr(snapshot, key, {name: value.detach().to(device) for name, value in getattr(snapshot, key).items()})
+    return snapshot
+
+
+def checkpoint_state(mynet, optimizerstate, epoch, log_dict):
+    # same layout as the checkpoints of checkpoint_model and the final state
+    saved_dict = {'model_state_dict': mynet.state_dict(), 'optimizer_state_dict': optimizerstate, 'epoch': epoch, 'log_dict': log_dict}
+    if mynet.input_scaling:
+        saved_dict["input_scales_bias"] = [mynet.in_scale, mynet.in_bias]
+    if mynet.output_scaling:
+        saved_dict["output_scales_bias"] = [mynet.out_scale, mynet.out_bias]
+    return saved_dict
+
+
+def get_rng_states():
+    states = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "random": random.getstate()}
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    torch.set_rng_state(states["torch"])
+    np.random.set_state(states["numpy"])
+    random.setstate(states["random"])
+    if "cuda" in states.keys() and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def load_training_state(path, map_location=None):
+    """
+    Loads a complete training state (with the rng and sampler states, not only tensors). Newer torch versions only
+    unpickle weights by default, older ones do not know the weights_only argument.
+    """
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    return torch.load(path, map_location=map_location)
+
+
+def load_scalings(mynet, saved_dict):
+    """
+    Copies the country scalings of a checkpoint into the network in place, the optimizer holds the scaling tensors.
+    """
+    with torch.no_grad():
+        if "input_scales_bias" in saved_dict.keys():
+            for name in mynet.in_scale.keys():
+                mynet.in_scale[name].copy_(saved_dict["input_scales_bias"][0][name])
+                mynet.in_bias[name].copy_(saved_dict["input_scales_bias"][1][name])
+        if "output_scales_bias" in saved_dict.keys():
+            for name in mynet.out_scale.keys():
+                mynet.out_scale[name].copy_(saved_dict["output_scales_bias"][0][name])
+                mynet.out_bias[name].copy_(saved_dict["output_scales_bias"][1][name])
+
+
+def link_or_copy(src, dst):
+    # the entry is replaced atomically, readers see the old or the new checkpoint
+    tmp = dst + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def write_checkpoint(saved_dict, paths, store_dir):
+    """
+    Serializes saved_dict once into the content-addressed store (file name: sha256 of the serialized bytes) and
+    materializes it at all paths as hardlinks (copies if the file system has no hardlinks). Returns the store file.
+    """
+    buffer = io.BytesIO()
+    torch.save(saved_dict, buffer)
+    data = buffer.getvalue()
+    os.makedirs(store_dir, exist_ok=True)
+    blob = os.path.join(store_dir, hashlib.sha256(data).hexdigest() + ".pth")
+    if not os.path.exists(blob):
+        with open(blob + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(blob + ".tmp", blob)
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_or_copy(blob, path)
+    return blob
+
+
+class CheckpointWriter:
+    """
+    Writes the best_* checkpoints of a log step in a background thread. All entries of a step (checkpoint_model calls
+    between begin() and commit()) share one serialized state in the store "store_dir".
+    Retention: the store keeps the states referenced by an entry and the keep_last most recent unreferenced states,
+    older states are deleted (the entries are hardlinks and stay valid).
+    """
+
+    def __init__(self, store_dir, keep_last=1, background=True):
+        self.store_dir = store_dir
+        self.keep_last = keep_last
+        self.background = background
+        self.references, self.unreferenced = {}, []
+        self.pending_paths, self.pending_log_dict = [], {}
+        self.errors = []
+        # at most two states wait for the writer, commit() blocks beyond
+        self.tasks = queue.Queue(maxsize=2)
+        if background:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+
+    def begin(self, mynet, optimizerstate, epoch):
+        self.mynet, self.optimizerstate, self.epoch = mynet, optimizerstate, epoch
+        self.pending_paths, self.pending_log_dict = [], {}
+
+
+    def add(self, paths, dataset_name, log_dict):
+        self.pending_paths += paths
+        for key, value in log_dict.items():
+            self.pending_log_dict[dataset_name + key] = value
+
+
+    def commit(self):
+        """
+        Snapshots the state on the cpu (if any entry improved) and queues the write. Does not wait for the write.
+        """
+        if len(self.errors)>0:
+            raise self.errors[0]
+        if len(self.pending_paths)>0:
+            saved_dict = cpu_copy(checkpoint_state(self.mynet, self.optimizerstate, self.epoch, self.pending_log_dict))
+            task = (saved_dict, self.pending_paths)
+            if self.background:
+                self.tasks.put(task)
+            else:
+                self._write(*task)
+        self.mynet, self.optimizerstate = None, None
+        self.pending_paths, self.pending_log_dict = [], {}
+
+
+    def write(self, saved_dict, paths):
+        """
+        Queues a complete state (e.g. the resumable training state) for the paths, outside of the log step entries.
+        """
+        if len(self.errors)>0:
+            raise self.errors[0]
+        task = (cpu_copy(saved_dict), paths)
+        if self.background:
+            self.tasks.put(task)
+        else:
+            self._write(*task)
+
+
+    def _write(self, saved_dict, paths):
+        blob = write_checkpoint(saved_dict, paths, self.store_dir)
+        for path in paths:
+            self.references[path] = blob
+        self._retain()
+
+
+    def _retain(self):
+        # states without entries (replaced by a better state), oldest first. The keep_last most recent ones are kept.
+        referenced = set(self.references.values())
+        stored = [os.path.join(self.store_dir, f) for f in os.listdir(self.store_dir) if f.endswith(".pth")]
+        for blob in sorted(stored, key=os.path.getmtime):
+            if blob not in referenced and blob not in self.unreferenced:
+                self.unreferenced.append(blob)
+        self.unreferenced = [blob for blob in self.unreferenced if blob not in referenced]
+        while len(self.unreferenced)>self.keep_last:
+            os.remove(self.unreferenced.pop(0))
+
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            try:
+                self._write(*task)
+            except Exception as e:
+                self.errors.append(e)
+
+
+    def close(self):
+        """
+        Waits for the queued writes.
+        """
+        if self.background:
+            self.tasks.put(None)
+            self.thread.join()
+        if len(self.errors)>0:
+            raise self.errors[0]
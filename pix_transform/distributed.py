@@ -0,0 +1,68 @@
+import datetime
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend="gloo"):
+    """
+    Joins the process group of a data-parallel training, from the environment set by torchrun (RANK, WORLD_SIZE,
+    MASTER_ADDR, MASTER_PORT). The other ranks wait in the next all-reduce while rank 0 validates, the timeout covers
+    the validation of large countries. Returns (rank, world_size).
+    """
+    if "RANK" not in os.environ or "WORLD_SIZE" not in os.environ:
+        raise Exception("distributed training needs the environment of torchrun, e.g. torchrun --nproc_per_node 4 superpixel_disagg_model.py ...")
+    if not dist.is_initialized():
+        dist.init_process_group(backend, timeout=datetime.timedelta(hours=6))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def barrier():
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    # the (picklable) object of rank src on all ranks, e.g. the run name. Unchanged without a process group.
+    if not (dist.is_available() and dist.is_initialized()):
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
+
+
+def broadcast_parameters(parameters, src=0):
+    # same initial weights and scalings on all ranks
+    with torch.no_grad():
+        for param in parameters:
+            dist.broadcast(param.data, src)
+
+
+def all_reduce_gradients(parameters):
+    """
+    Averages the gradients of the parameters over the ranks, with one all-reduce of a flat buffer. A parameter that
+    has no gradient on any rank (e.g. the scalings of a country none of the ranks sampled) keeps None, such that the
+    optimizer skips it as in a single process. The other gradients are summed, missing ones count as zero.
+    """
+    parameters = [param for param in parameters if param.requires_grad]
+    if len(parameters)==0:
+        return
+    world_size = dist.get_world_size()
+    grads = [param.grad if param.grad is not None else torch.zeros_like(param) for param in parameters]
+    has_grad = torch.tensor([param.grad is not None for param in parameters], dtype=grads[0].dtype, device=grads[0].device)
+    flat = torch.cat([grad.reshape(-1) for grad in grads] + [has_grad])
+    dist.all_reduce(flat)
+
+    # one copy of the flags to the host, the gradients are views of the reduced buffer
+    has_grad = (flat[-len(parameters):]>0).tolist()
+    grads = (flat[:-len(parameters)]/world_size).split([param.numel() for param in parameters])
+    for param, grad, this_has_grad in zip(parameters, grads, has_grad):
+        param.grad = grad.view_as(param) if this_has_grad else None
@@ -11,7 +11,6 @@ import torch.nn.functional as F
 import torch.optim as optim
 import torch.utils.data
 import sys
-import wandb
 import h5py
 import pickle
 from pathlib import Path
@@ -21,11 +20,17 @@ import os
 import pdb
 
 from utils import plot_2dmatrix, accumulate_values_by_region, compute_performance_metrics, bbox2, \
-     PatchDataset, MultiPatchDataset, NormL1, LogL1, LogoutputL1, LogoutputL2, compute_performance_metrics_arrays
+     PatchDataset, MultiPatchDataset, NormL1, LogL1, LogoutputL1, LogoutputL2, compute_performance_metrics_arrays, release_cached_memory
 from cy_utils import compute_map_with_new_labels, compute_accumulated_values_by_region, compute_disagg_weights, \
     set_value_for_each_region
 
-from pix_transform.pix_transform_net import PixScaleNet
+from pix_transform.pix_transform_net import PixScaleNet, PixScaleEnsemble, predict_map_sparse
+from pix_transform.export import export_inference_module
+from pix_transform.quantization import quantization_report
+from pix_transform.parallel_inference import predict_map_parallel
+from pix_transform.metrics import log_metrics, metrics_histogram, get_run_name
+from pix_transform.profiling import phase, profiled
+from pix_transform.checkpoints import checkpoint_state, write_checkpoint
 import config_pop as cfg
 
 
@@ -60,12 +65,13 @@ def disag_map(predicted_target_img, agg_preds_arr, disaggregation_data):
 
     scalings_array = torch.tensor(list(scalings.values())).numpy()
     log_dict = {
-    "disaggregation/scalings_": wandb.Histogram(scalings_array), "disaggregation/mean_scaling": np.mean(scalings_array),
+    "disaggregation/scalings_": metrics_histogram(scalings_array), "disaggregation/mean_scaling": np.mean(scalings_array),
     "disaggregation/median_scaling": np.median(scalings_array), "disaggregation/min_scaling": np.min(scalings_array),
     "disaggregation/max_scaling": np.max(scalings_array)  }
 
     return predicted_target_img_adjusted.cpu(), log_dict
 
+@profiled("disaggregation")
 def disag_wo_map(agg_preds_arr, disaggregation_data):
 
     # Get device
@@ -97,13 +103,14 @@ def disag_wo_map(agg_preds_arr, disaggregation_data):
 
     scalings_array = torch.tensor(list(scalings.values())).numpy()
     log_dict = {
-    "disaggregation/scalings_": wandb.Histogram(scalings_array), "disaggregation/mean_scaling": np.mean(scalings_array),
+    "disaggregation/scalings_": metrics_histogram(scalings_array), "disaggregation/mean_scaling": np.mean(scalings_array),
     "disaggregation/median_scaling": np.median(scalings_array), "disaggregation/min_scaling": np.min(scalings_array),
     "disaggregation/max_scaling": np.max(scalings_array)  }
 
     return agg_preds_arr_adj, log_dict
 
 
+@profiled("disaggregation")
 def disag_and_eval_map(predicted_target_img, agg_preds_arr, validation_regions, valid_validation_ids,
     num_validation_ids, validation_ids, validation_census, disaggregation_data):
 
@@ -131,7 +138,8 @@ def eval_my_model(mynet, guide_img, valid_mask, validation_regions,
     dataset,
     disaggregation_data=None, return_scale=False,
     dataset_name="unspecifed_dataset",
-    full_eval=False, silent_mode=True):
+    full_eval=False, silent_mode=True, sparse=False, pixel_model=None, mc_dropout_samples=0, inference_workers=0,
+    threads_per_worker=None, memory_policy="logstep"):
 
     res = {}
     metrics = {}
@@ -143,12 +151,28 @@ def eval_my_model(mynet, guide_img, valid_mask, validation_regions,
 
             # batchwise passing for whole image
             logging.info(f'Classic eval started')
-            return_vals = mynet.forward_batchwise(
-                guide_img,
-                predict_map=True,
-                return_scale=return_scale,
-                forward_only=True
-            )
+            if pixel_model is not None or sparse or mc_dropout_samples>0:
+                # the buildings mask of the dataset preparation skips reading the rows without buildings
+                sparse_mask = torch.as_tensor(valid_mask, dtype=torch.bool) & dataset.buildings_mask[dataset_name]
+            with phase("inference"):
+                if pixel_model is not None:
+                    # frozen inference module for this country, only valid pixels are evaluated
+                    return_vals = predict_map_sparse(pixel_model, guide_img, mynet.out_dim, mask=sparse_mask, device=getattr(pixel_model, "device", mynet.device))
+                elif inference_workers>0:
+                    # strips of rows are read, evaluated and written in a pipeline, split over inference_workers processes
+                    return_vals = predict_map_parallel(mynet, guide_img, sparse_mask if sparse else None, name=dataset_name,
+                        num_workers=inference_workers, threads_per_worker=threads_per_worker, sparse=sparse)
+                elif sparse:
+                    # only the pixels with buildings and valid data are passed through the network
+                    return_vals = mynet.forward_sparse(guide_img, sparse_mask, name=dataset_name)
+                else:
+                    return_vals = mynet.forward_batchwise(
+                        guide_img,
+                        name=dataset_name,
+                        predict_map=True,
+                        return_scale=return_scale,
+                        forward_only=True
+                    )
             if return_scale:
                 predicted_target_img, scales = return_vals
                 res["scales"] = scales.squeeze()
@@ -169,15 +193,24 @@ def eval_my_model(mynet, guide_img, valid_mask, validation_regions,
 
             res["predicted_target_img"] = predicted_target_img
 
+            if mc_dropout_samples>0:
+                logging.info(f'MC dropout with {mc_dropout_samples} samples started')
+                with phase("inference"):
+                    mc_mean, mc_variance = mynet.forward_mc_dropout(guide_img, sparse_mask, name=dataset_name, num_samples=mc_dropout_samples)
+                res["mc_dropout_mean"] = mc_mean[0,0]
+                res["mc_dropout_variance"] = mc_variance[0,0]
+                logging.info(f'MC dropout finished')
+
             # Aggregate by fine administrative boundary
-            agg_preds_arr = compute_accumulated_values_by_region(
-                validation_regions.numpy().astype(np.uint32),
-                predicted_target_img.cpu().numpy().astype(np.float32),
-                valid_validation_ids.numpy().astype(np.uint32),
-                num_validation_ids
-            )
-            agg_preds = {id: agg_preds_arr[id] for id in validation_ids}
-            metrics = compute_performance_metrics(agg_preds, validation_census) 
+            with phase("aggregation"):
+                agg_preds_arr = compute_accumulated_values_by_region(
+                    validation_regions.numpy().astype(np.uint32),
+                    predicted_target_img.cpu().numpy().astype(np.float32),
+                    valid_validation_ids.numpy().astype(np.uint32),
+                    num_validation_ids
+                )
+                agg_preds = {id: agg_preds_arr[id] for id in validation_ids}
+                metrics = compute_performance_metrics(agg_preds, validation_census) 
             logging.info(f'Classic eval finished')
 
             if disaggregation_data is not None:
@@ -195,17 +228,8 @@ def eval_my_model(mynet, guide_img, valid_mask, validation_regions,
         else:
             # Fast evaluation pipeline
             logging.info(f'Samplewise eval started')
-            # agg_preds2 = {}
-            agg_preds_arr = torch.zeros((dataset.max_tregid[dataset_name]+1,))
-            for idx in tqdm(range(dataset.len_all_samples(dataset_name)), disable=silent_mode):
-                X, Y, Mask, name, census_id = dataset.get_single_item(idx, dataset_name) 
-                prediction = mynet.forward(X, Mask, name=name, forward_only=True).detach().cpu().numpy()
-
-                if isinstance(prediction, np.ndarray) and prediction.shape.__len__()==1:
-                    prediction = prediction[0]
-                # agg_preds2[census_id.item()] = prediction.item()
-                agg_preds_arr[census_id.item()] = prediction.item()
-                torch.cuda.empty_cache()
+            # all regions in flat batches, summed per region
+            _, agg_preds_arr = region_sums(mynet, dataset, dataset_name, split="all", memory_policy=memory_policy)
 
             agg_preds3 = {id: agg_preds_arr[id].item() for id in validation_ids}
 
@@ -313,7 +337,16 @@ def log_scales(mynet, datalocations, dataset, metrics):
 
 
 
-def checkpoint_model(mynet, optimizerstate, epoch, log_dict, dataset_name, best_scores):
+def checkpoint_model(mynet, optimizerstate, epoch, log_dict, dataset_name, best_scores, checkpoint_writer=None, run_name=None):
+    """
+    Updates the best scores of the checkpoint path dataset_name (e.g. '/tza/VAL/') and saves the state for every
+    improved score. All improved entries share one serialized state (pix_transform.checkpoints.write_checkpoint).
+    checkpoint_writer: CheckpointWriter of the run, the entries are written with the other entries of the log step
+        in its background thread. None: written before returning.
+    run_name: file name of the checkpoints, default: name of the run (pix_transform.metrics)
+    """
+    if run_name is None:
+        run_name = get_run_name()
 
     Path("checkpoints").mkdir(parents=True, exist_ok=True)
     Path('checkpoints/best_r2{}'.format(dataset_name)).mkdir(parents=True, exist_ok=True)
@@ -325,53 +358,241 @@ def checkpoint_model(mynet, optimizerstate, epoch, log_dict, dataset_name, best_
     
     best_r2, best_mae, best_mape, best_r2_adj, best_mae_adj, best_mape_adj = best_scores
 
-    saved_dict = {'model_state_dict': mynet.state_dict(), 'optimizer_state_dict': optimizerstate, 'epoch': epoch, 'log_dict': log_dict}
-    if mynet.input_scaling:
-        saved_dict["input_scales_bias"] = [mynet.in_scale, mynet.in_bias]
-    if mynet.output_scaling:
-        saved_dict["output_scales_bias"] = [mynet.out_scale, mynet.out_bias] 
+    paths = []
 
     if log_dict["r2"]>best_r2:
         best_r2 = log_dict["r2"]
         log_dict["best_r2"] = best_r2
-        torch.save(saved_dict,
-            'checkpoints/best_r2{}{}.pth'.format(dataset_name, wandb.run.name) )
+        paths.append('checkpoints/best_r2{}{}.pth'.format(dataset_name, run_name))
     
     if log_dict["mae"]<best_mae:
         best_mae = log_dict["mae"]
         log_dict["best_mae"] = best_mae
-        torch.save(saved_dict,
-            'checkpoints/best_mae{}{}.pth'.format(dataset_name, wandb.run.name) )
+        paths.append('checkpoints/best_mae{}{}.pth'.format(dataset_name, run_name))
 
     if log_dict["mape"]<best_mape:
         best_mape = log_dict["mape"]
         log_dict["best_mape"] = best_mape
-        torch.save(saved_dict,
-            'checkpoints/best_mape{}{}.pth'.format(dataset_name, wandb.run.name) )
+        paths.append('checkpoints/best_mape{}{}.pth'.format(dataset_name, run_name))
     
     if "adjusted/r2" in log_dict.keys() and log_dict["adjusted/r2"]>best_r2_adj:
         best_r2_adj = log_dict["adjusted/r2"]
         log_dict["adjusted/best_r2"] = best_r2_adj
-        torch.save(saved_dict,
-            'checkpoints/best_r2_adj{}{}.pth'.format(dataset_name, wandb.run.name) )
+        paths.append('checkpoints/best_r2_adj{}{}.pth'.format(dataset_name, run_name))
 
     if "adjusted/mae" in log_dict.keys() and log_dict["adjusted/mae"]<best_mae_adj:
         best_mae_adj = log_dict["adjusted/mae"]
         log_dict["adjusted/best_mae"] = best_mae_adj
-        torch.save(saved_dict,
-            'checkpoints/best_mae_adj{}{}.pth'.format(dataset_name, wandb.run.name) )
+        paths.append('checkpoints/best_mae_adj{}{}.pth'.format(dataset_name, run_name))
 
     if "adjusted/mape" in log_dict.keys() and log_dict["adjusted/mape"]<best_mape_adj:
         best_mape_adj = log_dict["adjusted/mape"]
         log_dict["adjusted/best_mape"] = best_mape_adj
-        torch.save(saved_dict,
-            'checkpoints/best_mape_adj{}{}.pth'.format(dataset_name, wandb.run.name) )
+        paths.append('checkpoints/best_mape_adj{}{}.pth'.format(dataset_name, run_name))
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.add(paths, dataset_name, log_dict)
+    elif len(paths)>0:
+        write_checkpoint(checkpoint_state(mynet, optimizerstate, epoch, log_dict), paths, 'checkpoints/store/{}'.format(run_name))
 
     best_scores = best_r2, best_mae, best_mape, best_r2_adj, best_mae_adj, best_mape_adj
 
     return best_scores
 
 
+def region_sums(mynet, dataset, name, split="val", batch_size=2**16, memory_policy="logstep", regions=None):
+    """
+    Predicted population of all regions of a split ("val", "all" or "hout") of the country "name" in a
+    MultiPatchDataset. For 1x1 kernels, the pixels of all regions are passed through the network in flat batches
+    (PixScaleMLP) and summed per region with a segment sum. Networks with larger kernels need the spatial context and
+    are evaluated region by region. The sums stay on the device until all regions are evaluated.
+    regions: indices of a subset of the regions of the split, None for all
+    Returns:
+        - sums : predictions per region of the split (or subset), in the order of the split, tensor of shape
+          (num_regions,d), where d is 2 (pred & var) for the bayesian case
+        - agg_preds_arr : predictions (without variances) indexed by census id, tensor of shape (max_tregid+1,), zero
+          for the regions outside of the subset
+    """
+    BBox, Masks, tregid = dataset.split_regions(split)
+    if regions is None:
+        regions = range(len(BBox[name]))
+    census_ids = torch.as_tensor(np.asarray(tregid[name])[list(regions)], dtype=torch.long)
+
+    with torch.no_grad(), phase("inference"):
+        if mynet.convnet:
+            sums = []
+            for k in regions:
+                rmin, rmax, cmin, cmax = BBox[name][k]
+                X = torch.tensor(dataset.features[name][0,:,rmin:rmax, cmin:cmax])
+                pred = mynet.forward(X, torch.tensor(Masks[name][k]), name=name, forward_only=True, keep_on_device=True)
+                sums.append(pred.reshape(-1))
+            sums = torch.stack(sums).cpu().float() if len(sums)>0 else torch.zeros((0,mynet.out_dim))
+        else:
+            # zero buildings predict zero population, except with pop_target or exptransform (as in forward_sparse)
+            buildings_only = not (mynet.pop_target or mynet.exptransform_outputs)
+            pixels, segments, _ = dataset.get_region_pixels(name, split, buildings_only=buildings_only,
+                regions=None if len(regions)==len(BBox[name]) else regions)
+            # only in eval mode, as forward_batchwise: with active dropouts the input scaling cannot be folded.
+            # Scalings that cannot be folded (e.g. a non-positive output scale) are applied by the PixScaleMLP
+            specialize = (mynet.input_scaling or mynet.output_scaling) and (not mynet.training) and mynet.can_specialize(name)
+            net = mynet.specialized(name) if specialize else mynet
+            mlp = net.as_linear()
+            sums = torch.zeros((len(census_ids),mynet.out_dim), dtype=torch.float64, device=mlp.device)
+            for bi in range(0, pixels.shape[0], batch_size):
+                pop_est, _ = mlp(pixels[bi:bi+batch_size], name=name)
+                sums.index_add_(0, segments[bi:bi+batch_size].to(sums.device), pop_est.double())
+            sums = sums.cpu().float()
+    release_cached_memory(memory_policy)
+
+    agg_preds_arr = torch.zeros((dataset.max_tregid[name]+1,))
+    agg_preds_arr[census_ids] = sums[:,0]
+    return sums, agg_preds_arr
+
+
+def validate_model(mynet, dataset, train_dataset_name, test_dataset_names, params, datanames, full=True):
+    """
+    Validation of the log steps: region-wise metrics on the validation regions (with coarse and country-like
+    disaggregation) and, with full_ceval, eval_my_model on all regions of the test countries.
+    Does not write checkpoints, returns the log_dict and the list of checkpoint candidates (metrics, checkpoint path,
+    log prefix) for select_checkpoints. The log prefix is None if the metrics are already in the log_dict.
+    full: False for the light validation between the full ones, see validate_subset
+    """
+    if not full:
+        return validate_subset(mynet, dataset, train_dataset_name, test_dataset_names, params, datanames)
+
+    log_dict = {}
+    checkpoints = []
+
+    # Validation
+    if params["validation_split"]>0. or (params["validation_fold"] is not None):
+        this_val_scores_avg, n = np.zeros((3,)), 0
+        for name in test_dataset_names:
+            logging.info(f'Validating dataset of {name}')
+            # all validation regions in flat batches, summed per region
+            agg_preds, agg_preds_arr = region_sums(mynet, dataset, name, split="val", memory_policy=params["memory_policy"])
+            agg_preds = agg_preds.numpy()
+            val_census = np.asarray(dataset.Ys_val[name])
+
+            metrics = compute_performance_metrics_arrays(agg_preds, val_census) 
+            if name in train_dataset_name:
+                this_val_scores_avg += [metrics["r2"], metrics["mae"],  metrics["mape"]]
+                n += 1
+
+            for key in metrics.keys():
+                log_dict[name + '/validation/' + key ] = metrics[key]
+            
+            # Disaggregation per coarse val census
+            agg_preds_arr_adj, this_metrics_dis = disag_wo_map(agg_preds_arr, dataset.memory_disag_val[name])
+            for key,value in this_metrics_dis.items():
+                log_dict[name + "/validation/adjusted/coarse/"+key] = value  
+                
+            adj_metrics = compute_performance_metrics_arrays(agg_preds_arr_adj[dataset.tregid_val[name]].numpy(), np.asarray(val_census))  
+            for key,value in adj_metrics.items():
+                metrics["adjusted/"+key] = value
+                log_dict[name + "/validation/adjusted/coarse/"+key] = value  
+            
+            checkpoints.append((metrics, '/'+name+'/VAL/', None))
+
+            # "fake" new dissagregation data and reuse the function
+            # Do the disagregation on country level
+            tts = torch.zeros(dataset.memory_disag_val[name][0].shape, dtype=int)
+            tts[torch.where(dataset.memory_disag_val[name][0])] = 1
+            disaggregation_data_coarsest_val = [tts, {1: sum(list(dataset.memory_disag_val[name][1].values()))}, dataset.memory_disag_val[name][2] ]
+        
+            agg_preds_arr_country_adj, this_metrics_cl = disag_wo_map(agg_preds_arr, disaggregation_data_coarsest_val)
+            for key,value in this_metrics_cl.items():
+                log_dict[name + "/validation/adjusted/country_like/"+key] = value  
+            this_metrics_cl = compute_performance_metrics_arrays(agg_preds_arr_country_adj[dataset.tregid_val[name]].numpy(), np.asarray(val_census))  
+            for key,value in this_metrics_cl.items():
+                log_dict[name + "/validation/adjusted/country_like/"+key] = value  
+            
+            release_cached_memory(params["memory_policy"], "logstep")
+
+        avg_metrics = {}
+        avg_metrics["r2"], avg_metrics["mae"],  avg_metrics["mape"] = this_val_scores_avg/n
+        checkpoints.append((avg_metrics, '/AVG/VAL/', None))
+        for key,value in avg_metrics.items():
+            log_dict["validation/average/"+key] = value  
+
+    # Evaluation Model: Evaluates the training and validation regions at the same time!
+    if params["full_ceval"]:
+        for name in test_dataset_names: 
+            logging.info(f'Testing dataset of {name}')
+            val_census, val_regions, val_map, _, val_valid_ids, val_map_valid_ids, _, val_valid_data_mask, _, _, _ = dataset.memory_vars[name]
+            val_features = dataset.features[name]
+            
+            res, this_log_dict = eval_my_model(
+                mynet, val_features, val_valid_data_mask, val_regions,
+                val_map_valid_ids, np.unique(val_regions).__len__(), val_valid_ids, val_census,
+                dataset=dataset,
+                disaggregation_data=dataset.memory_disag[name],
+                dataset_name=name, return_scale=True, silent_mode=params["silent_mode"],
+                memory_policy=params["memory_policy"]
+            )
+            # the best scores are added by the checkpointing and logged with the rest
+            checkpoints.append((this_log_dict, '/'+name+'/ALL/', name+'/'))
+            release_cached_memory(params["memory_policy"], "logstep")
+
+    #log scales
+    log_dict = log_scales(mynet, datanames, dataset, log_dict)
+    return log_dict, checkpoints
+
+
+def validate_subset(mynet, dataset, train_dataset_name, test_dataset_names, params, datanames):
+    """
+    Light validation: region-wise metrics on a fixed random subset (val_subset) of the validation regions of each test
+    country, logged as <name>/validation_subset/<metric> and validation_subset/average/<metric>. Without the
+    disaggregation (it needs all regions) and without checkpoint candidates, the best scores and checkpoints only
+    follow the full validations.
+    """
+    log_dict = {}
+    if params["validation_split"]>0. or (params["validation_fold"] is not None):
+        this_val_scores_avg, n = np.zeros((3,)), 0
+        for name in test_dataset_names:
+            regions = dataset.val_subset(name, params["val_subset"], seed=params["random_seed"])
+            agg_preds, _ = region_sums(mynet, dataset, name, split="val", memory_policy=params["memory_policy"], regions=regions)
+            val_census = np.asarray(dataset.Ys_val[name])[regions]
+
+            metrics = compute_performance_metrics_arrays(agg_preds.numpy(), val_census)
+            if name in train_dataset_name:
+                this_val_scores_avg += [metrics["r2"], metrics["mae"],  metrics["mape"]]
+                n += 1
+            for key in metrics.keys():
+                log_dict[name + '/validation_subset/' + key] = metrics[key]
+            log_dict[name + '/validation_subset/num_regions'] = len(regions)
+            release_cached_memory(params["memory_policy"], "logstep")
+
+        for key, value in zip(["r2", "mae", "mape"], this_val_scores_avg/n):
+            log_dict["validation_subset/average/"+key] = value
+
+    log_dict = log_scales(mynet, datanames, dataset, log_dict)
+    return log_dict, []
+
+
+def select_checkpoints(mynet, optimizerstate, epoch, log_dict, checkpoints, best_scores, checkpoint_writer=None, run_name=None):
+    """
+    Saves the checkpoints of validate_model whose scores improve on best_scores (dict checkpoint path -> best scores,
+    updated in place) and adds the metrics with their best scores to the log_dict.
+    mynet: the network the metrics were computed with (or a snapshot of it)
+    checkpoint_writer: CheckpointWriter, the state is serialized once for all improved entries and written in the
+        background. None: each checkpoint path is written before returning.
+    run_name: see checkpoint_model
+    """
+    if checkpoint_writer is not None:
+        checkpoint_writer.begin(mynet, optimizerstate, epoch)
+    for metrics, dataset_name, log_prefix in checkpoints:
+        if dataset_name not in best_scores.keys():
+            best_scores[dataset_name] = [-1e12, 1e12, 1e12, -1e12, 1e12, 1e12]
+        best_scores[dataset_name] = checkpoint_model(mynet, optimizerstate, epoch, metrics, dataset_name, best_scores[dataset_name],
+            checkpoint_writer=checkpoint_writer, run_name=run_name)
+        if log_prefix is not None:
+            for key in metrics.keys():
+                log_dict[log_prefix+key] = metrics[key]
+    if checkpoint_writer is not None:
+        checkpoint_writer.commit()
+    return log_dict
+
+
 def eval_generic_model(datalocations, train_dataset_name,  test_dataset_names, params, Mynets, Datasets, memory_vars):
     
     log_dict = {}
@@ -402,6 +623,10 @@ def eval_generic_model(datalocations, train_dataset_name,  test_dataset_names, p
 
         logging.info(f'Cross Validating dataset of {name}')
 
+        # Stack the fold models to read the features once and predict all folds in a single pass
+        use_ensemble = not Mynets[0].convnet
+        fold_idx_map = torch.full(guide_res, -1, dtype=torch.int8)
+
         for k in range(5):
 
             dataset = Datasets[k]
@@ -412,28 +637,55 @@ def eval_generic_model(datalocations, train_dataset_name,  test_dataset_names, p
                 val_census_list = []
 
                 for idx in tqdm(range(len(dataset.Ys_hout[name])), disable=params["silent_mode"]):
-                    X, Y, Mask, name, census_id, BB, regMasks = dataset.get_single_holdout_item(idx, name, return_BB=True) 
-                    pop_est, scale = mynet.forward(X, mask=None, name=name, predict_map=True, forward_only=True)
+                    rmin, rmax, cmin, cmax = dataset.BBox_hout[name][idx]
+                    regMasks = torch.tensor(dataset.regMasks_hout[name][idx])
+                    census_id = torch.tensor(dataset.tregid_hout[name][idx])
+
+                    res["fold_map"][rmin:rmax, cmin:cmax][regMasks] = 1.0 * k  
+                    res["id_map"][rmin:rmax, cmin:cmax][regMasks] = census_id.to(torch.float16) #1.0 * census_id
+                    fold_idx_map[rmin:rmax, cmin:cmax][regMasks] = k
+                    if use_ensemble:
+                        continue
 
-                    rmin, rmax, cmin, cmax = BB
+                    X, Y, Mask, name, census_id, BB, regMasks = dataset.get_single_holdout_item(idx, name, return_BB=True) 
+                    with phase("inference"):
+                        pop_est, scale = mynet.forward(X, mask=None, name=name, predict_map=True, forward_only=True)
 
                     res["predicted_target_img"][rmin:rmax, cmin:cmax][Mask] = pop_est[:,0,Mask].to(torch.float16)
                     if pop_est.shape[1]==2:
                         res["variances"][rmin:rmax, cmin:cmax][Mask] = pop_est[:,1,Mask].to(torch.float16)  
                     res["scales"][:,rmin:rmax, cmin:cmax][:,regMasks] = scale[0,:,regMasks].to(torch.float16)
                     # res["scales"][:,rmin:rmax, cmin:cmax] = scale[0,:].to(torch.float16)
-                    res["fold_map"][rmin:rmax, cmin:cmax][torch.tensor(regMasks)] = 1.0 * k  
-                    res["id_map"][rmin:rmax, cmin:cmax][regMasks] = census_id.to(torch.float16) #1.0 * census_id
                     
-                    pred = pop_est[0,0,Mask].sum().detach().cpu().numpy()
-                    agg_preds.append(pred)
+                    # the sums are scattered by census id once per fold, as in region_sums
+                    agg_preds.append(pop_est[0,0,Mask].sum())
                     val_census_list.append(Y.cpu().numpy())
-                    agg_preds_arr[census_id.item()] = pop_est[0,0,Mask].sum().detach().cpu().item()
-                    
                     census_ids.append(census_id)
-                    torch.cuda.empty_cache()
+
+                if not use_ensemble and len(agg_preds)>0:
+                    agg_preds_arr[torch.stack(census_ids)] = torch.stack(agg_preds).float()
+                    agg_preds, census_ids = [], []
 
             torch.cuda.empty_cache()
+
+        if use_ensemble:
+            # the valid data mask of the holdout regions is the union of the holdout masks of all folds
+            ensemble = PixScaleEnsemble(Mynets)
+            sparse_mask = torch.as_tensor(val_valid_data_mask, dtype=torch.bool)
+            # zero buildings predict zero population, except with pop_target or exptransform (as in region_sums)
+            if not (ensemble.pop_target or ensemble.exptransform_outputs):
+                sparse_mask &= Datasets[0].buildings_mask[name]
+            with phase("inference"):
+                out = ensemble.forward_map(Datasets[0].features[name], fold_idx_map, mask=sparse_mask, name=name,
+                    regions=val_regions, num_regions=max(int(val_regions.max()), len(agg_preds_arr)-1)+1, dtype=torch.float16)
+
+            res["predicted_target_img"] = out["pop_est"][0]
+            if ensemble.out_dim==2:
+                res["variances"] = out["pop_est"][1]
+            res["scales"][:] = out["occrate"]
+            res["ensemble_mean"] = out["mean"]
+            res["ensemble_variance"] = out["variance"]
+            agg_preds_arr = out["region_sums"][:len(agg_preds_arr)].float()
         
         res["scales"][torch.isinf(res["scales"])] = np.nan
 
@@ -475,9 +727,17 @@ def eval_generic_model(datalocations, train_dataset_name,  test_dataset_names, p
     log_dict["batchiter"] = 0 
     log_dict["epoch"] = 0 
     
-    wandb.log(log_dict) 
+    log_metrics(log_dict) 
     return res_dict, log_dict
 
+def e5f_checkpoint_path(e5f_metric, test_dataset_names, run_name):
+    if e5f_metric == "final":
+        return 'checkpoints/Final/Maxstepstate_{}.pth'.format(run_name)
+    elif e5f_metric in ["best_mape_avg","best_r2_avg","best_mae_avg","best_mape_adj_avg","best_r2_adj_avg","best_mae_adj_avg"]: 
+        return 'checkpoints/{}/AVG/VAL/{}.pth'.format(e5f_metric.split("_avg")[0], run_name)
+    else: 
+        return 'checkpoints/{}/{}/VAL/{}.pth'.format(e5f_metric, test_dataset_names[0], run_name)
+
 def Eval5Fold_PixAdminTransform(
     datalocations,
     train_dataset_name,
@@ -581,17 +841,13 @@ def Eval5Fold_PixAdminTransform(
                     device=device, loss=params['loss'], kernel_size=params['kernel_size'],
                     dropout=params["dropout"],
                     input_scaling=params["input_scaling"], output_scaling=params["output_scaling"],
-                    datanames=train_dataset_name, small_net=params["small_net"], pop_target=params["population_target"]
+                    datanames=train_dataset_name, small_net=params["small_net"], pop_target=params["population_target"],
+                    precision=params["precision"]
                     ).train().to(device)
 
 
         # Loading from checkpoint
-        if params["e5f_metric"] == "final":
-            checkpoint = torch.load('checkpoints/Final/Maxstepstate_{}.pth'.format(params["eval_5fold"][k]))
-        elif params["e5f_metric"] in ["best_mape_avg","best_r2_avg","best_mae_avg","best_mape_adj_avg","best_r2_adj_avg","best_mae_adj_avg"]: 
-            checkpoint = torch.load('checkpoints/{}/AVG/VAL/{}.pth'.format(params["e5f_metric"].split("_avg")[0], params["eval_5fold"][k])) 
-        else: 
-            checkpoint = torch.load('checkpoints/{}/{}/VAL/{}.pth'.format(params["e5f_metric"], test_dataset_names[0], params["eval_5fold"][k])) 
+        checkpoint = torch.load(e5f_checkpoint_path(params["e5f_metric"], test_dataset_names, params["eval_5fold"][k]))
         
         mynet.load_state_dict(checkpoint['model_state_dict'])
         if "input_scales_bias" in checkpoint.keys():
@@ -609,6 +865,22 @@ def Eval5Fold_PixAdminTransform(
 
 
 
+def build_pixel_model(mynet, name, params, dataset, log_dict):
+    """
+    Pixel model of the country "name" for the full map predictions: int8 with --quantized_inference (the quantization
+    report is added to log_dict), frozen with --frozen_inference, else None (mynet is used).
+    """
+    if params["quantized_inference"] is not None:
+        metrics, models = quantization_report(mynet, dataset, name, modes=(params["quantized_inference"],), silent_mode=False)
+        for model_name, this_metrics in metrics.items():
+            for key, value in this_metrics.items():
+                log_dict[name+'/quantization/'+model_name+'/'+key] = value
+        return models[params["quantized_inference"]]
+    if params["frozen_inference"] is not None:
+        return export_inference_module(mynet, name, mode=params["frozen_inference"])
+    return None
+
+
 def EvalModel_PixAdminTransform(
     datalocations,
     train_dataset_name,
@@ -644,7 +916,8 @@ def EvalModel_PixAdminTransform(
                 device=device, loss=params['loss'], kernel_size=params['kernel_size'],
                 dropout=params["dropout"],
                 input_scaling=params["input_scaling"], output_scaling=params["output_scaling"],
-                datanames=train_dataset_name, small_net=params["small_net"], pop_target=params["population_target"]
+                datanames=train_dataset_name, small_net=params["small_net"], pop_target=params["population_target"],
+                precision=params["precision"]
                 ).train().to(device)
 
 
@@ -672,13 +945,16 @@ def EvalModel_PixAdminTransform(
         logging.info(f'Testing dataset of {name}')
         val_census, val_regions, val_map, _, val_valid_ids, val_map_valid_ids, _, val_valid_data_mask, _, _, _ = memory_vars[name]
         val_features = dataset.features[name]
+        pixel_model = build_pixel_model(mynet, name, params, dataset, log_dict)
         
         res, this_log_dict = eval_my_model(
             mynet, val_features, val_valid_data_mask, val_regions,
             val_map_valid_ids, np.unique(val_regions).__len__(), val_valid_ids, val_census,
             dataset=dataset,
             disaggregation_data=dataset.memory_disag[name],
-            dataset_name=name, return_scale=True, silent_mode=params["silent_mode"], full_eval=True
+            dataset_name=name, return_scale=True, silent_mode=params["silent_mode"], full_eval=True,
+            sparse=params["sparse_inference"], pixel_model=pixel_model, mc_dropout_samples=params["mc_dropout_samples"],
+            inference_workers=params["inference_workers"], threads_per_worker=params["threads_per_worker"]
         )
 
 
@@ -690,7 +966,7 @@ def EvalModel_PixAdminTransform(
 
     log_dict["batchiter"] = 0
 
-    wandb.log(log_dict)
+    log_metrics(log_dict)
     return res_dict, log_dict
 
 
@@ -0,0 +1,240 @@
+import copy
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from pix_transform.checkpoints import snapshot_model
+
+
+class FrozenPixScaleNet(nn.Module):
+    """
+    Inference-only PixScaleNet (1x1 kernels) for a single country. The dropouts are removed and the country scalings
+    are folded into the first and the last layers, such that the forward pass has no python control flow left and
+    can be scripted. Works on pixel matrices of shape (N,C) with the building counts in the first column.
+    """
+
+    def __init__(self, occratenet, occrate_layer, occrate_var_layer, pop_target=False, bayesian=False, pred_var=True,
+        exptransform_outputs=False, zero_no_buildings=False):
+        super(FrozenPixScaleNet, self).__init__()
+        self.occratenet = occratenet
+        self.occrate_layer = occrate_layer
+        self.occrate_var_layer = occrate_var_layer
+        self.pop_target = pop_target
+        self.bayesian = bayesian
+        self.pred_var = pred_var
+        self.exptransform_outputs = exptransform_outputs
+        self.zero_no_buildings = zero_no_buildings
+        self.out_dim = 2 if bayesian else 1
+
+
+    def forward(self, pixels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        buildings = pixels[:,0:1]
+        has_buildings = buildings!=0
+
+        if self.pop_target:
+            data = pixels
+        else:
+            data = pixels[:,1:]
+
+        feats = self.occratenet(data)
+
+        if self.pop_target:
+            pop_est = self.occrate_layer(feats)
+            if self.zero_no_buildings:
+                pop_est = pop_est * has_buildings
+            occrate = torch.where(has_buildings, pop_est / buildings, torch.zeros_like(pop_est))
+        else:
+            occrate = self.occrate_layer(feats)
+            if self.bayesian:
+                var = self.occrate_var_layer(feats)
+                if not self.pred_var:
+                    var = torch.exp(var)
+                occrate = torch.cat([occrate, var], 1)
+                if self.zero_no_buildings:
+                    occrate = occrate * has_buildings
+
+                # Variance Propagation
+                pop_est = torch.cat([buildings*occrate[:,0:1], buildings*buildings*occrate[:,1:2]], 1)
+            else:
+                pop_est = buildings*occrate
+
+        if self.exptransform_outputs:
+            pop_est = pop_est.exp()
+
+        return pop_est, occrate
+
+
+class FrozenPixScaleMap(nn.Module):
+    """
+    Image layout of a FrozenPixScaleNet: (1,C,h,w) sanitized features to (1,d,h,w) maps. Used for the ONNX export,
+    where h and w are dynamic axes.
+    """
+
+    def __init__(self, frozen):
+        super(FrozenPixScaleMap, self).__init__()
+        self.frozen = frozen
+
+
+    def forward(self, features):
+        c, h, w = features.shape[1], features.shape[2], features.shape[3]
+        pixels = features[0].reshape(c, h*w).t()
+        pop_est, occrate = self.frozen(pixels)
+        return pop_est.t().reshape(1, -1, h, w), occrate.t().reshape(1, -1, h, w)
+
+
+def fold_input_scale(layer, scale, bias):
+    """
+    Folds the input scaling (x-bias)/scale into a nn.Linear or a nn.Conv2d with 1x1 kernels:
+    W' = W/scale, b' = b - W @ (bias/scale).
+    """
+    with torch.no_grad():
+        weight = layer.weight.view(layer.weight.shape[0], -1)
+        scale, bias = scale.reshape(-1), bias.reshape(-1)
+        layer.bias -= weight @ (bias/scale)
+        weight /= scale
+    return layer
+
+
+def fold_output_scale(head, scale, exp_output=False):
+    """
+    Folds a positive output scale into a head of the form Sequential(Linear, Softplus/Identity).
+    Softplus: s*softplus_beta(Wx+b) == softplus_(beta/s)(s*W x + s*b), also in the linear regime above the threshold.
+    Identity followed by exp (variance head without pred_var): s*exp(Wx+b) == exp(Wx + b + log(s)).
+    """
+    if scale<=0:
+        raise Exception("Only positive output scales can be folded into the network")
+    linear, activation = head[0], head[1]
+    with torch.no_grad():
+        if isinstance(activation, nn.Softplus):
+            linear.weight *= scale
+            linear.bias *= scale
+            head[1] = nn.Softplus(beta=activation.beta/scale, threshold=activation.threshold)
+        elif exp_output:
+            linear.bias += torch.log(torch.tensor(scale, dtype=linear.bias.dtype))
+        else:
+            raise Exception("Cannot fold the output scale into {}".format(activation))
+    return head
+
+
+def freeze_pixscalenet(net, name=None):
+    """
+    Builds a FrozenPixScaleNet with the weights of a PixScaleNet (1x1 kernels) for the country "name". The input
+    scaling (data-bias)/scale is folded into the first linear layer and the output scale into the last layers.
+    Countries without own scalings get the mean scalings, as in PixScaleNet.forward.
+    """
+    mlp = net.as_linear().eval()
+    occratenet = nn.Sequential(*[copy.deepcopy(layer) for layer in mlp.occratenet if not isinstance(layer, nn.Dropout)])
+    occrate_layer = copy.deepcopy(mlp.occrate_layer)
+    occrate_var_layer = copy.deepcopy(mlp.occrate_var_layer)
+
+    with torch.no_grad():
+        if net.input_scaling:
+            fold_input_scale(occratenet[0], *mlp.input_scale_bias(name))
+
+        if net.output_scaling:
+            scale = mlp.output_scale(name).item()
+            fold_output_scale(occrate_layer, scale)
+            if net.bayesian:
+                fold_output_scale(occrate_var_layer, scale**2, exp_output=not net.pred_var)
+
+    frozen = FrozenPixScaleNet(occratenet, occrate_layer, occrate_var_layer, pop_target=net.pop_target, bayesian=net.bayesian,
+        pred_var=net.pred_var, exptransform_outputs=net.exptransform_outputs, zero_no_buildings=net.zero_no_buildings)
+    for param in frozen.parameters():
+        param.requires_grad_(False)
+    return frozen.to(net.device).eval()
+
+
+def export_inference_module(net, name=None, mode="script"):
+    """
+    Freezes the network for the country "name" and compiles it for inference.
+    mode: "script" (torch.jit.script + torch.jit.freeze, can be saved with torch.jit.save), "compile" (torch.compile)
+        or "eager" (only the folding).
+    """
+    frozen = freeze_pixscalenet(net, name)
+    if mode=="script":
+        return torch.jit.freeze(torch.jit.script(frozen))
+    elif mode=="compile":
+        if not hasattr(torch, "compile"):
+            raise Exception("torch.compile requires torch>=2.0, use mode 'script'")
+        return torch.compile(frozen, dynamic=True)
+    elif mode=="eager":
+        return frozen
+    else:
+        raise Exception("unknown export mode {}".format(mode))
+
+
+def export_onnx(net, output_path, name=None, opset_version=13, metadata=None):
+    """
+    Exports the frozen network for the country "name" to ONNX. Input "features" (1,C,height,width), outputs "pop_est"
+    and "occrate" (1,d,height,width), with dynamic height and width.
+    metadata: dict of strings stored in the metadata_props of the model (e.g. the geo metadata of the country)
+    """
+    frozen = freeze_pixscalenet(net, name).cpu()
+    module = FrozenPixScaleMap(frozen).eval()
+    channels_in = net.channels_in if net.pop_target else net.channels_in + 1
+    dummy_input = torch.rand((1, channels_in, 64, 48))
+
+    torch.onnx.export(module, (dummy_input,), output_path, input_names=["features"], output_names=["pop_est", "occrate"],
+        dynamic_axes={"features": {2: "height", 3: "width"}, "pop_est": {2: "height", 3: "width"}, "occrate": {2: "height", 3: "width"}},
+        opset_version=opset_version, do_constant_folding=True)
+
+    if metadata is not None:
+        import onnx
+        model = onnx.load(output_path)
+        for key, value in metadata.items():
+            entry = model.metadata_props.add()
+            entry.key, entry.value = key, str(value)
+        onnx.save(model, output_path)
+    return output_path
+
+
+def check_onnx_parity(net, onnx_path, name=None, size=256, seed=1610, rtol=1e-4, atol=1e-4, num_threads=1):
+    """
+    Compares the ONNX model (run with onnxruntime) against PixScaleNet.forward on a random tile of size x size pixels,
+    where a tenth of the pixels have buildings. Raises if the outputs differ, returns the max abs differences.
+    The occupancy rates are only compared on pixels with buildings (PixScaleNet leaves NaNs there with pop_target).
+    """
+    import onnxruntime as ort
+
+    channels_in = net.channels_in if net.pop_target else net.channels_in + 1
+    gen = torch.Generator().manual_seed(seed)
+    inputs = torch.randn((1, channels_in, size, size), generator=gen)
+    buildings = torch.randint(1, 50, (size,size), generator=gen).float()
+    buildings[torch.rand((size,size), generator=gen)>0.1] = 0
+    inputs[0,0] = buildings
+    has_buildings = (buildings>0).numpy()
+
+    with torch.no_grad():
+        # on a cpu copy in eval mode, the network of the caller is not changed
+        pop_est, occrate = snapshot_model(net, "cpu")(inputs, name=name, predict_map=True, forward_only=True)
+
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = num_threads
+    session = ort.InferenceSession(onnx_path, sess_options, providers=["CPUExecutionProvider"])
+    onnx_pop_est, onnx_occrate = session.run(["pop_est", "occrate"], {"features": inputs.numpy()})
+
+    diffs = {}
+    for key, reference, result in [("pop_est", pop_est.numpy(), onnx_pop_est), ("occrate", occrate.numpy(), onnx_occrate)]:
+        if reference.shape!=result.shape:
+            raise Exception("ONNX parity check failed: shape of {} is {} instead of {}".format(key, result.shape, reference.shape))
+        if key=="occrate":
+            reference, result = reference[:,:,has_buildings], result[:,:,has_buildings]
+        if not np.allclose(result, reference, rtol=rtol, atol=atol):
+            raise Exception("ONNX parity check failed: max abs diff of {} is {}".format(key, np.abs(result-reference).max()))
+        diffs[key] = np.abs(result-reference).max()
+    return diffs
+
+
+def load_scalenet_checkpoint(net, checkpoint_path):
+    """
+    Loads the weights and the country scalings of a checkpoint (e.g. checkpoints/Final/Maxstepstate_*.pth) into net.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location=net.device)
+    net.load_state_dict(checkpoint['model_state_dict'])
+    if "input_scales_bias" in checkpoint.keys():
+        net.in_scale, net.in_bias = checkpoint["input_scales_bias"][0], checkpoint["input_scales_bias"][1]
+    if "output_scales_bias" in checkpoint.keys():
+        net.out_scale, net.out_bias = checkpoint["output_scales_bias"][0], checkpoint["output_scales_bias"][1]
+    return net.eval()
@@ -0,0 +1,200 @@
+import atexit
+import datetime
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import numpy as np
+import torch
+
+
+backends = ["wandb", "jsonl", "sqlite", "none"]
+
+
+def to_python(value):
+    """
+    JSON serializable copy of a logged value: tensors and arrays become numbers (one element) or lists.
+    """
+    if torch.is_tensor(value):
+        value = value.detach().cpu().numpy()
+    if isinstance(value, np.ndarray):
+        return value.item() if value.size==1 else value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(key): to_python(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_python(v) for v in value]
+    return value
+
+
+def make_run_name():
+    return datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+
+
+class NoopSink:
+    def log(self, log_dict):
+        pass
+
+    def histogram(self, values):
+        return None
+
+    def close(self):
+        pass
+
+
+class WandbSink:
+    """
+    Logs to a wandb run (needs the wandb package and, unless offline, the network).
+    """
+
+    def __init__(self, run_name, config, project, entity):
+        import wandb
+        self.wandb = wandb
+        wandb.init(project=project, entity=entity, config=config, name=run_name)
+        self.run_name = wandb.run.name
+
+    def log(self, log_dict):
+        self.wandb.log(log_dict)
+
+    def histogram(self, values):
+        return self.wandb.Histogram(values)
+
+    def close(self):
+        self.wandb.finish()
+
+
+class LocalSink:
+    """
+    Appends the logs to local files: <log_dir>/<run_name>.jsonl (one line per log call) or the table "logs" of
+    <log_dir>/<run_name>.sqlite (one row per key), with the number of the log call "_step" and the time "_timestamp".
+    The config is written to <log_dir>/<run_name>.config.json.
+    log() only queues a shallow copy of the dict, the values are converted and written by a background thread, which
+    flushes the file at least every flush_interval seconds and when the sink is closed (also at exit).
+    """
+
+    def __init__(self, run_name, config=None, log_dir="logs", fmt="jsonl", flush_interval=5.):
+        if fmt not in ["jsonl", "sqlite"]:
+            raise Exception("unknown metrics format {}".format(fmt))
+        os.makedirs(log_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, "{}.{}".format(run_name, fmt))
+        self.fmt, self.flush_interval = fmt, flush_interval
+        if config is not None:
+            with open(os.path.join(log_dir, "{}.config.json".format(run_name)), "w") as f:
+                json.dump(to_python(config), f, indent=1, default=str)
+        self.step = 0
+        self.errors = []
+        self.entries = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.closed = False
+        atexit.register(self.close)
+
+
+    def log(self, log_dict):
+        if len(self.errors)>0:
+            raise self.errors[0]
+        self.entries.put((self.step, time.time(), dict(log_dict)))
+        self.step += 1
+
+
+    def histogram(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        counts, bins = np.histogram(values[np.isfinite(values)], bins=64)
+        return {"_type": "histogram", "counts": counts, "bins": bins}
+
+
+    def _run(self):
+        if self.fmt=="jsonl":
+            out = open(self.path, "a")
+        else:
+            out = sqlite3.connect(self.path)
+            out.execute("CREATE TABLE IF NOT EXISTS logs (step INTEGER, timestamp REAL, key TEXT, value TEXT)")
+        last_flush = time.time()
+        while True:
+            try:
+                entry = self.entries.get(timeout=self.flush_interval)
+            except queue.Empty:
+                entry = False
+            try:
+                if entry:
+                    self._write(out, *entry)
+                if entry is None or time.time()-last_flush>=self.flush_interval:
+                    out.flush() if self.fmt=="jsonl" else out.commit()
+                    last_flush = time.time()
+            except Exception as e:
+                self.errors.append(e)
+            if entry is None:
+                break
+        out.close()
+
+
+    def _write(self, out, step, timestamp, log_dict):
+        values = {key: to_python(value) for key, value in log_dict.items()}
+        if self.fmt=="jsonl":
+            out.write(json.dumps(dict(values, _step=step, _timestamp=timestamp), default=str) + "\n")
+        else:
+            out.executemany("INSERT INTO logs VALUES (?, ?, ?, ?)",
+                [(step, timestamp, key, json.dumps(value, default=str)) for key, value in values.items()])
+
+
+    def close(self):
+        """
+        Writes the queued logs and closes the file.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.entries.put(None)
+        self.thread.join()
+        if len(self.errors)>0:
+            raise self.errors[0]
+
+
+_sink = NoopSink()
+_run_name = None
+
+
+def init_metrics(backend="wandb", run_name=None, config=None, project="HAC", entity=None, log_dir="logs"):
+    """
+    Sets up the metrics backend of the process, see backends: wandb, local files ("jsonl", "sqlite", see LocalSink)
+    or "none" (nothing is logged). The run name names the checkpoints and outputs of the run. None: wandb assigns it
+    for the wandb backend, else a new name <date>-<time>-<random suffix>. Returns the run name.
+    """
+    global _sink, _run_name
+    if backend not in backends:
+        raise Exception("unknown metrics backend {}, options: {}".format(backend, ", ".join(backends)))
+    if backend=="wandb":
+        _sink = WandbSink(run_name, config, project, entity)
+        _run_name = _sink.run_name
+        return _run_name
+    _run_name = run_name if run_name is not None else make_run_name()
+    if backend=="none":
+        _sink = NoopSink()
+    else:
+        _sink = LocalSink(_run_name, config, log_dir, fmt=backend)
+    return _run_name
+
+
+def log_metrics(log_dict):
+    _sink.log(log_dict)
+
+
+def metrics_histogram(values):
+    # histogram in the format of the backend, None without a backend
+    return _sink.histogram(values)
+
+
+def get_run_name():
+    if _run_name is None:
+        raise Exception("no metrics run, see init_metrics")
+    return _run_name
+
+
+def finish_metrics():
+    global _sink
+    _sink.close()
+    _sink = NoopSink()
@@ -0,0 +1,231 @@
+import os
+import queue
+import threading
+import h5py
+import torch
+import torch.multiprocessing as mp
+
+from pix_transform.checkpoints import snapshot_model
+
+
+class FeatureSource:
+    """
+    Picklable handle of a feature cube of shape (1,C,h,w) or (C,h,w) for the inference workers. hdf5 datasets are
+    reopened by file name in each worker, arrays and tensors are moved to shared memory once.
+    """
+
+    def __init__(self, inputs, share=False):
+        if isinstance(inputs, h5py.Dataset):
+            self.filename, self.key, self.tensor = inputs.file.filename, inputs.name, None
+        else:
+            self.filename, self.key = None, None
+            self.tensor = torch.as_tensor(inputs)
+            if share:
+                self.tensor.share_memory_()
+
+
+    def open(self):
+        if self.tensor is not None:
+            return self.tensor
+        return h5py.File(self.filename, "r")[self.key]
+
+
+def read_strip(inputs, hi, rows):
+    strip = inputs[0,:,hi:hi+rows] if len(inputs.shape)==4 else inputs[:,hi:hi+rows]
+    return torch.as_tensor(strip).unsqueeze(0)
+
+
+def infer_strip(model, strip, strip_mask, name, sparse, batch_size):
+    """
+    Predictions (pop_est, occrate) of shape (1,d,rows,w) for one strip of rows. sparse: only the pixels with buildings
+    (and inside the mask) are passed through the PixScaleMLP "model", else the full strip through the PixScaleNet.
+    """
+    if not sparse:
+        return model.forward_batchwise(strip, name=name, predict_map=True, forward_only=True)
+
+    _, _, rows, w = strip.shape
+    pop_est = torch.zeros((1,model.out_dim,rows,w), dtype=torch.float32)
+    occrate = torch.zeros((1,model.out_dim,rows,w), dtype=torch.float32)
+    pixels = strip[0].reshape(strip.shape[1], -1)
+    selection = pixels[0]>0
+    if strip_mask is not None:
+        selection &= strip_mask.reshape(-1)
+    idxs = torch.nonzero(selection).squeeze(1)
+    pop_flat, occ_flat = pop_est.view(model.out_dim, -1), occrate.view(model.out_dim, -1)
+    for bi in range(0, len(idxs), batch_size):
+        this_idxs = idxs[bi:bi+batch_size]
+        this_pop_est, this_occrate = model(pixels[:,this_idxs].t(), name=name)
+        pop_flat[:,this_idxs] = this_pop_est.t().cpu()
+        occ_flat[:,this_idxs] = this_occrate.t().cpu()
+    return pop_est, occrate
+
+
+def run_tile_pipeline(model, source, mask, tasks, outputs, name=None, sparse=True, rows=512, queue_size=2, batch_size=2**16,
+    num_threads=None, cores=None):
+    """
+    Pipeline of one worker: a reader thread reads the strips of rows listed in "tasks" (a queue of first rows, ended by
+    None), the calling thread runs the inference and a writer thread copies the results into the output maps. The
+    queues between the stages hold at most queue_size strips, so reading and writing overlap with the inference
+    (torch releases the GIL) while the memory stays bounded.
+    num_threads: torch threads of this worker, cores: cpu cores the worker is pinned to (None: no pinning)
+    """
+    if cores is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    inputs = source.open()
+    pop_est_map, occrate_map = outputs
+    read_queue, write_queue = queue.Queue(maxsize=queue_size), queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def reader():
+        try:
+            while True:
+                hi = tasks.get()
+                if hi is None:
+                    break
+                strip_mask = mask[hi:hi+rows] if mask is not None else None
+                read_queue.put((hi, read_strip(inputs, hi, rows), strip_mask))
+        except Exception as e:
+            errors.append(e)
+        read_queue.put(None)
+
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            hi, pop_est, occrate = item
+            try:
+                pop_est_map[:,:,hi:hi+rows] = pop_est
+                occrate_map[:,:,hi:hi+rows] = occrate
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=writer, daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        with torch.no_grad():
+            while True:
+                item = read_queue.get()
+                if item is None:
+                    break
+                hi, strip, strip_mask = item
+                write_queue.put((hi, *infer_strip(model, strip, strip_mask, name, sparse, batch_size)))
+    finally:
+        write_queue.put(None)
+    for thread in threads:
+        thread.join()
+    if len(errors)>0:
+        raise errors[0]
+
+
+def _worker_main(model, source, mask, tasks, outputs, kwargs):
+    run_tile_pipeline(model, source, mask, tasks, outputs, **kwargs)
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def worker_cores(num_workers, threads_per_worker):
+    """
+    Disjoint sets of cores per worker if threads should be bound (OMP_PROC_BIND, set in superpixel_disagg_model.py),
+    None per worker otherwise or if there are not enough cores.
+    """
+    cores = available_cores()
+    bind = os.environ.get("OMP_PROC_BIND", "false").lower() not in ["false", ""]
+    if (not bind) or num_workers*threads_per_worker>len(cores):
+        return [None]*num_workers
+    return [cores[i*threads_per_worker:(i+1)*threads_per_worker] for i in range(num_workers)]
+
+
+def predict_map_parallel(net, inputs, mask=None, name=None, num_workers=1, threads_per_worker=None, rows=512, queue_size=2,
+    sparse=True, batch_size=2**16):
+    """
+    Full map prediction on the cpu, like forward_batchwise(predict_map=True) or forward_sparse, with the map split into
+    strips of "rows" rows that are read, evaluated and written in a pipeline (see run_tile_pipeline).
+    With num_workers>1 the strips are distributed dynamically over worker processes with threads_per_worker torch
+    threads each (default: the available cores split evenly). If OMP_PROC_BIND is set, every worker is bound to its
+    own cores (OMP_PLACES and the affinity of the process), such that the bound OpenMP threads of the workers do not
+    share cores.
+    Inputs:
+        - inputs : array/tensor/hdf5 dataset of shape (1,C,h,w) or (C,h,w). Tensors are moved to shared memory for the workers.
+        - mask : boolean mask of shape (h,w) of the pixels to evaluate, only used with sparse
+        - sparse: only evaluate the pixels with buildings, as forward_sparse. Falls back to the dense path if the
+          configuration of the network does not allow it.
+    Output:
+        - pop_est and occrate maps of shape (1,d,h,w), on the cpu
+    """
+    if sparse and (net.convnet or net.pop_target or net.exptransform_outputs):
+        print("sparse inference not available for this configuration, using the dense path")
+        sparse = False
+    if (net.input_scaling or net.output_scaling) and net.can_specialize(name):
+        # specialize() also drops the parameter groups and scalings, which cannot be sent to the workers
+        model = net.specialize(name).cpu().eval()
+        model.device = "cpu"
+    else:
+        # scalings that cannot be folded are applied in the forward, on detached copies
+        model = snapshot_model(net, "cpu")
+    if sparse:
+        model = model.as_linear().eval()
+
+    oh, ow = inputs.shape[-2:]
+    outputs = (torch.zeros((1,net.out_dim,oh,ow), dtype=torch.float32), torch.zeros((1,net.out_dim,oh,ow), dtype=torch.float32))
+    if mask is not None:
+        mask = torch.as_tensor(mask, dtype=torch.bool)
+    starts = [hi for hi in range(0, oh, rows) if (not sparse) or mask is None or mask[hi:hi+rows].any()]
+
+    kwargs = {"name": name, "sparse": sparse, "rows": rows, "queue_size": queue_size, "batch_size": batch_size}
+
+    if num_workers<=1:
+        # in this process, only the number of torch threads is changed (and restored)
+        tasks = queue.Queue()
+        for hi in starts + [None]:
+            tasks.put(hi)
+        num_threads = torch.get_num_threads()
+        try:
+            run_tile_pipeline(model, FeatureSource(inputs), mask, tasks, outputs, num_threads=threads_per_worker, **kwargs)
+        finally:
+            torch.set_num_threads(num_threads)
+        return outputs
+
+    if threads_per_worker is None:
+        threads_per_worker = max(1, len(available_cores())//num_workers)
+
+    ctx = mp.get_context("spawn")
+    tasks = ctx.Queue()
+    for hi in starts + [None]*num_workers:
+        tasks.put(hi)
+    source = FeatureSource(inputs, share=True)
+    for output in outputs:
+        output.share_memory_()
+    if mask is not None:
+        mask.share_memory_()
+
+    workers = []
+    environ = dict(os.environ)
+    try:
+        for this_cores in worker_cores(num_workers, threads_per_worker):
+            # the OpenMP runtime of a worker reads its thread budget and places from the environment at startup
+            os.environ["OMP_NUM_THREADS"] = str(threads_per_worker)
+            if this_cores is not None:
+                os.environ["OMP_PLACES"] = ",".join(["{"+str(c)+"}" for c in this_cores])
+            worker = ctx.Process(target=_worker_main, args=(model, source, mask, tasks, outputs, dict(kwargs, num_threads=threads_per_worker, cores=this_cores)))
+            worker.start()
+            workers.append(worker)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+    for worker in workers:
+        worker.join()
+    failed = [rank for rank, worker in enumerate(workers) if worker.exitcode!=0]
+    if len(failed)>0:
+        raise Exception("inference workers {} failed".format(failed))
+    return outputs
@@ -9,23 +9,31 @@ import torch.nn.functional as F
 import torch.optim as optim
 import torch.utils.data
 import sys
-import wandb
 import h5py
 import pickle
 from pathlib import Path
 import random
 
 from utils import plot_2dmatrix, accumulate_values_by_region, compute_performance_metrics, bbox2, \
-     PatchDataset, MultiPatchDataset, NormL1, LogL1, LogL2, LogoutputL1, LogoutputL2, compute_performance_metrics_arrays, myMSEloss
+     PatchDataset, MultiPatchDataset, NormL1, LogL1, LogL2, LogoutputL1, LogoutputL2, compute_performance_metrics_arrays, myMSEloss, \
+     weighted_sample_sums, release_cached_memory, ResumableSampler, DistributedWeightedSampler, ImportanceSampler, \
+     apply_country_quotas
 from cy_utils import compute_map_with_new_labels, compute_accumulated_values_by_region, compute_disagg_weights, \
     set_value_for_each_region
 # from pix_transform_utils.utils import upsample
 
-from pix_transform.pix_transform_net import PixTransformNet, PixScaleNet
+from pix_transform.pix_transform_net import PixTransformNet, PixScaleNet, grad_scaler
 
 from bayesian_dl.loss import GaussianNLLLoss, LaplacianNLLLoss
 
-from pix_transform.evaluation import disag_map, disag_wo_map, disag_and_eval_map, eval_my_model, checkpoint_model, log_scales
+from pix_transform.evaluation import disag_map, disag_wo_map, disag_and_eval_map, eval_my_model, checkpoint_model, log_scales, build_pixel_model, \
+    validate_model, select_checkpoints, eval_generic_model, e5f_checkpoint_path
+from pix_transform.async_validation import ValidationWorker
+from pix_transform.checkpoints import CheckpointWriter, checkpoint_state, get_rng_states, set_rng_states, load_scalings, \
+    load_training_state
+from pix_transform.metrics import log_metrics, get_run_name
+from pix_transform.profiling import phase, profiled_iter, op_profiler
+from pix_transform.distributed import get_rank, get_world_size, broadcast_parameters, all_reduce_gradients
 
 if 'ipykernel' in sys.modules:
     from tqdm import tqdm_notebook as tqdm
@@ -33,24 +41,24 @@ else:
     from tqdm import tqdm as tqdm
 
 
-def PixAdminTransform(
-    datalocations,
-    train_dataset_name,
-    test_dataset_names,
-    params):
+def train_model(dataset, datalocations, train_dataset_name, test_dataset_names, params, run_name, log_prefix=""):
+    """
+    Trains a network on the training regions of the MultiPatchDataset "dataset", with validation and checkpoints
+    named run_name. Generator: yields once when the setup before the network is done (the validation worker is
+    forked, see ValidationWorker), then after every optimizer step, and returns (mynet, log_dict) after the final
+    state is saved. Run it with interleave_training.
+    In a data-parallel training (pix_transform.distributed), the ranks train on their shards of the samples with
+    averaged gradients, only rank 0 validates, logs and writes checkpoints.
+    log_prefix: prefix of the logged keys
+    """
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    rank, world_size = get_rank(), get_world_size()
+    main_process = rank==0
 
-    #### prepare Dataset #########################################################################
-    # unique_datasets = set(list(validation_data.keys()) + list(training_source.keys()))
-
-    #if params["admin_augment"]:
-    dataset = MultiPatchDataset(datalocations, train_dataset_name, params["train_level"], params['memory_mode'], device, 
-        params["validation_split"], params["validation_fold"], params["weights"], params["custom_sampler_weights"], 
-        random_seed_folds=params["random_seed_folds"], build_pairs=params["admin_augment"], remove_feat_idxs=params["remove_feat_idxs"])
-    #else:
-    #    raise Exception("option not available")
-    #    dataset = PatchDataset(training_source, params['memory_mode'], device, params["validation_split"])
+    def log(log_dict):
+        if main_process:
+            log_metrics({log_prefix+key: value for key, value in log_dict.items()})
 
     # Fix all random seeds
     torch.manual_seed(params["random_seed"])
@@ -62,15 +70,40 @@ def PixAdminTransform(
     torch.backends.cudnn.deterministic = True
     os.environ['PYTHONHASHSEED'] = str(params["random_seed"])
 
+    # share of each training country among the drawn samples
+    quotas = None
+    if params["country_quotas"] is not None:
+        quotas = dict(zip(train_dataset_name, params["country_quotas"]))
+    importance_sampler = None
     if params["sampler"] in ['custom', 'natural']:
         weights = dataset.all_natural_weights if params["sampler"]=="natural" else dataset.custom_sampler_weights
+        if quotas is not None:
+            weights = apply_country_quotas(weights, dataset.sample_countries(), quotas)
         sampler = torch.utils.data.WeightedRandomSampler(weights, len(weights), replacement=False)
-        shuffle = False
+    elif params["sampler"]=="importance":
+        if world_size>1:
+            raise Exception("the importance sampler is not available in a distributed training")
+        if params["loss"] in ["gaussNLL", "laplaceNLL"]:
+            raise Exception("the importance sampler needs a non-negative loss, not " + params["loss"])
+        importance_sampler = ImportanceSampler(dataset.custom_sampler_weights, dataset.sample_countries(), quotas,
+            smoothing=params["importance_smoothing"], seed=params["random_seed"])
+        weights = None
     else:
         logging.info(f'Using no weighted sampler') 
-        sampler = None
-        shuffle = True
-    train_loader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=shuffle, sampler=sampler, num_workers=0)
+        weights = None
+        sampler = torch.utils.data.RandomSampler(dataset)
+    if world_size>1:
+        sampler = DistributedWeightedSampler(dataset, weights, world_size, rank, seed=params["random_seed"])
+    # records the order and the position in the epoch for the resumable state
+    train_sampler = importance_sampler if importance_sampler is not None else ResumableSampler(sampler)
+    train_loader = torch.utils.data.DataLoader(dataset, batch_size=1, sampler=train_sampler, num_workers=0)
+
+    # the validation worker shares the dataset, it is forked before the network initializes cuda
+    validator = None
+    if params["async_validation"] and main_process:
+        validator = ValidationWorker(dataset, train_dataset_name, test_dataset_names, params, list(datalocations.keys()),
+            num_threads=params["validation_threads"])
+    yield
 
     #### setup loss/network ############################################################################
 
@@ -106,7 +139,8 @@ def PixAdminTransform(
                         device=device, loss=params['loss'], kernel_size=params['kernel_size'],
                         dropout=params["dropout"],
                         input_scaling=params["input_scaling"], output_scaling=params["output_scaling"],
-                        datanames=train_dataset_name, small_net=params["small_net"], pop_target=params["population_target"]
+                        datanames=train_dataset_name, small_net=params["small_net"], pop_target=params["population_target"],
+                        precision=params["precision"]
                         ).train().to(device)
 
     #Optimizer
@@ -115,6 +149,8 @@ def PixAdminTransform(
     elif params["optim"]=="adamw":
         optimizer = optim.AdamW(mynet.params_with_regularizer, lr=params['lr'], weight_decay=params["weights_regularizer_adamw"])
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=params["lr_scheduler_step"], gamma=params["lr_scheduler_gamma"])
+    # loss scaling for fp16, None otherwise
+    scaler = grad_scaler(device, mynet.autocast_dtype)
 
     # Load from state
     if params["load_state"] is not None:
@@ -123,46 +159,129 @@ def PixAdminTransform(
         mynet.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
     # wandb.watch(mynet)
+
+    if world_size>1:
+        broadcast_parameters([param for group in optimizer.param_groups for param in group["params"]])
+        # different dropout masks on the ranks
+        torch.manual_seed(params["random_seed"] + rank)
     
     #### train network ############################################################################
 
     epochs = params["epochs"]
+    start_epoch = 0
     itercounter = 0
     batchiter = 0
-
-    # initialize the best score variables
-    best_scores, best_val_scores = {}, {}
-    for test_dataset_name in test_dataset_names:
-        best_scores[test_dataset_name] = [-1e12, 1e12, 1e12, -1e12, 1e12, 1e12]
-        best_val_scores[test_dataset_name] = [-1e12, 1e12, 1e12, -1e12, 1e12, 1e12]
-        best_val_scores_avg = [-1e12, 1e12, 1e12, -1e12, 1e12, 1e12]
-
-    with tqdm(range(0, epochs), leave=True, disable=params["silent_mode"]) as tnr:
+    log_dict = {}
+
+    # the gradients of accumulation_steps samples are averaged for each optimizer step. batchiter, the logstep,
+    # the maxstep and the lr schedule count optimizer steps.
+    accumulation_steps = params["accumulation_steps"]
+    accumulated, accumulated_loss = 0, 0.
+    optimizer.zero_grad()
+
+    # best scores per checkpoint path, e.g. '/tza/VAL/', '/AVG/VAL/', '/tza/ALL/'
+    best_scores = {}
+    checkpoint_writer = CheckpointWriter('checkpoints/store/{}'.format(run_name), keep_last=params["checkpoint_retention"])
+
+    # Resume from the training state of the last log step
+    resume_path = 'checkpoints/Resume/{}.pth'.format(run_name)
+    resume_rng_states = None
+    if params["resume"] and os.path.exists(resume_path):
+        logging.info(f'Resuming from {resume_path}')
+        state = load_training_state(resume_path, map_location=device)
+        mynet.load_state_dict(state['model_state_dict'])
+        load_scalings(mynet, state)
+        optimizer.load_state_dict(state['optimizer_state_dict'])
+        scheduler.load_state_dict(state['scheduler_state_dict'])
+        if scaler is not None:
+            scaler.load_state_dict(state['scaler_state_dict'])
+        train_sampler.load_state_dict(state['sampler_state_dict'])
+        start_epoch, batchiter, itercounter = state['epoch'], state['batchiter'], state['itercounter']
+        best_scores.update(state['best_scores'])
+        log_dict = state['log_dict']
+        # restored when the first epoch iterator has been created, which draws from the torch generator
+        resume_rng_states = state['rng_states']
+
+    def log_validation(model, optimizerstate, epoch, batchiter, log_dict, checkpoints):
+        # checkpoints with the weights the validation was computed with, then log
+        with phase("checkpoint"):
+            log_dict = select_checkpoints(model, optimizerstate, epoch, log_dict, checkpoints, best_scores, checkpoint_writer=checkpoint_writer,
+                run_name=run_name)
+        log_dict['batchiter'] = batchiter
+        log_dict['epoch'] = epoch
+        val_prefix = test_dataset_names[-1] + ('/validation/' if len(checkpoints)>0 else '/validation_subset/')
+        if val_prefix+'r2' in log_dict.keys():
+            tnr.set_postfix(R2=log_dict[val_prefix+'r2'], zMAEc=log_dict[val_prefix+'mae'])
+        log(log_dict)
+        return log_dict
+
+    # operators of a few training steps for a Chrome trace, see pix_transform.profiling
+    ops = None
+    if params["profile_ops"]>0 and main_process:
+        ops = op_profiler('profiles/{}.ops.trace.json'.format(run_name), active=params["profile_ops"])
+        ops.start()
+
+    with tqdm(range(start_epoch, epochs), leave=True, disable=params["silent_mode"]) as tnr:
         for epoch in tnr:
-            for sample in tqdm(train_loader, disable=params["silent_mode"]):
-                optimizer.zero_grad()
+            epoch_loader = iter(train_loader)
+            if resume_rng_states is not None:
+                set_rng_states(resume_rng_states)
+                resume_rng_states = None
+            for sample in tqdm(profiled_iter(epoch_loader, "data"), total=len(train_loader), disable=params["silent_mode"] or not main_process):
                 
-                # Feed forward the network
-                y_pred_list = mynet.forward_one_or_more(sample)
-                
-                #check if any valid values are there, else skip   
-                if y_pred_list is None:
-                    continue
+                with phase("forward"):
+                    # Feed forward the network, optionally on a bounded random subset of the pixels
+                    if params["pixel_budget"] is not None:
+                        y_pred_list = mynet.forward_subsampled(sample, params["pixel_budget"], stratified=params["stratified_pixels"],
+                            merged=params["merged_forward"])
+                    else:
+                        y_pred_list = mynet.forward_one_or_more(sample, merged=params["merged_forward"])
+                    
+                    #check if any valid values are there, else skip   
+                    if y_pred_list is None:
+                        continue
 
-                # Sum over the census data per patch 
-                y_pred = torch.stack([pred*samp[4] for pred,samp in zip(y_pred_list, sample)]).sum(0)
-                y_gt = torch.tensor([samp[1]*samp[4] for samp in sample]).sum().unsqueeze(0) 
+                    # Sum over the census data per patch, the loss stays on the device until the next log
+                    y_pred, y_gt = weighted_sample_sums(y_pred_list, sample)
+                    loss = myloss(y_pred, y_gt)
 
                 # Backwards
-                loss = myloss(y_pred, y_gt)
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(mynet.parameters(), params["grad_clip"])
-                optimizer.step()
-                scheduler.step()
+                with phase("backward"):
+                    # the importance weight corrects the gradient for the loss-aware sampling, the logged loss is unweighted
+                    weighted_loss = loss
+                    if importance_sampler is not None:
+                        weighted_loss = loss*importance_sampler.update(loss.detach())
+                    if scaler is not None:
+                        scaler.scale(weighted_loss/accumulation_steps).backward()
+                    else:
+                        (weighted_loss/accumulation_steps).backward()
+                accumulated += 1
+                accumulated_loss += loss.detach()
+                if accumulated<accumulation_steps:
+                    continue
 
-                # train logging
+                with phase("optimizer"):
+                    if world_size>1:
+                        all_reduce_gradients([param for group in optimizer.param_groups for param in group["params"]])
+                    if scaler is not None:
+                        scaler.unscale_(optimizer)
+                        torch.nn.utils.clip_grad_norm_(mynet.parameters(), params["grad_clip"])
+                        scaler.step(optimizer)
+                        scaler.update()
+                    else:
+                        torch.nn.utils.clip_grad_norm_(mynet.parameters(), params["grad_clip"])
+                        optimizer.step()
+                    optimizer.zero_grad()
+                    scheduler.step()
+                if ops is not None:
+                    ops.step()
+                loss = accumulated_loss/accumulated
+                accumulated, accumulated_loss = 0, 0.
+
+                # train logging, the only host synchronization of the training step
                 train_log_dict = {}
-                if batchiter % 50 == 0: 
+                if batchiter % 50 == 0 and main_process: 
+                    y_pred, y_gt, loss = y_pred.detach().cpu(), y_gt.cpu(), loss.cpu()
                     if len(y_pred)==2:
                         train_log_dict["train/y_pred_"] = y_pred[0]
                         train_log_dict["train/y_var"] = y_pred[1]
@@ -173,7 +292,7 @@ def PixAdminTransform(
                     train_log_dict['epoch'] = epoch 
                     train_log_dict['batchiter'] = batchiter
                     train_log_dict['current_lr'] = optimizer.param_groups[0]["lr"]
-                    wandb.log(train_log_dict)
+                    log(train_log_dict)
 
                 itercounter += 1
                 batchiter += 1
@@ -181,134 +300,130 @@ def PixAdminTransform(
                 if mynet.output_scaling:
                     mynet.normalize_out_scales()
 
-                torch.cuda.empty_cache()
+                release_cached_memory(params["memory_policy"])
+
+                if validator is not None:
+                    for result in validator.collect():
+                        log_dict = log_validation(*result)
 
                 if itercounter>=( params['logstep'] ):
                     itercounter = 0
-
-                    with torch.no_grad():
+                    # every full_val_every-th log step (and the last one) validates fully, the others on the subset
+                    full = (batchiter//params['logstep']) % params["full_val_every"]==0 or batchiter>=params["maxstep"]
+
+                    # only on rank 0, the other ranks wait for it in the next all-reduce
+                    if validator is not None:
+                        # evaluated in the background on a snapshot, logged when the result arrives
+                        with phase("validation"):
+                            validator.submit(mynet, optimizer, epoch, batchiter, full=full)
+                    elif main_process:
                         # Validate and Test the model and save model
-                        log_dict = {}
-
-                        # Validation
-                        if params["validation_split"]>0. or (params["validation_fold"] is not None):
-                            this_val_scores_avg, n = np.zeros((3,)), 0
-                            for name in test_dataset_names:
-                                logging.info(f'Validating dataset of {name}')
-                                agg_preds,val_census = [],[]
-                                agg_preds_arr = torch.zeros((dataset.max_tregid[name]+1,))
-
-                                for idx in tqdm(range(len(dataset.Ys_val[name])), disable=params["silent_mode"]):
-                                    X, Y, Mask, name, census_id = dataset.get_single_validation_item(idx, name) 
-                                    pred = mynet.forward(X, Mask, name=name, forward_only=True).detach().cpu().numpy()
-                                    agg_preds.append(pred)
-                                    val_census.append(Y.cpu().numpy())
-                                    if isinstance(pred, np.ndarray) and pred.shape.__len__()==1:
-                                        pred = pred[0] 
-                                    agg_preds_arr[census_id.item()] = pred.item()
-                                    torch.cuda.empty_cache()
-
-                                metrics = compute_performance_metrics_arrays(np.asarray(agg_preds), np.asarray(val_census)) 
-                                # best_val_scores[name] = checkpoint_model(mynet, optimizer.state_dict(), epoch, metrics, '/'+name+'/VAL/', best_val_scores[name])
-                                if name in train_dataset_name:
-                                    this_val_scores_avg += [metrics["r2"], metrics["mae"],  metrics["mape"]]
-                                    n += 1
-
-                                for key in metrics.keys():
-                                    log_dict[name + '/validation/' + key ] = metrics[key]
-                                
-                                # Disaggregation per coarse val census
-                                agg_preds_arr_adj, this_metrics_dis = disag_wo_map(agg_preds_arr, dataset.memory_disag_val[name])
-                                for key,value in this_metrics_dis.items():
-                                    log_dict[name + "/validation/adjusted/coarse/"+key] = value  
-                                    
-                                adj_metrics = compute_performance_metrics_arrays(agg_preds_arr_adj[dataset.tregid_val[name]].numpy(), np.asarray(val_census))  
-                                for key,value in adj_metrics.items():
-                                    metrics["adjusted/"+key] = value
-                                    log_dict[name + "/validation/adjusted/coarse/"+key] = value  
-                                
-                                best_val_scores[name] = checkpoint_model(mynet, optimizer.state_dict(), epoch, metrics, '/'+name+'/VAL/', best_val_scores[name])
-
-                                # "fake" new dissagregation data and reuse the function
-                                # Do the disagregation on country level
-                                tts = torch.zeros(dataset.memory_disag_val[name][0].shape, dtype=int)
-                                tts[torch.where(dataset.memory_disag_val[name][0])] = 1
-                                disaggregation_data_coarsest_val = [tts, {1: sum(list(dataset.memory_disag_val[name][1].values()))}, dataset.memory_disag_val[name][2] ]
-                            
-                                agg_preds_arr_country_adj, this_metrics_cl = disag_wo_map(agg_preds_arr, disaggregation_data_coarsest_val)
-                                for key,value in this_metrics_cl.items():
-                                    log_dict[name + "/validation/adjusted/country_like/"+key] = value  
-                                # agg_preds_arr_adj[dataset.tregid_val[name]]
-                                this_metrics_cl = compute_performance_metrics_arrays(agg_preds_arr_country_adj[dataset.tregid_val[name]].numpy(), np.asarray(val_census))  
-                                for key,value in this_metrics_cl.items():
-                                    log_dict[name + "/validation/adjusted/country_like/"+key] = value  
-                                
-                                torch.cuda.empty_cache()
-
-                            avg_metrics = {}
-                            avg_metrics["r2"], avg_metrics["mae"],  avg_metrics["mape"] = this_val_scores_avg/n
-                            best_val_scores_avg = checkpoint_model(mynet, optimizer.state_dict(), epoch, avg_metrics, '/AVG/VAL/', best_val_scores_avg)
-                            for key,value in avg_metrics.items():
-                                log_dict["validation/average/"+key] = value  
-
-                        # Evaluation Model: Evaluates the training and validation regions at the same time!
-                        if params["full_ceval"]:
-                            for name in test_dataset_names: 
-                                logging.info(f'Testing dataset of {name}')
-                                val_census, val_regions, val_map, _, val_valid_ids, val_map_valid_ids, _, val_valid_data_mask, _, _, _ = dataset.memory_vars[name]
-                                val_features = dataset.features[name]
-                                
-                                res, this_log_dict = eval_my_model(
-                                    mynet, val_features, val_valid_data_mask, val_regions,
-                                    val_map_valid_ids, np.unique(val_regions).__len__(), val_valid_ids, val_census,
-                                    dataset=dataset,
-                                    disaggregation_data=dataset.memory_disag[name],
-                                    dataset_name=name, return_scale=True, silent_mode=params["silent_mode"]
-                                )
-                                # Model checkpointing and update best scores
-                                best_scores[name] = checkpoint_model(mynet, optimizer.state_dict(), epoch, this_log_dict,  '/'+name+'/ALL/', best_scores[test_dataset_name])
-                                for key in this_log_dict.keys():
-                                    log_dict[name+'/'+key] = this_log_dict[key]
-                                torch.cuda.empty_cache()
-
-                    #log scales
-                    log_dict = log_scales(mynet, list(datalocations.keys()), dataset, log_dict)
-
-                    # log_dict['train/loss'] = loss 
-                    log_dict['batchiter'] = batchiter
-                    log_dict['epoch'] = epoch
-
-                    # if val_fine_map is not None:
-                    tnr.set_postfix(R2=log_dict[test_dataset_names[-1]+'/validation/r2'],
-                                    zMAEc=log_dict[test_dataset_names[-1]+'/validation/mae'])
-                    wandb.log(log_dict)
+                        with torch.no_grad(), phase("validation"):
+                            log_dict, checkpoints = validate_model(mynet, dataset, train_dataset_name, test_dataset_names, params, list(datalocations.keys()),
+                                full=full)
+                        log_dict = log_validation(mynet, optimizer.state_dict(), epoch, batchiter, log_dict, checkpoints)
                         
                     mynet.train() 
-                    torch.cuda.empty_cache()
+                    release_cached_memory(params["memory_policy"], "logstep")
+
+                    # complete training state, pending asynchronous validations are not repeated after a resume
+                    if main_process:
+                        with phase("checkpoint"):
+                            resume_dict = checkpoint_state(mynet, optimizer.state_dict(), epoch, log_dict)
+                            resume_dict.update({'scheduler_state_dict': scheduler.state_dict(),
+                                'scaler_state_dict': scaler.state_dict() if scaler is not None else None,
+                                'batchiter': batchiter, 'itercounter': itercounter, 'best_scores': best_scores,
+                                'sampler_state_dict': train_sampler.state_dict(), 'rng_states': get_rng_states()})
+                            checkpoint_writer.write(resume_dict, [resume_path])
 
                     if batchiter>=params["maxstep"]:
                         maxstep_reached = True
                         break
+
+                yield
             else:
                 # Continue if the inner loop was not broken.
                 continue
             break
 
-    # compute final prediction, un-normalize, and back to numpy
-    with torch.no_grad():
+    if ops is not None:
+        ops.stop()
+    if validator is not None:
+        for result in validator.close():
+            log_dict = log_validation(*result)
+    with phase("checkpoint"):
+        checkpoint_writer.close()
+
+    with torch.no_grad(), phase("checkpoint"):
         mynet.eval()
         
-        Path('checkpoints/{}'.format('Final')).mkdir(parents=True, exist_ok=True) 
+        if main_process:
+            Path('checkpoints/{}'.format('Final')).mkdir(parents=True, exist_ok=True) 
+
+            saved_dict = {'model_state_dict': mynet.state_dict(), 'optimizer_state_dict': optimizer.state_dict(), 'epoch': epoch, 'log_dict': log_dict}
+            if mynet.input_scaling:
+                saved_dict["input_scales_bias"] = [mynet.in_scale, mynet.in_bias]
+            if mynet.output_scaling:
+                saved_dict["output_scales_bias"] = [mynet.out_scale, mynet.out_bias] 
+
+            torch.save(saved_dict,
+                'checkpoints/{}{}.pth'.format('Final/Maxstepstate_', run_name) )
+        release_cached_memory(params["memory_policy"], "logstep")
+
+    return mynet, log_dict
+
+
+def interleave_training(trainers):
+    """
+    Runs the train_model generators step by step in turn until all are finished. The setup of all trainers runs first.
+    With several trainers, each has its own random generator states that are swapped in for its steps, so every
+    trainer draws the same random numbers as if it was trained alone. Returns the results (mynet, log_dict) in the
+    order of the trainers.
+    """
+    results = [None]*len(trainers)
+    rng_states = [None]*len(trainers)
+    running = list(range(len(trainers)))
+    while len(running)>0:
+        for k in list(running):
+            if len(trainers)>1 and rng_states[k] is not None:
+                set_rng_states(rng_states[k])
+            try:
+                next(trainers[k])
+            except StopIteration as stop:
+                results[k] = stop.value
+                running.remove(k)
+            if len(trainers)>1:
+                rng_states[k] = get_rng_states()
+    return results
 
-        saved_dict = {'model_state_dict': mynet.state_dict(), 'optimizer_state_dict': optimizer.state_dict(), 'epoch': epoch, 'log_dict': log_dict}
-        if mynet.input_scaling:
-            saved_dict["input_scales_bias"] = [mynet.in_scale, mynet.in_bias]
-        if mynet.output_scaling:
-            saved_dict["output_scales_bias"] = [mynet.out_scale, mynet.out_bias] 
 
-        torch.save(saved_dict,
-            'checkpoints/{}{}.pth'.format('Final/Maxstepstate_', wandb.run.name) )
-        torch.cuda.empty_cache()
+def PixAdminTransform(
+    datalocations,
+    train_dataset_name,
+    test_dataset_names,
+    params):
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    #### prepare Dataset #########################################################################
+    # unique_datasets = set(list(validation_data.keys()) + list(training_source.keys()))
+
+    #if params["admin_augment"]:
+    dataset = MultiPatchDataset(datalocations, train_dataset_name, params["train_level"], params['memory_mode'], device, 
+        params["validation_split"], params["validation_fold"], params["weights"], params["custom_sampler_weights"], 
+        random_seed_folds=params["random_seed_folds"], build_pairs=params["admin_augment"], remove_feat_idxs=params["remove_feat_idxs"])
+    #else:
+    #    raise Exception("option not available")
+    #    dataset = PatchDataset(training_source, params['memory_mode'], device, params["validation_split"])
+
+    mynet, log_dict = interleave_training([train_model(dataset, datalocations, train_dataset_name, test_dataset_names, params, get_run_name())])[0]
+    if get_rank()!=0:
+        # the evaluation runs on rank 0
+        return {}, log_dict
+
+    # compute final prediction, un-normalize, and back to numpy
+    with torch.no_grad():
+        mynet.eval()
 
         # Validate and Test the model and save model
         log_dict = {}
@@ -321,13 +436,16 @@ def PixAdminTransform(
             logging.info(f'Testing dataset of {name}')
             val_census, val_regions, val_map, _, val_valid_ids, val_map_valid_ids, _, val_valid_data_mask, _, _, _ = dataset.memory_vars[name]
             val_features = dataset.features[name]
+            pixel_model = build_pixel_model(mynet, name, params, dataset, log_dict)
             
             res, this_log_dict = eval_my_model(
                 mynet, val_features, val_valid_data_mask, val_regions,
                 val_map_valid_ids, np.unique(val_regions).__len__(), val_valid_ids, val_census,
                 dataset=dataset,
                 disaggregation_data=dataset.memory_disag[name],
-                dataset_name=name, return_scale=True, silent_mode=params["silent_mode"], full_eval=True
+                dataset_name=name, return_scale=True, silent_mode=params["silent_mode"], full_eval=True,
+                sparse=params["sparse_inference"], pixel_model=pixel_model, mc_dropout_samples=params["mc_dropout_samples"],
+                inference_workers=params["inference_workers"], threads_per_worker=params["threads_per_worker"]
             )
 
             # Model log collection
@@ -337,6 +455,49 @@ def PixAdminTransform(
             for key in this_log_dict.keys():
                 log_dict[name+'/'+key] = this_log_dict[key]
                 
-        wandb.log(log_dict)
+        log_metrics(log_dict)
         
     return res_dict, log_dict 
+
+
+
+def TrainAllFolds_PixAdminTransform(
+    datalocations,
+    train_dataset_name,
+    test_dataset_names,
+    params):
+    """
+    Trains the models of the five validation folds in one process and evaluates them as -e5f (eval_generic_model).
+    The datasets of the folds share the features, the training steps of the folds are interleaved
+    (interleave_training). The folds are logged with the prefix 'fold<k>/' and named '<run name>_vfold<k>'.
+    The e5f_metric "final" evaluates the trained networks, the best_* metrics the best checkpoints of the folds.
+    """
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    Datasets, trainers, run_names = [], [], []
+    for k in range(5):
+        Datasets.append(MultiPatchDataset(datalocations, train_dataset_name, params["train_level"], params['memory_mode'], device, 
+            params["validation_split"], k, params["weights"], params["custom_sampler_weights"], 
+            random_seed_folds=params["random_seed_folds"], build_pairs=params["admin_augment"], remove_feat_idxs=params["remove_feat_idxs"],
+            shared_dataset=Datasets[0] if k>0 else None))
+        run_names.append('{}_vfold{}'.format(get_run_name(), k))
+        # one torch.profiler at a time, the operators are traced for the first fold
+        fold_params = dict(params, validation_fold=k, profile_ops=params["profile_ops"] if k==0 else 0)
+        trainers.append(train_model(Datasets[k], datalocations, train_dataset_name, test_dataset_names, fold_params,
+            run_names[k], log_prefix='fold{}/'.format(k)))
+
+    results = interleave_training(trainers)
+    if get_rank()!=0:
+        return {}, {}
+
+    Mynets = []
+    for k, (mynet, _) in enumerate(results):
+        if params["e5f_metric"]!="final":
+            checkpoint = torch.load(e5f_checkpoint_path(params["e5f_metric"], test_dataset_names, run_names[k]), map_location=device)
+            mynet.load_state_dict(checkpoint['model_state_dict'])
+            load_scalings(mynet, checkpoint)
+        Mynets.append(mynet.eval())
+
+    memory_vars = {name: Datasets[0].memory_vars[name] for name in test_dataset_names}
+    return eval_generic_model(datalocations, train_dataset_name, test_dataset_names, params, Mynets, Datasets, memory_vars)
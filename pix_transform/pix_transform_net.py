@@ -1,9 +1,13 @@
+import contextlib
+import copy
 import numpy as np
 import torch.nn as nn
 import torch
 from torch.nn.modules.container import Sequential
 from tqdm import tqdm
-from utils import plot_2dmatrix
+from utils import plot_2dmatrix, subsample_pixels
+from pix_transform.export import fold_input_scale, fold_output_scale
+from pix_transform.profiling import phase
 
 class PixTransformNet(nn.Module):
 
@@ -102,7 +106,8 @@ class PixScaleNet(nn.Module):
 
     def __init__(self, channels_in=5, kernel_size=1, weights_regularizer=0.001,
         device="cuda" if torch.cuda.is_available() else "cpu", loss=None, dropout=0.,
-        exp_max_clamp=20, pred_var = True, input_scaling=False, output_scaling=False, datanames=None, small_net=False, pop_target=False):
+        exp_max_clamp=20, pred_var = True, input_scaling=False, output_scaling=False, datanames=None, small_net=False, pop_target=False,
+        precision="fp32"):
         super(PixScaleNet, self).__init__()
 
         self.pop_target = pop_target
@@ -114,7 +119,14 @@ class PixScaleNet(nn.Module):
         self.pred_var = pred_var
         self.input_scaling = input_scaling
         self.output_scaling = output_scaling
+        # the output scaling sets the predictions of pixels without buildings to zero, also after specialize()
+        self.zero_no_buildings = output_scaling
+        self.mean_in_scale, self.mean_out_scale = None, None
+        self.specialized_nets = {}
         self.datanames = datanames
+        if precision not in precision_dtypes.keys():
+            raise Exception("unknown precision {}".format(precision))
+        self.autocast_dtype = precision_dtypes[precision]
 
         self.exptransform_outputs = loss in ['LogoutputL1', 'LogoutputL2']
         self.bayesian = loss in ['gaussNLL', 'laplaceNLL']
@@ -189,7 +201,16 @@ class PixScaleNet(nn.Module):
         self.params_with_regularizer += [{'params':self.occrate_var_layer.parameters(),'weight_decay':weights_regularizer}]
 
 
-    def forward(self, inputs, mask=None, name=None, predict_map=False, forward_only=False):
+    def forward(self, inputs, mask=None, name=None, predict_map=False, forward_only=False, keep_on_device=False, pixel_weights=None,
+        segments=None):
+        """
+        keep_on_device: the sums over the mask stay on the device of the network (no host synchronization), as needed
+            for the loss in training.
+        pixel_weights: weights of the pixels in the sum over the mask, in the order of the masked pixels (see
+            forward_subsampled)
+        segments: region of each pixel of inputs of shape (1,C,N,1), for several regions in one pass (see
+            forward_segments). name is then the list of the countries of the regions, the sums are returned per region.
+        """
 
         if len(inputs.shape)==3:
             inputs = inputs.unsqueeze(0)
@@ -199,28 +220,28 @@ class PixScaleNet(nn.Module):
 
         # Check if the image is too large for singe forward pass
         PS = 2500 if forward_only else 1000 
-        if torch.tensor(inputs.shape[-2:]).prod()>PS**2:
-            return self.forward_batchwise(inputs, mask, name, predict_map=predict_map, forward_only=forward_only)
+        if segments is None and inputs.shape[-2]*inputs.shape[-1]>PS**2:
+            return self.forward_batchwise(inputs, mask, name, predict_map=predict_map, forward_only=forward_only, keep_on_device=keep_on_device)
         
         if (mask is not None) and (not predict_map):
-            mask = mask.to(self.device)
+            # the pixels are selected before they are moved to the device
+            mask = mask.to(inputs.device) if torch.is_tensor(inputs) else mask.cpu()
             if not self.convnet:
                 inputs = inputs[:,:,mask[0]].unsqueeze(3)
                 mask = mask[mask].unsqueeze(0).unsqueeze(2)
             # inputs = inputs[:,:,mask[0]].unsqueeze(3)
             # mask = mask[mask].unsqueeze(0).unsqueeze(2)
             mask = mask.cpu()
-        
-        # check inputs
-        inputs[inputs>1e32] = 0
 
-        # Apply network
-        if isinstance(inputs, np.ndarray):
-            inputs = torch.from_numpy(inputs).to(self.device)
-        else:
-            inputs = inputs.to(self.device)
+        # Apply network, the inputs are sanitized at dataset preparation (utils.sanitize_hdf5_file)
+        with phase("h2d"):
+            if isinstance(inputs, np.ndarray):
+                inputs = torch.from_numpy(inputs).to(self.device)
+            else:
+                inputs = inputs.to(self.device)
 
         buildings = inputs[:,0:1,:,:]
+        no_buildings = buildings[0,0]==0
         
         if self.pop_target:
             data = inputs
@@ -228,9 +249,12 @@ class PixScaleNet(nn.Module):
             data = inputs[:,1:,:,:]
 
         if self.input_scaling:
-            data = self.perform_scale_inputs(data, name)
+            data = self.perform_scale_inputs(data, name, segments)
 
+        with autocast(self.device, self.autocast_dtype):
             feats = self.occratenet(data)
+        # the heads, the scalings and the sums over the regions stay in float32
+        feats = feats.float()
         
         if self.pop_target:
             pop_est = self.occrate_layer(feats)
@@ -238,11 +262,12 @@ class PixScaleNet(nn.Module):
                 raise Exception("not implemented")
             else:
                 if self.output_scaling:
-                    pop_est = self.perform_scale_output(pop_est, name)
-                    pop_est[:,:,buildings[0,0]==0] *= 0.
+                    pop_est = self.perform_scale_output(pop_est, name, segments)
+                if self.zero_no_buildings:
+                    pop_est[:,:,no_buildings] *= 0.
                 
                 occrate = pop_est / buildings
-                occrate[:,:,buildings[0,0]==0] *= 0.
+                occrate[:,:,no_buildings] *= 0.
         else:
             occrate = self.occrate_layer(feats)
             if self.bayesian:
@@ -253,8 +278,9 @@ class PixScaleNet(nn.Module):
 
                 occrate = torch.cat([occrate, var], 1)
                 if self.output_scaling:
-                    occrate = self.perform_scale_output(occrate, name)
-                    occrate[:,:,buildings[0,0]==0] *= 0.
+                    occrate = self.perform_scale_output(occrate, name, segments)
+                if self.zero_no_buildings:
+                    occrate[:,:,no_buildings] *= 0.
                     
                 pop_est = torch.mul(buildings, occrate[:,0])
 
@@ -262,22 +288,31 @@ class PixScaleNet(nn.Module):
                 pop_est = torch.cat([pop_est,  torch.mul(torch.square(buildings), occrate[:,1])], 1)
             else:
                 if self.output_scaling:
-                    occrate = self.perform_scale_output(occrate, name)
+                    occrate = self.perform_scale_output(occrate, name, segments)
                     #occrate[:,:,buildings[0,0]==0] *= 0.
                 pop_est = torch.mul(buildings, occrate)
-        data = data.cpu()
 
         # backtransform if necessary before(!) summation
         if self.exptransform_outputs:
             #TODO: change this part when using a new loss function
             pop_est = pop_est.exp() 
         
+        if segments is not None:
+            return self.segment_sums(pop_est, segments, len(name), pixel_weights)
+
         # Check if masking should be applied
         if mask is not None: 
-            if self.bayesian:
-                    return pop_est[0,:,mask[0]].sum(1).cpu()
+            if pixel_weights is not None:
+                pixel_weights = pixel_weights.to(pop_est.device)
+                if self.bayesian:
+                    pop_sum = (pop_est[0,:,mask[0]]*pixel_weights).sum(1)
+                else:
+                    pop_sum = (pop_est[0,mask]*pixel_weights).sum()
+            elif self.bayesian:
+                    pop_sum = pop_est[0,:,mask[0]].sum(1)
             else:
-                    return pop_est[0,mask].sum().cpu()
+                    pop_sum = pop_est[0,mask].sum()
+            return pop_sum if keep_on_device else pop_sum.cpu()
             #return pop_est.sum((0,2,3)).cpu()
         else:
             # check if the output should be the map or the sum
@@ -287,15 +322,107 @@ class PixScaleNet(nn.Module):
                 return pop_est.cpu(), occrate.cpu()
 
 
-    def perform_scale_inputs(self, data, name):
+    def train(self, mode=True):
+        # reset the cached mean scales and specialized copies, the weights change in training or are reloaded before eval()
+        self.mean_in_scale, self.mean_out_scale = None, None
+        self.specialized_nets = {}
+        return super(PixScaleNet, self).train(mode)
+
+
+    def _apply(self, fn, *args, **kwargs):
+        # the specialized copies stay on their device, they are rebuilt after .to()/.cuda()
+        self.specialized_nets = {}
+        return super(PixScaleNet, self)._apply(fn, *args, **kwargs)
+
+
+    def specialize(self, name=None):
+        """
+        Copy of the network for the country "name" without scaling overhead: the input scaling is folded into the
+        first convolution and the output scale into the last layers (see pix_transform.export). Countries without own
+        scalings get the mean scalings. The input scaling can only be folded into a first layer with 1x1 kernels.
+        """
+        # the copy is only for inference: the scalings and the parameter groups of the optimizer are not copied
+        skip = ["params_with_regularizer", "in_scale", "in_bias", "out_scale", "out_bias", "mean_in_scale", "mean_in_bias",
+            "mean_out_scale", "mean_out_bias", "specialized_nets"]
+        net = copy.deepcopy(self, memo={id(getattr(self, key)): None for key in skip if getattr(self, key, None) is not None})
+        with torch.no_grad():
+            if self.input_scaling:
+                first = [layer for layer in net.occratenet if isinstance(layer, nn.Conv2d)][0]
+                if first.kernel_size!=(1,1):
+                    raise Exception("the input scaling can only be folded into a first layer with 1x1 kernels")
+                if name in self.in_scale.keys():
+                    scale, bias = self.in_scale[name], self.in_bias[name]
+                else:
+                    self.calculate_mean_input_scale()
+                    scale, bias = self.mean_in_scale, self.mean_in_bias
+                fold_input_scale(first, scale, bias)
+
+            if self.output_scaling:
+                if name in self.out_scale.keys():
+                    scale = self.out_scale[name].item()
+                else:
+                    self.calculate_mean_output_scale()
+                    scale = self.mean_out_scale.item()
+                fold_output_scale(net.occrate_layer, scale)
+                if self.bayesian:
+                    fold_output_scale(net.occrate_var_layer, scale**2, exp_output=not self.pred_var)
+
+        net.input_scaling, net.output_scaling = False, False
+        return net
+
+
+    def specialized(self, name=None):
+        """
+        specialize(name), in eval mode cached per country until the next call of train()/eval() or change of device.
+        """
+        if self.training:
+            return self.specialize(name)
+        if name not in self.specialized_nets.keys():
+            self.specialized_nets[name] = self.specialize(name)
+        return self.specialized_nets[name]
+
+
+    def can_specialize(self, name=None):
+        """
+        Whether specialize(name) can fold the scalings: the input scaling needs a first layer with 1x1 kernels and the
+        output scale has to be positive (the scaling of the forward clamps the predictions of other scales to zero).
+        Without name, for the scales of all countries and the mean scale.
+        """
+        first = [layer for layer in self.occratenet if isinstance(layer, nn.Conv2d)][0]
+        if self.input_scaling and first.kernel_size!=(1,1):
+            return False
+        if self.output_scaling:
+            names = [name] if name is not None else list(self.out_scale.keys()) + [None]
+            return all([self.output_scale(this_name).item()>0 for this_name in names])
+        return True
+
+
+    def perform_scale_inputs(self, data, name, segments=None):
+        if segments is not None and len(set(name))==1:
+            # all regions in the same country
+            name, segments = name[0], None
+        if segments is not None:
+            # per pixel scalings of the countries of the regions, data of shape (1,C,N,1)
+            scale_bias = [self.input_scale_bias(this_name) for this_name in name]
+            segments = segments.to(data.device)
+            scale = torch.cat([scale for scale,_ in scale_bias], 2)[:,:,segments]
+            bias = torch.cat([bias for _,bias in scale_bias], 2)[:,:,segments]
+            return (data - bias) / scale
+        scale, bias = self.input_scale_bias(name)
+        return (data - bias) / scale
+
+
+    def input_scale_bias(self, name):
         if name not in list(self.in_scale.keys()):
             self.calculate_mean_input_scale()
-            return (data - self.mean_in_bias) / self.mean_in_scale #+ self.mean_in_bias
-        else:
-            return (data - self.in_bias[name]) /self.in_scale[name]
+            return self.mean_in_scale, self.mean_in_bias
+        return self.in_scale[name], self.in_bias[name]
 
 
     def calculate_mean_input_scale(self):
+        # the scales do not change in eval mode, the mean is cached until the next call of train()/eval()
+        if (not self.training) and self.mean_in_scale is not None:
+            return
         self.mean_in_scale = 0
         self.mean_in_bias = 0
         for name in list(self.in_scale.keys()):
@@ -305,34 +432,39 @@ class PixScaleNet(nn.Module):
         self.mean_in_bias = self.mean_in_bias/self.in_scale.keys().__len__()
 
 
-    def perform_scale_output(self, preds, name):
+    def perform_scale_output(self, preds, name, segments=None):
         """
         Inputs:
             - preds : tensor of shape (1,d,h,w). Where d is 1 for the non bayesian case and 2 (pred & var) for the bayesian case.
             - name: the name of the country the patch is located.
+            - segments: region of each pixel of preds of shape (1,d,N,1), name is then the list of the countries of the regions
         Output:
             - Scaled and clamped predictions
         """
+        if segments is not None and len(set(name))==1:
+            name, segments = name[0], None
+        if segments is not None:
+            scale = torch.cat([self.output_scale(this_name).view(1,1,1,1) for this_name in name], 2)[:,:,segments.to(preds.device)]
+        else:
+            scale = self.output_scale(name)
+
         if self.bayesian:
-            if name not in list(self.out_scale.keys()):
-                self.calculate_mean_output_scale()  
-                preds_0 = preds[:,0:1]*self.mean_out_scale #+ self.mean_out_bias
-                preds_1 = preds[:,1:2]*torch.square(self.mean_out_scale)
-                preds = torch.cat([preds_0,preds_1], 1)  
-            else:
-                preds_0 = preds[:,0:1]*self.out_scale[name] #+ self.out_bias[name]
-                preds_1 = preds[:,1:2]*torch.square(self.out_scale[name])
-                preds = torch.cat([preds_0,preds_1], 1) 
+            preds_0 = preds[:,0:1]*scale #+ bias
+            preds_1 = preds[:,1:2]*torch.square(scale)
+            preds = torch.cat([preds_0,preds_1], 1) 
         else: 
-            if name not in list(self.out_scale.keys()):
-                self.calculate_mean_output_scale()
-                preds = preds*self.mean_out_scale #+ self.mean_out_bias
-            else:
-                preds = preds*self.out_scale[name] #+ self.out_bias[name]
+            preds = preds*scale #+ bias
                         
         # Ensure that there are no negative occ-rates and variances
         return preds.clamp(min=0)
 
+
+    def output_scale(self, name):
+        if name not in list(self.out_scale.keys()):
+            self.calculate_mean_output_scale()
+            return self.mean_out_scale
+        return self.out_scale[name]
+
     def normalize_out_scales(self):
         with torch.no_grad():
             average_scale = torch.sum(torch.cat(list(self.out_scale.values()))) / list(self.out_scale.keys()).__len__()
@@ -341,6 +473,8 @@ class PixScaleNet(nn.Module):
                 self.out_scale[key] /= average_scale
             
     def calculate_mean_output_scale(self):
+        if (not self.training) and self.mean_out_scale is not None:
+            return
         self.mean_out_scale = 0
         self.mean_out_bias = 0
         for name in list(self.out_scale.keys()):
@@ -350,7 +484,12 @@ class PixScaleNet(nn.Module):
         self.mean_out_bias = self.mean_out_bias/self.out_scale.keys().__len__()
 
 
-    def forward_batchwise(self, inputs, mask=None, name=None, predict_map=False, return_scale=False, forward_only=False): 
+    def forward_batchwise(self, inputs, mask=None, name=None, predict_map=False, return_scale=False, forward_only=False, keep_on_device=False): 
+
+        if (self.input_scaling or self.output_scaling) and (not self.training) and self.can_specialize(name):
+            # fold the country scalings into the weights once instead of scaling every patch
+            return self.specialized(name).forward_batchwise(inputs, mask, name, predict_map=predict_map, return_scale=return_scale,
+                forward_only=forward_only, keep_on_device=keep_on_device)
 
         #choose a responsible patch that does not exceed the GPU memory
         PS = 1800 if forward_only else 900
@@ -371,13 +510,14 @@ class PixScaleNet(nn.Module):
             for oi in range(0,ow,PS):
                 if (not predict_map) and (not self.convnet):
                     if mask is not None and mask[:,hi:hi+PS,oi:oi+PS].sum()>0:
-                        outvar += self( inputs[:,:,hi:hi+PS,oi:oi+PS][:,:,mask[0,hi:hi+PS,oi:oi+PS]].unsqueeze(3), name=name, forward_only=forward_only)
+                        outvar += self( inputs[:,:,hi:hi+PS,oi:oi+PS][:,:,mask[0,hi:hi+PS,oi:oi+PS]].unsqueeze(3), name=name, forward_only=forward_only,
+                            keep_on_device=keep_on_device)
                 elif (not predict_map) and self.convnet:
                     this_mask = mask[:,hi:hi+PS,oi:oi+PS]
                     if this_mask.sum()>0:
                         # out = self( inputs[:,:,hi:hi+PS,oi:oi+PS], mask=this_mask, predict_map=True, name=name)[0].cpu()
-                        out = self( inputs[:,:,hi:hi+PS,oi:oi+PS], mask=this_mask, predict_map=True, name=name)
-                        outvar += out.sum().cpu()
+                        out = self( inputs[:,:,hi:hi+PS,oi:oi+PS], mask=this_mask, predict_map=True, name=name, keep_on_device=keep_on_device)
+                        outvar += out.sum() if keep_on_device else out.sum().cpu()
                 else:
                     outvar[:,:,hi:hi+PS,oi:oi+PS], scale[:,:,hi:hi+PS,oi:oi+PS] = self( inputs[:,:,hi:hi+PS,oi:oi+PS], name=name, predict_map=True, forward_only=forward_only)
 
@@ -385,18 +525,647 @@ class PixScaleNet(nn.Module):
             return outvar
         else:
             return outvar, scale
+
+
+    def forward_sparse(self, inputs, mask=None, name=None, batch_size=2**18, rows_per_read=512):
+        """
+        Predicts the full map like forward_batchwise(predict_map=True), but only evaluates pixels with buildings (and
+        valid data if a mask is given). All other pixels predict a population of zero and are left at zero in the output.
+        The pixels are gathered over strips of rows, evaluated in batches of "batch_size" pixels with the PixScaleMLP and
+        scattered back into the map.
+        Inputs:
+            - inputs : array/tensor/hdf5 dataset of shape (1,C,h,w) or (C,h,w)
+            - mask : boolean mask of shape (h,w) of the pixels to evaluate, optional
+        Output:
+            - pop_est and occrate maps of shape (1,d,h,w), on the cpu
+        """
+        if self.convnet or self.pop_target or self.exptransform_outputs:
+            # zero buildings do not imply a zero prediction in these configurations
+            print("sparse inference not available for this configuration, using forward_batchwise")
+            return self.forward_batchwise(inputs, name=name, predict_map=True, forward_only=True)
+
+        net = self.specialized(name) if (self.input_scaling or self.output_scaling) and self.can_specialize(name) else self
+        mlp = net.as_linear().eval()
+        return predict_map_sparse(lambda pixels: mlp(pixels, name=name), inputs, self.out_dim, mask=mask,
+            batch_size=batch_size, rows_per_read=rows_per_read)
+
+
+    def forward_mc_dropout(self, inputs, mask=None, name=None, num_samples=32, samples_per_pass=8, batch_size=2**15, rows_per_read=512):
+        """
+        Monte Carlo dropout uncertainty of the full map: the dropouts stay active and num_samples stochastic predictions
+        are drawn per pixel with buildings, batched along a sample dimension (see predict_map_mc_dropout).
+        Inputs as for forward_sparse.
+        Output:
+            - mean and variance of the population estimates over the samples, maps of shape (1,d,h,w) on the cpu
+        """
+        if self.convnet or self.pop_target or self.exptransform_outputs:
+            raise Exception("Monte Carlo dropout maps are only available for 1x1 kernels without pop_target and exptransform")
+        if not any([isinstance(layer, nn.Dropout) and layer.p>0 for layer in self.occratenet]):
+            raise Exception("Monte Carlo dropout maps need a network trained with dropout")
+
+        # not specialized: the first dropout acts on the scaled inputs, which cannot be folded into the first layer
+        # the PixScaleMLP reuses the dropout modules, work on a copy to leave this network in eval mode
+        mlp = copy.deepcopy(self.as_linear()).eval()
+        for layer in mlp.occratenet:
+            if isinstance(layer, nn.Dropout):
+                layer.train()
+        return predict_map_mc_dropout(lambda pixels, n: mlp(pixels, name=name, num_samples=n)[0], inputs, self.out_dim,
+            num_samples=num_samples, samples_per_pass=samples_per_pass, mask=mask, batch_size=batch_size, rows_per_read=rows_per_read)
+
+
+    def as_linear(self):
+        """
+        Returns a PixScaleMLP with a copy of the weights of this network. Only available for 1x1 kernels.
+        """
+        return PixScaleMLP(self)
         
 
-    def forward_one_or_more(self, sample, mask=None):
+    def forward_one_or_more(self, sample, mask=None, merged=True):
+        """
+        Sums of the predictions over the regions of a training sample (a region, a pair or a triplet), on the device.
+        merged: the regions of pairs and triplets are evaluated in one forward pass (see forward_segments), for 1x1
+        kernels and up to the pixels of a single pass. Otherwise (and for convnets) one pass per region.
+        """
+        valid = [inp for inp in sample if inp[2].any()]
+        if merged and len(valid)>1 and not self.convnet:
+            regions = [(inp[0][0][:,inp[2][0]], inp[3][0]) for inp in valid]
+            if sum([pixels.shape[1] for pixels,_ in regions])<=1000**2:
+                return self.forward_segments(regions)
 
         summings = []
         valid_samples  = 0 
         for i, inp in enumerate(sample):
-            if inp[2].sum()>0:
+            if inp[2].any():
 
-                summings.append( self(inp[0], inp[2], inp[3][0]).cpu())
+                # the predictions stay on the device for the loss
+                summings.append( self(inp[0], inp[2], inp[3][0], keep_on_device=True))
                 valid_samples += 1
 
         if valid_samples==0:
             return None    
         return summings
+
+
+    def forward_segments(self, regions, pixel_weights=None):
+        """
+        Sums of the predictions over several regions in one forward pass: the pixels of the regions are concatenated
+        with the region of each pixel as segment id, the country scalings are applied per segment and the predictions
+        are summed per segment. Only for 1x1 kernels.
+        Inputs:
+            - regions: list of (pixels, name), pixels of shape (C,n) and the country of the region
+            - pixel_weights: None or list of the weights of the pixels of each region, in the sums
+        Output:
+            - list of the sums of the regions, on the device (as forward with keep_on_device)
+        """
+        names = [name for _,name in regions]
+        inputs = torch.cat([pixels for pixels,_ in regions], 1).unsqueeze(0).unsqueeze(3)
+        segments = torch.cat([torch.full((pixels.shape[1],), i, dtype=torch.long) for i,(pixels,_) in enumerate(regions)])
+        if pixel_weights is not None:
+            pixel_weights = torch.cat(pixel_weights)
+        return self(inputs, name=names, keep_on_device=True, pixel_weights=pixel_weights, segments=segments)
+
+
+    def segment_sums(self, pop_est, segments, num_segments, pixel_weights=None):
+        # sums of pop_est of shape (1,d,N,1) per segment, as the sums over the mask of one region in forward
+        values = pop_est[0,:,:,0]
+        if pixel_weights is not None:
+            values = values*pixel_weights.to(values.device)
+        sums = torch.zeros((values.shape[0], num_segments), dtype=values.dtype, device=values.device)
+        sums = sums.index_add(1, segments.to(values.device), values)
+        return [sums[:,i] if self.bayesian else sums[0,i] for i in range(num_segments)]
+
+
+    def forward_subsampled(self, sample, pixel_budget, stratified=False, merged=True):
+        """
+        As forward_one_or_more, but the sums of the regions are estimated from random subsets of their pixels, weighted
+        with the inverse sampling rates (unbiased, see utils.subsample_pixels). At most about pixel_budget pixels are
+        evaluated per sample, split over its regions proportional to their sizes. Regions within the budget are summed
+        exactly. Pixels without buildings are left out where they predict zero (as in forward_sparse).
+        Only for 1x1 kernels.
+        """
+        if self.convnet:
+            raise Exception("the pixel subsampling needs 1x1 kernels, the convolutions need all pixels of a region")
+        buildings_only = not (self.pop_target or self.exptransform_outputs)
+
+        regions = []
+        for inp in sample:
+            if inp[2].any():
+                pixels = inp[0][0][:,inp[2][0]]
+                if buildings_only and (pixels[0]>0).any():
+                    pixels = pixels[:,pixels[0]>0]
+                regions.append((pixels, inp[3][0]))
+        if len(regions)==0:
+            return None
+
+        total = sum([pixels.shape[1] for pixels,_ in regions])
+        subsets, subset_weights = [], []
+        for pixels, name in regions:
+            num_pixels = max(1, int(pixel_budget*pixels.shape[1]/total))
+            idxs, weights = subsample_pixels(pixels[0], num_pixels, stratified=stratified)
+            subsets.append((pixels[:,idxs], name))
+            subset_weights.append(weights)
+        if merged and len(subsets)>1:
+            return self.forward_segments(subsets, pixel_weights=subset_weights)
+
+        summings = []
+        for (pixels, name), weights in zip(subsets, subset_weights):
+            inputs = pixels.unsqueeze(0).unsqueeze(3)
+            mask = torch.ones((1,pixels.shape[1],1), dtype=torch.bool)
+            summings.append( self(inputs, mask, name, keep_on_device=True, pixel_weights=weights))
+        return summings
+
+
+
+precision_dtypes = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast(device, dtype):
+    """
+    Autocast context for "dtype" on the device type of "device". No-op for dtype None (float32).
+    """
+    if dtype is None:
+        return contextlib.nullcontext()
+    if not hasattr(torch, "autocast"):
+        raise Exception("reduced precision needs torch>=1.10")
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+
+def grad_scaler(device, dtype):
+    """
+    Loss scaler for fp16 training. None for float32 and bfloat16, which has the exponent range of float32.
+    """
+    if dtype!=torch.float16:
+        return None
+    device_type = torch.device(device).type
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device_type)
+    if device_type=="cuda":
+        return torch.cuda.amp.GradScaler()
+    raise Exception("fp16 training on the cpu needs torch>=2.3, use bf16")
+
+
+def check_precision(precision, device):
+    """
+    Raises if the installed torch cannot train and predict with "precision" on the device type of "device": autocast
+    needs torch>=1.10, the loss scaling of fp16 on the cpu torch>=2.3 (see autocast and grad_scaler).
+    """
+    if precision not in precision_dtypes.keys():
+        raise Exception("unknown precision {}".format(precision))
+    if precision=="fp32":
+        return
+    if not hasattr(torch, "autocast"):
+        raise Exception("precision {} needs torch>=1.10 (installed: {}), use fp32".format(precision, torch.__version__))
+    if precision=="fp16" and torch.device(device).type=="cpu" and not (hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler")):
+        raise Exception("precision fp16 on the cpu needs torch>=2.3 (installed: {}), use bf16".format(torch.__version__))
+
+
+def iterate_pixel_batches(inputs, mask=None, batch_size=2**18, rows_per_read=512, buildings_only=True):
+    """
+    Gathers the pixels with buildings (and inside the mask, if given) from a feature cube, reading strips of
+    "rows_per_read" rows at a time, such that hdf5 datasets are never read completely.
+    Inputs:
+        - inputs : sanitized array/tensor/hdf5 dataset of shape (1,C,h,w) or (C,h,w), with the building counts in the
+            first channel
+        - mask : boolean mask of shape (h,w), optional. Strips without pixels in the mask are not read.
+        - buildings_only : False to also gather the pixels without buildings (in the mask)
+    Yields:
+        - pixels : tensor of shape (N,C) with N<=batch_size
+        - idxs : flat indices (row*w+col) of the pixels in the map
+    """
+    oh, ow = inputs.shape[-2:]
+    if mask is not None:
+        mask = torch.as_tensor(mask, dtype=torch.bool)
+
+    pending_pixels, pending_idxs, npending = [], [], 0
+    for hi in range(0, oh, rows_per_read):
+        if mask is not None and not mask[hi:hi+rows_per_read].any():
+            continue
+        strip = inputs[0,:,hi:hi+rows_per_read] if len(inputs.shape)==4 else inputs[:,hi:hi+rows_per_read]
+        strip = torch.as_tensor(strip)
+        strip = strip.reshape(strip.shape[0], -1)
+        selection = strip[0]>0 if buildings_only else torch.ones(strip.shape[1], dtype=torch.bool)
+        if mask is not None:
+            selection &= mask[hi:hi+rows_per_read].reshape(-1)
+        idxs = torch.nonzero(selection).squeeze(1)
+        if len(idxs)==0:
+            continue
+        pending_pixels.append(strip[:,idxs].t())
+        pending_idxs.append(idxs + hi*ow)
+        npending += len(idxs)
+
+        if npending>=batch_size:
+            pixels, idxs = torch.cat(pending_pixels, 0), torch.cat(pending_idxs, 0)
+            for bi in range(0, len(idxs), batch_size):
+                yield pixels[bi:bi+batch_size], idxs[bi:bi+batch_size]
+            pending_pixels, pending_idxs, npending = [], [], 0
+
+    if npending>0:
+        pixels, idxs = torch.cat(pending_pixels, 0), torch.cat(pending_idxs, 0)
+        for bi in range(0, len(idxs), batch_size):
+            yield pixels[bi:bi+batch_size], idxs[bi:bi+batch_size]
+
+
+def predict_map_sparse(pixel_model, inputs, out_dim, mask=None, batch_size=2**18, rows_per_read=512, device=None):
+    """
+    Evaluates pixel_model on the pixels with buildings (and inside the mask, if given) and scatters the results into
+    maps of shape (1,out_dim,h,w). pixel_model maps a (N,C) pixel matrix to the tuple (pop_est, occrate), both of
+    shape (N,out_dim), e.g. a PixScaleMLP or a frozen inference module. The pixels are moved to "device" if given.
+    """
+    oh, ow = inputs.shape[-2:]
+    outvar = torch.zeros((1,out_dim,oh, ow), dtype=torch.float32, device='cpu')
+    scale = torch.zeros((1,out_dim,oh, ow), dtype=torch.float32, device='cpu')
+    outvar_flat, scale_flat = outvar.view(out_dim, -1), scale.view(out_dim, -1)
+
+    with torch.no_grad():
+        for pixels, idxs in iterate_pixel_batches(inputs, mask, batch_size=batch_size, rows_per_read=rows_per_read):
+            if device is not None:
+                pixels = pixels.to(device)
+            pop_est, occrate = pixel_model(pixels)
+            outvar_flat[:,idxs] = pop_est.t().cpu()
+            scale_flat[:,idxs] = occrate.t().cpu()
+
+    return outvar, scale
+
+
+class WelfordReducer:
+    """
+    Online mean and variance over samples. A batch of samples (stacked along the first dimension) is merged into the
+    running statistics with the parallel update of Chan et al., such that only one batch of samples is held in memory.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+
+    def update(self, samples):
+        n = samples.shape[0]
+        batch_mean = samples.mean(0)
+        batch_m2 = torch.square(samples - batch_mean).sum(0)
+        if self.count==0:
+            self.mean, self.m2 = batch_mean, batch_m2
+        else:
+            delta = batch_mean - self.mean
+            total = self.count + n
+            self.mean = self.mean + delta * (n / total)
+            self.m2 = self.m2 + batch_m2 + torch.square(delta) * (self.count * n / total)
+        self.count += n
+
+
+    def variance(self):
+        return self.m2 / self.count
+
+
+def predict_map_mc_dropout(sample_model, inputs, out_dim, num_samples=32, samples_per_pass=8, mask=None, batch_size=2**15,
+    rows_per_read=512, device=None):
+    """
+    Monte Carlo dropout maps: mean and variance over num_samples stochastic predictions per pixel with buildings (and
+    inside the mask, if given). sample_model maps a (N,C) pixel matrix and a number of samples n to the population
+    estimates of shape (n,N,out_dim). The samples of a pixel batch are drawn in passes of samples_per_pass and reduced
+    with a WelfordReducer, so at most batch_size x samples_per_pass predictions are in memory.
+    Output:
+        - mean and variance maps of shape (1,out_dim,h,w), on the cpu
+    """
+    oh, ow = inputs.shape[-2:]
+    mean = torch.zeros((1,out_dim,oh, ow), dtype=torch.float32, device='cpu')
+    variance = torch.zeros((1,out_dim,oh, ow), dtype=torch.float32, device='cpu')
+    mean_flat, variance_flat = mean.view(out_dim, -1), variance.view(out_dim, -1)
+
+    with torch.no_grad():
+        for pixels, idxs in iterate_pixel_batches(inputs, mask, batch_size=batch_size, rows_per_read=rows_per_read):
+            if device is not None:
+                pixels = pixels.to(device)
+            reducer = WelfordReducer()
+            for si in range(0, num_samples, samples_per_pass):
+                reducer.update(sample_model(pixels, min(samples_per_pass, num_samples-si)))
+            mean_flat[:,idxs] = reducer.mean.t().cpu()
+            variance_flat[:,idxs] = reducer.variance().t().cpu()
+
+    return mean, variance
+
+
+def conv1x1_to_linear(conv):
+    """
+    Copies the weights of a 1x1 nn.Conv2d into an equivalent nn.Linear.
+    """
+    linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None).to(conv.weight.device)
+    with torch.no_grad():
+        linear.weight.copy_(conv.weight.view(conv.out_channels, conv.in_channels))
+        if conv.bias is not None:
+            linear.bias.copy_(conv.bias)
+    return linear
+
+
+def linear_to_conv1x1(linear):
+    """
+    Copies the weights of a nn.Linear into an equivalent 1x1 nn.Conv2d.
+    """
+    conv = nn.Conv2d(linear.in_features, linear.out_features, (1,1), padding=0, bias=linear.bias is not None).to(linear.weight.device)
+    with torch.no_grad():
+        conv.weight.copy_(linear.weight.view(linear.out_features, linear.in_features, 1, 1))
+        if linear.bias is not None:
+            conv.bias.copy_(linear.bias)
+    return conv
+
+
+def convert_sequential(seq, convert_fn):
+    """
+    Rebuilds a nn.Sequential with convert_fn applied to its Conv2d/Linear layers. The layer indices (and therefore the
+    state_dict keys) are kept, activations and dropouts are reused as they work on both layouts.
+    """
+    layers = []
+    for layer in seq:
+        if isinstance(layer, (nn.Conv2d, nn.Linear)):
+            layers.append(convert_fn(layer))
+        else:
+            layers.append(layer)
+    return nn.Sequential(*layers)
+
+
+def conv_to_linear_state_dict(state_dict):
+    """
+    Converts a PixScaleNet (1x1 kernels) state_dict to the layout of PixScaleMLP. The keys are identical, only the
+    (out,in,1,1) conv weights are reshaped to (out,in).
+    """
+    return {key: value.flatten(1) if value.dim()==4 else value for key,value in state_dict.items()}
+
+
+def linear_to_conv_state_dict(state_dict):
+    """
+    Converts a PixScaleMLP state_dict back to the layout of PixScaleNet, such that it can be saved as a regular checkpoint.
+    """
+    return {key: value[:,:,None,None] if (value.dim()==2 and key.endswith("weight")) else value for key,value in state_dict.items()}
+
+
+class PixScaleMLP(nn.Module):
+    """
+    Fast path of PixScaleNet for 1x1 kernels. Runs the same weights as nn.Linear layers on pixel matrices of shape
+    (N,C), where the first column holds the building counts (same channel order as for PixScaleNet).
+    This avoids the (1,C,N,1) layout, the masking and the unsqueezing of the convolutional path.
+    """
+
+    def __init__(self, scalenet):
+        super(PixScaleMLP, self).__init__()
+
+        if scalenet.convnet:
+            raise Exception("PixScaleMLP is only available for networks with kernel_size 1,1,1,1")
+
+        self.copy_config(scalenet)
+
+        # the scaling parameters are shared with the PixScaleNet
+        if self.input_scaling:
+            self.in_scale, self.in_bias = scalenet.in_scale, scalenet.in_bias
+        if self.output_scaling:
+            self.out_scale, self.out_bias = scalenet.out_scale, scalenet.out_bias
+
+        self.occratenet = convert_sequential(scalenet.occratenet, conv1x1_to_linear)
+        self.occrate_layer = convert_sequential(scalenet.occrate_layer, conv1x1_to_linear)
+        self.occrate_var_layer = convert_sequential(scalenet.occrate_var_layer, conv1x1_to_linear)
+        self.train(scalenet.training)
+
+
+    def copy_config(self, scalenet):
+        self.channels_in = scalenet.channels_in
+        self.device = scalenet.device
+        self.pop_target = scalenet.pop_target
+        self.pred_var = scalenet.pred_var
+        self.bayesian = scalenet.bayesian
+        self.exptransform_outputs = scalenet.exptransform_outputs
+        self.out_dim = scalenet.out_dim
+        self.input_scaling = scalenet.input_scaling
+        self.output_scaling = scalenet.output_scaling
+        self.zero_no_buildings = scalenet.zero_no_buildings
+        self.autocast_dtype = scalenet.autocast_dtype
+
+
+    def forward(self, pixels, name=None, num_samples=None):
+        """
+        Inputs:
+            - pixels : tensor of shape (N,C), with the building counts in the first column.
+            - name: the name of the country the pixels are located.
+            - num_samples: if given, the pixels are repeated along a leading sample dimension, such that dropouts in
+              train mode draw independent masks per sample (Monte Carlo dropout).
+        Output:
+            - pop_est : tensor of shape (N,d). Where d is 1 for the non bayesian case and 2 (pred & var) for the bayesian case.
+              Shape (num_samples,N,d) if num_samples is given.
+            - occrate : tensor of shape (N,d)
+        """
+        with phase("h2d"):
+            pixels = pixels.to(self.device)
+        buildings = pixels[:,0:1]
+        no_buildings = buildings[:,0]==0
+
+        if self.pop_target:
+            data = pixels
+        else:
+            data = pixels[:,1:]
+
+        if self.input_scaling:
+            data = self.perform_scale_inputs(data, name)
+
+        if num_samples is not None:
+            # a copy, the first dropout works in place
+            data = data.unsqueeze(0).repeat(num_samples, 1, 1)
+
+        with autocast(self.device, self.autocast_dtype):
+            feats = self.occratenet(data)
+        feats = feats.float()
+
+        # indexing with [...,0:1] and [...,no_buildings,:] also supports stacked outputs of shape (K,N,d)
+        if self.pop_target:
+            pop_est = self.occrate_layer(feats)
+            if self.bayesian:
+                raise Exception("not implemented")
+            if self.output_scaling:
+                pop_est = self.perform_scale_output(pop_est, name)
+            if self.zero_no_buildings:
+                pop_est[...,no_buildings,:] *= 0.
+            occrate = pop_est / buildings
+            occrate[...,no_buildings,:] *= 0.
+        else:
+            occrate = self.occrate_layer(feats)
+            if self.bayesian:
+                if self.pred_var:
+                    var = self.occrate_var_layer(feats)
+                else:
+                    var = torch.exp(self.occrate_var_layer(feats))
+                occrate = torch.cat([occrate, var], -1)
+                if self.output_scaling:
+                    occrate = self.perform_scale_output(occrate, name)
+                if self.zero_no_buildings:
+                    occrate[...,no_buildings,:] *= 0.
+
+                # Variance Propagation
+                pop_est = torch.cat([buildings*occrate[...,0:1], torch.square(buildings)*occrate[...,1:2]], -1)
+            else:
+                if self.output_scaling:
+                    occrate = self.perform_scale_output(occrate, name)
+                pop_est = buildings*occrate
+
+        if self.exptransform_outputs:
+            pop_est = pop_est.exp()
+
+        return pop_est, occrate
+
+
+    def input_scale_bias(self, name):
+        if name in self.in_scale.keys():
+            scale, bias = self.in_scale[name], self.in_bias[name]
+        else:
+            scale = torch.stack(list(self.in_scale.values())).mean(0)
+            bias = torch.stack(list(self.in_bias.values())).mean(0)
+        return scale.view(1,-1), bias.view(1,-1)
+
+
+    def output_scale(self, name):
+        if name in self.out_scale.keys():
+            return self.out_scale[name]
+        return torch.stack(list(self.out_scale.values())).mean(0)
+
+
+    def perform_scale_inputs(self, data, name):
+        scale, bias = self.input_scale_bias(name)
+        return (data - bias) / scale
+
+
+    def perform_scale_output(self, preds, name):
+        scale = self.output_scale(name)
+        if self.bayesian:
+            preds = torch.cat([preds[...,0:1]*scale, preds[...,1:2]*torch.square(scale)], -1)
+        else:
+            preds = preds*scale
+        return preds.clamp(min=0)
+
+
+    def load_scalenet_state_dict(self, state_dict):
+        """
+        Loads a PixScaleNet state_dict (e.g. the 'model_state_dict' of a checkpoint) into this module.
+        """
+        return self.load_state_dict(conv_to_linear_state_dict(state_dict))
+
+
+    def scalenet_state_dict(self):
+        """
+        Returns the weights in the PixScaleNet layout, such that they can be stored as a regular checkpoint.
+        """
+        return linear_to_conv_state_dict(self.state_dict())
+
+
+    def to_scalenet(self, scalenet):
+        """
+        Copies the weights of this module back into a PixScaleNet.
+        """
+        scalenet.load_state_dict(self.scalenet_state_dict())
+        return scalenet
+
+
+
+class StackedLinear(nn.Module):
+    """
+    K nn.Linear layers of the same shape, evaluated with one batched matmul. An input of shape (N,in) is shared by all
+    K layers, an input of shape (K,N,in) holds one slice per layer. The output has shape (K,N,out).
+    """
+
+    def __init__(self, linears):
+        super(StackedLinear, self).__init__()
+        self.weight = nn.Parameter(torch.stack([linear.weight.detach() for linear in linears]))
+        self.bias = nn.Parameter(torch.stack([linear.bias.detach() for linear in linears]))
+
+    def forward(self, x):
+        return torch.matmul(x, self.weight.transpose(1,2)) + self.bias.unsqueeze(1)
+
+
+def stack_sequentials(seqs):
+    """
+    Builds one nn.Sequential from several converted (PixScaleMLP) sequentials of the same architecture.
+    """
+    layers = []
+    for parallel_layers in zip(*seqs):
+        if isinstance(parallel_layers[0], nn.Linear):
+            layers.append(StackedLinear(parallel_layers))
+        else:
+            layers.append(parallel_layers[0])
+    return nn.Sequential(*layers)
+
+
+class PixScaleEnsemble(PixScaleMLP):
+    """
+    Several PixScaleNets with 1x1 kernels (e.g. the five cross validation folds) stacked into one module. The pixels are
+    read and passed through the network once, the forward pass returns the predictions of all models with shape (K,N,d).
+    Inference only.
+    """
+
+    def __init__(self, scalenets):
+        nn.Module.__init__(self)
+
+        self.members = [scalenet.as_linear().eval() for scalenet in scalenets]
+        self.num_models = len(self.members)
+        self.copy_config(scalenets[0])
+
+        self.occratenet = stack_sequentials([member.occratenet for member in self.members])
+        self.occrate_layer = stack_sequentials([member.occrate_layer for member in self.members])
+        self.occrate_var_layer = stack_sequentials([member.occrate_var_layer for member in self.members])
+        self.eval()
+
+
+    def input_scale_bias(self, name):
+        scales, biases = zip(*[member.input_scale_bias(name) for member in self.members])
+        return torch.stack(scales), torch.stack(biases)
+
+
+    def output_scale(self, name):
+        return torch.stack([member.output_scale(name) for member in self.members]).view(self.num_models, 1, 1)
+
+
+    def forward_map(self, inputs, model_map, mask=None, name=None, regions=None, num_regions=None,
+        batch_size=2**16, rows_per_read=512, dtype=torch.float32):
+        """
+        Predicts the map with all models in one pass over the feature cube. Each pixel takes the prediction of the model
+        given by model_map (e.g. the fold for which the pixel is in the holdout set). Pixels without buildings are only
+        evaluated with pop_target or exptransform, otherwise their prediction is zero.
+        Inputs:
+            - inputs : array/tensor/hdf5 dataset of shape (1,C,h,w) or (C,h,w)
+            - model_map : integer tensor of shape (h,w) with the index of the model to use per pixel, -1 for no prediction
+            - mask : boolean mask of shape (h,w) of the pixels to evaluate, optional
+            - regions : integer tensor of shape (h,w) with region ids, optional. Sums of the selected population
+              estimates per region are accumulated in float64, independent of the dtype of the maps.
+        Output: dict with
+            - "pop_est", "occrate" : maps of shape (d,h,w) of the selected model, occrate is nan where not evaluated
+            - "mean", "variance" : mean and variance of the population estimates of all models, of shape (h,w)
+            - "region_sums" : tensor of shape (num_regions,), if regions are given
+        """
+        oh, ow = inputs.shape[-2:]
+        model_map = torch.as_tensor(model_map).long()
+        evaluate = model_map>=0
+        if mask is not None:
+            evaluate &= torch.as_tensor(mask, dtype=torch.bool)
+
+        out = {
+            "pop_est": torch.zeros((self.out_dim, oh, ow), dtype=dtype),
+            "occrate": torch.full((self.out_dim, oh, ow), float('nan'), dtype=dtype),
+            "mean": torch.zeros((oh, ow), dtype=dtype),
+            "variance": torch.zeros((oh, ow), dtype=dtype),
+        }
+        flat = {key: value.view(value.shape[0], -1) if value.dim()==3 else value.view(1, -1) for key,value in out.items()}
+        model_map = model_map.view(-1)
+        if regions is not None:
+            regions = torch.as_tensor(regions).reshape(-1)
+            num_regions = num_regions if num_regions is not None else int(regions.max())+1
+            out["region_sums"] = torch.zeros((num_regions,), dtype=torch.float64)
+
+        with torch.no_grad():
+            buildings_only = not (self.pop_target or self.exptransform_outputs)
+            for pixels, idxs in iterate_pixel_batches(inputs, evaluate, batch_size=batch_size, rows_per_read=rows_per_read,
+                buildings_only=buildings_only):
+                pop_est, occrate = self(pixels, name=name)
+                pick = model_map[idxs].to(pop_est.device)
+                arange = torch.arange(len(idxs), device=pop_est.device)
+                flat["pop_est"][:,idxs] = pop_est[pick, arange].t().cpu().to(dtype)
+                flat["occrate"][:,idxs] = occrate[pick, arange].t().cpu().to(dtype)
+                flat["mean"][0,idxs] = pop_est[...,0].mean(0).cpu().to(dtype)
+                flat["variance"][0,idxs] = pop_est[...,0].var(0, unbiased=False).cpu().to(dtype)
+                if regions is not None:
+                    out["region_sums"].index_add_(0, regions[idxs].long(), pop_est[pick, arange, 0].cpu().double())
+
+        return out
@@ -0,0 +1,147 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+import torch
+
+
+class PhaseProfiler:
+    """
+    Wall-clock time of the phases of a run (data fetch, forward, backward, validation, ...). Every phase is also a
+    torch.profiler record_function, such that it shows up in the traces of torch.profiler. With synchronize, the
+    device is synchronized at the beginning and end of each phase, such that the asynchronous cuda work is counted in
+    the phase that launched it (this slows down the training on the gpu).
+    Nested phases are also counted in their parent phase. At most max_events phases are kept for the trace, the
+    totals count all.
+    """
+
+    def __init__(self, synchronize=True, max_events=200000):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.max_events = max_events
+        self.totals, self.counts = defaultdict(float), defaultdict(int)
+        self.events = []
+        self.start_time = time.perf_counter()
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.synchronize and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        with torch.profiler.record_function(name):
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.synchronize and torch.cuda.is_initialized():
+                    torch.cuda.synchronize()
+                duration = time.perf_counter() - start
+                self.totals[name] += duration
+                self.counts[name] += 1
+                if len(self.events)<self.max_events:
+                    self.events.append((name, start, duration, threading.get_ident()))
+
+
+    def summary(self):
+        """
+        Table of the phases: calls, total time, mean time per call and share of the wall time since the start.
+        """
+        wall = time.perf_counter() - self.start_time
+        lines = ["{:<16} {:>10} {:>12} {:>12} {:>8}".format("phase", "calls", "total [s]", "mean [ms]", "wall [%]")]
+        for name, total in sorted(self.totals.items(), key=lambda item: -item[1]):
+            lines.append("{:<16} {:>10d} {:>12.3f} {:>12.3f} {:>8.1f}".format(name, self.counts[name], total,
+                1e3*total/self.counts[name], 100*total/wall))
+        lines.append("{:<16} {:>10} {:>12.3f}".format("wall", "", wall))
+        return "\n".join(lines)
+
+
+    def export_chrome_trace(self, path):
+        # complete events ("X") in microseconds since the start, one row per thread (chrome://tracing, perfetto)
+        pid = os.getpid()
+        events = [{"name": name, "ph": "X", "ts": 1e6*(start-self.start_time), "dur": 1e6*duration, "pid": pid, "tid": tid}
+            for name, start, duration, tid in self.events]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+_profiler = None
+
+
+def start_profiling(synchronize=True):
+    global _profiler
+    _profiler = PhaseProfiler(synchronize=synchronize)
+    return _profiler
+
+
+def phase(name):
+    """
+    Context of a profiled phase, no-op if the profiling is not started.
+    """
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.phase(name)
+
+
+def profiled(name):
+    """
+    Decorator, every call of the function is a phase.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiled_iter(iterable, name="data"):
+    # times the fetching of every element (e.g. of a DataLoader) as a phase
+    if _profiler is None:
+        return iterable
+    return _timed_iter(iterable, name)
+
+
+def _timed_iter(iterable, name):
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def stop_profiling(out_dir, run_name):
+    """
+    Writes the summary table to <out_dir>/<run_name>.txt and the trace of the phases to <out_dir>/<run_name>.trace.json,
+    prints the summary and returns the total time per phase. None if the profiling is not started.
+    """
+    global _profiler
+    if _profiler is None:
+        return None
+    profiler, _profiler = _profiler, None
+    os.makedirs(out_dir, exist_ok=True)
+    summary = profiler.summary()
+    with open(os.path.join(out_dir, "{}.txt".format(run_name)), "w") as f:
+        f.write(summary + "\n")
+    profiler.export_chrome_trace(os.path.join(out_dir, "{}.trace.json".format(run_name)))
+    print(summary)
+    return dict(profiler.totals)
+
+
+def op_profiler(path, wait=5, warmup=2, active=10):
+    """
+    torch.profiler of the operators of "active" training steps (after wait+warmup steps, call step() after every
+    step), the Chrome trace is written to path. The phases appear as record functions in the trace.
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return torch.profiler.profile(activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=lambda prof: prof.export_chrome_trace(path))
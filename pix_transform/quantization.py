@@ -0,0 +1,128 @@
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.quantization
+
+from utils import compute_performance_metrics
+from pix_transform.export import freeze_pixscalenet
+
+
+def fuse_linear_relu(seq):
+    """
+    Fuses all (nn.Linear, nn.ReLU) pairs of a sequential in place, as needed for static quantization.
+    """
+    pairs = [[str(i), str(i+1)] for i in range(len(seq)-1) if isinstance(seq[i], nn.Linear) and isinstance(seq[i+1], nn.ReLU)]
+    if len(pairs)>0:
+        torch.quantization.fuse_modules(seq, pairs, inplace=True)
+    return seq
+
+
+def quantize_pixscalenet(net, name=None, mode="dynamic", calibration_pixels=None, batch_size=2**16):
+    """
+    Int8 version of the frozen network (pix_transform.export.freeze_pixscalenet) for the country "name", runs on CPU.
+    mode:
+        "dynamic": int8 weights of all linear layers, the activations are quantized on the fly.
+        "static": int8 weights and activations of the occratenet, the activation ranges are calibrated on
+            calibration_pixels (N,C), e.g. from calibration_pixels_from_dataset. The heads stay in float32.
+    """
+    frozen = freeze_pixscalenet(net, name).cpu().eval()
+
+    if mode=="dynamic":
+        quantized = torch.quantization.quantize_dynamic(frozen, {nn.Linear}, dtype=torch.qint8)
+
+    elif mode=="static":
+        if calibration_pixels is None:
+            raise Exception("static quantization needs calibration pixels")
+        backend = torch.backends.quantized.engine
+        occratenet = fuse_linear_relu(frozen.occratenet)
+        frozen.occratenet = nn.Sequential(torch.quantization.QuantStub(), *occratenet, torch.quantization.DeQuantStub())
+        frozen.occratenet.qconfig = torch.quantization.get_default_qconfig(backend)
+        torch.quantization.prepare(frozen.occratenet, inplace=True)
+        with torch.no_grad():
+            for pixels in torch.split(calibration_pixels.cpu(), batch_size):
+                frozen(pixels)
+        torch.quantization.convert(frozen.occratenet, inplace=True)
+        quantized = frozen
+
+    else:
+        raise Exception("unknown quantization mode {}".format(mode))
+
+    # the quantized kernels only run on CPU, predict_map_sparse moves the pixels there
+    quantized.device = torch.device("cpu")
+    return quantized
+
+
+def region_pixels(X, Mask):
+    """
+    (N,C) pixel matrix of the valid pixels of a region patch.
+    """
+    return X[:, Mask].t().float()
+
+
+def calibration_pixels_from_dataset(dataset, name, num_regions=64, max_pixels=2**17, seed=1610):
+    """
+    Samples pixels with buildings from num_regions training regions of the country "name" in a MultiPatchDataset.
+    Falls back to all regions of the country if it has no training regions (e.g. test countries).
+    """
+    rng = np.random.default_rng(seed)
+    if len(dataset.BBox_train[name])>0:
+        num_all, get_item = len(dataset.BBox_train[name]), dataset.get_single_training_item
+    else:
+        num_all, get_item = len(dataset.BBox[name]), dataset.get_single_item
+    choice = rng.choice(num_all, min(num_regions, num_all), replace=False)
+
+    pixels = []
+    for k in choice:
+        X, _, Mask, _, _ = get_item(k, name)
+        this_pixels = region_pixels(X, Mask)
+        pixels.append(this_pixels[this_pixels[:,0]>0])
+    pixels = torch.cat(pixels, 0)
+
+    if pixels.shape[0]>max_pixels:
+        pixels = pixels[torch.from_numpy(rng.choice(pixels.shape[0], max_pixels, replace=False))]
+    return pixels
+
+
+def quantization_report(net, dataset, name, modes=("dynamic", "static"), num_calibration_regions=64, silent_mode=True):
+    """
+    Compares the float32 frozen network with its int8 versions on all regions of the country "name" in a
+    MultiPatchDataset: region-level metrics (compute_performance_metrics) and throughput in pixels/s.
+    Returns the metrics per model and the quantized models.
+    """
+    models = {"float32": freeze_pixscalenet(net, name).cpu().eval()}
+    calibration_pixels = None
+    if "static" in modes:
+        calibration_pixels = calibration_pixels_from_dataset(dataset, name, num_regions=num_calibration_regions)
+    for mode in modes:
+        models[mode] = quantize_pixscalenet(net, name, mode=mode, calibration_pixels=calibration_pixels)
+
+    preds = {key: {} for key in models.keys()}
+    runtimes = {key: 0. for key in models.keys()}
+    gt = {}
+    num_pixels = 0
+    with torch.no_grad():
+        for k in range(dataset.len_all_samples(name)):
+            X, Y, Mask, _, census_id = dataset.get_single_item(k, name)
+            pixels = region_pixels(X, Mask)
+            num_pixels += pixels.shape[0]
+            gt[census_id.item()] = Y.item()
+            for key, model in models.items():
+                t0 = time.perf_counter()
+                pop_est = model(pixels)[0]
+                runtimes[key] += time.perf_counter() - t0
+                preds[key][census_id.item()] = pop_est[:,0].sum().item()
+
+    metrics = {}
+    for key in models.keys():
+        this_metrics = compute_performance_metrics(preds[key], gt)
+        metrics[key] = {"r2": this_metrics["r2"], "mae": this_metrics["mae"], "mape": this_metrics["mape"],
+            "pixels_per_s": num_pixels/max(runtimes[key], 1e-12)}
+
+    if not silent_mode:
+        print("Quantization report for {} ({} regions, {} pixels)".format(name, len(gt), num_pixels))
+        print("{:<10} {:>8} {:>12} {:>8} {:>14}".format("model", "r2", "mae", "mape", "pixels/s"))
+        for key, m in metrics.items():
+            print("{:<10} {:>8.4f} {:>12.2f} {:>8.4f} {:>14.0f}".format(key, m["r2"], m["mae"], m["mape"], m["pixels_per_s"]))
+
+    return metrics, models
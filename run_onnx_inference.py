@@ -0,0 +1,129 @@
+import argparse
+import h5py
+import numpy as np
+import onnxruntime as ort
+from osgeo import gdal
+from tqdm import tqdm
+
+
+def create_session(model_path, intra_op_threads=None, inter_op_threads=None):
+    """
+    onnxruntime session on the CPU provider. None leaves the number of threads to onnxruntime (all physical cores).
+    """
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads is not None:
+        sess_options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads is not None:
+        sess_options.inter_op_num_threads = inter_op_threads
+        sess_options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    return ort.InferenceSession(model_path, sess_options, providers=["CPUExecutionProvider"])
+
+
+def get_geo_metadata(session, reference_raster=None):
+    """
+    geo_transform and projection of the output, from a reference raster of the same grid (e.g. the admin regions
+    raster of the country) or from the metadata stored by export_pixscalenet.py.
+    """
+    if reference_raster is not None:
+        ds = gdal.Open(reference_raster)
+        geo_transform, projection = ds.GetGeoTransform(), ds.GetProjection()
+        ds = None
+        return geo_transform, projection
+
+    metadata = session.get_modelmeta().custom_metadata_map
+    if "geo_transform" not in metadata.keys():
+        raise Exception("The ONNX model has no geo metadata, pass a reference raster (-ref)")
+    geo_transform = tuple([float(v) for v in metadata["geo_transform"].split(",")])
+    return geo_transform, metadata["projection"]
+
+
+def create_geotiff(output_path, h, w, bands, geo_transform, projection):
+    driver = gdal.GetDriverByName("GTiff")
+    outdata = driver.Create(output_path, w, h, bands, gdal.GDT_Float32, options=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=IF_SAFER'])
+    outdata.SetGeoTransform(geo_transform)
+    outdata.SetProjection(projection)
+    return outdata
+
+
+def iterate_tiles(h, w, tile_size):
+    for rmin in range(0, h, tile_size):
+        for cmin in range(0, w, tile_size):
+            yield rmin, min(rmin+tile_size, h), cmin, min(cmin+tile_size, w)
+
+
+def run_inference(session, h5_filename, output_path, occrate_output_path=None, tile_size=512, reference_raster=None, skip_empty_tiles=True):
+    """
+    Streams tiles of size tile_size x tile_size from the features of a data.hdf5 file through the ONNX model and writes
+    the population map (and the occupancy rate map) tile by tile to GeoTIFF. Only one tile is kept in memory.
+    skip_empty_tiles: tiles without buildings are not evaluated and stay zero. They are found with the buildings mask
+        stored by utils.sanitize_hdf5_file, without reading their features.
+    """
+    geo_transform, projection = get_geo_metadata(session, reference_raster)
+
+    with h5py.File(h5_filename, "r") as f:
+        if not f.attrs.get("sanitized", False):
+            raise Exception("Features of {} are not sanitized, run utils.sanitize_hdf5_file first".format(h5_filename))
+        features = f["features"]
+        buildings_mask = f["buildings_mask"]
+        _, _, h, w = features.shape
+
+        outdata, occdata = None, None
+        for rmin, rmax, cmin, cmax in tqdm(list(iterate_tiles(h, w, tile_size))):
+            if skip_empty_tiles and not buildings_mask[rmin:rmax, cmin:cmax].any():
+                continue
+            tile = features[:, :, rmin:rmax, cmin:cmax].astype(np.float32)
+
+            pop_est, occrate = session.run(["pop_est", "occrate"], {"features": tile})
+
+            if outdata is None:
+                outdata = create_geotiff(output_path, h, w, pop_est.shape[1], geo_transform, projection)
+                if occrate_output_path is not None:
+                    occdata = create_geotiff(occrate_output_path, h, w, occrate.shape[1], geo_transform, projection)
+
+            for b in range(pop_est.shape[1]):
+                outdata.GetRasterBand(b+1).WriteArray(pop_est[0,b], cmin, rmin)
+            if occdata is not None:
+                for b in range(occrate.shape[1]):
+                    occdata.GetRasterBand(b+1).WriteArray(occrate[0,b], cmin, rmin)
+
+    if outdata is None:
+        raise Exception("No tile with buildings in {}".format(h5_filename))
+    outdata.FlushCache()
+    outdata = None
+    if occdata is not None:
+        occdata.FlushCache()
+        occdata = None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", type=str, help="ONNX model exported with export_pixscalenet.py -f onnx")
+    parser.add_argument("output", type=str, help="Output GeoTIFF of the population map")
+    parser.add_argument("--country", "-c", type=str, default=None, help="Country, reads the features from <dataset_dir>/<country>/data.hdf5. Default: country stored in the model")
+    parser.add_argument("--dataset_dir", "-dd", type=str, default='datasets', help="Directory of the hdf5 files")
+    parser.add_argument("--h5_file", "-h5", type=str, default=None, help="hdf5 file with the features, overrides dataset_dir and country")
+    parser.add_argument("--occrate_output", "-occ", type=str, default=None, help="Output GeoTIFF of the occupancy rate map")
+    parser.add_argument("--reference_raster", "-ref", type=str, default=None, help="Raster of the same grid to copy the geo metadata from, e.g. the admin regions raster")
+    parser.add_argument("--tile_size", "-ts", type=int, default=512, help="Height and width of the tiles, multiples of the hdf5 chunk size (512) are the fastest")
+    parser.add_argument("--intra_op_threads", "-intra", type=int, default=None, help="onnxruntime intra-op threads")
+    parser.add_argument("--inter_op_threads", "-inter", type=int, default=None, help="onnxruntime inter-op threads")
+    parser.add_argument("--keep_empty_tiles", "-ket", action="store_true", help="Also evaluate the tiles without buildings (instead of writing zeros)")
+    args = parser.parse_args()
+
+    session = create_session(args.model, args.intra_op_threads, args.inter_op_threads)
+
+    h5_filename = args.h5_file
+    if h5_filename is None:
+        country = args.country if args.country is not None else session.get_modelmeta().custom_metadata_map.get("country")
+        if country is None:
+            raise Exception("Pass the country (-c) or the hdf5 file (-h5)")
+        h5_filename = f"{args.dataset_dir}/{country}/data.hdf5"
+
+    run_inference(session, h5_filename, args.output, occrate_output_path=args.occrate_output, tile_size=args.tile_size,
+        reference_raster=args.reference_raster, skip_empty_tiles=not args.keep_empty_tiles)
+    print("saved population map to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
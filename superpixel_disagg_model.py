@@ -6,7 +6,6 @@ import numpy as np
 import torch
 import matplotlib.pyplot as plt 
 from osgeo import gdal
-import wandb
 from pathlib import Path
 import h5py 
 from tqdm import tqdm as tqdm
@@ -16,11 +15,15 @@ import random
 import config_pop as cfg
 from utils import read_input_raster_data, read_input_raster_data_to_np, compute_performance_metrics, write_geolocated_image, create_map_of_valid_ids, \
     compute_grouped_values, transform_dict_to_array, transform_dict_to_matrix, calculate_densities, plot_2dmatrix, \
-    bbox2
+    bbox2, sanitize_hdf5_file
 from cy_utils import compute_map_with_new_labels, compute_accumulated_values_by_region, compute_disagg_weights, \
     set_value_for_each_region
 
-from pix_transform.pix_admin_transform import PixAdminTransform 
+from pix_transform.pix_admin_transform import PixAdminTransform, TrainAllFolds_PixAdminTransform
+from pix_transform.distributed import init_distributed, get_rank, barrier, broadcast_object
+from pix_transform.metrics import init_metrics, get_run_name, finish_metrics, log_metrics
+from pix_transform.profiling import start_profiling, stop_profiling
+from pix_transform.pix_transform_net import check_precision
 from pix_transform.evaluation import Eval5Fold_PixAdminTransform, EvalModel_PixAdminTransform, Eval5Fold_FeatureImportance
 from pix_transform_utils.plots import plot_result
 from distutils.util import strtobool
@@ -305,7 +308,33 @@ def superpixel_with_pix_data(
     kernel_size,
     eval_model,
     full_ceval,
-    remove_feat_idxs
+    remove_feat_idxs,
+    sparse_inference,
+    frozen_inference,
+    quantized_inference,
+    precision,
+    mc_dropout_samples,
+    inference_workers,
+    threads_per_worker,
+    accumulation_steps,
+    memory_policy,
+    async_validation,
+    validation_threads,
+    checkpoint_retention,
+    resume,
+    train_all_folds,
+    distributed,
+    pixel_budget,
+    stratified_pixels,
+    importance_smoothing,
+    country_quotas,
+    merged_forward,
+    metrics_backend,
+    log_dir,
+    profile,
+    profile_ops,
+    val_subset,
+    full_val_every
     ):
 
     ####  define parameters  ########################################################
@@ -353,7 +382,33 @@ def superpixel_with_pix_data(
             'random_seed_folds': random_seed_folds,
             'eval_model': eval_model,
             'full_ceval': full_ceval,
-            'remove_feat_idxs' : remove_feat_idxs
+            'remove_feat_idxs' : remove_feat_idxs,
+            'sparse_inference': sparse_inference,
+            'frozen_inference': frozen_inference,
+            'quantized_inference': quantized_inference,
+            'precision': precision,
+            'mc_dropout_samples': mc_dropout_samples,
+            'inference_workers': inference_workers,
+            'threads_per_worker': threads_per_worker,
+            'accumulation_steps': accumulation_steps,
+            'memory_policy': memory_policy,
+            'async_validation': async_validation,
+            'validation_threads': validation_threads,
+            'checkpoint_retention': checkpoint_retention,
+            'resume': resume,
+            'train_all_folds': train_all_folds,
+            'distributed': distributed,
+            'pixel_budget': pixel_budget,
+            'stratified_pixels': stratified_pixels,
+            'importance_smoothing': importance_smoothing,
+            'country_quotas': country_quotas,
+            'merged_forward': merged_forward,
+            'metrics_backend': metrics_backend,
+            'log_dir': log_dir,
+            'profile': profile,
+            'profile_ops': profile_ops,
+            'val_subset': val_subset,
+            'full_val_every': full_val_every
             }
 
     building_features = ['buildings', 'buildings_j', 'buildings_google', 'buildings_maxar', 'buildings_merge']
@@ -365,7 +420,23 @@ def superpixel_with_pix_data(
                             "valid_data_mask", "geo_metadata", "cr_map", "cr_map_full"]
     cr_disaggregation_data_vars = ["id_to_cr_id", "cr_census", "cr_regions"]
 
-    wandb.init(project="HAC", entity=wandb_user, config=params, name=params["name"])
+    if params["resume"] and params["name"] is None:
+        raise Exception("--resume needs the --name of the run, the training state is stored by run name")
+    if params["distributed"]:
+        if params["resume"]:
+            raise Exception("--resume is not available with --distributed")
+        init_distributed("gloo")
+    # the other ranks of a distributed training do not log, they take the run name of rank 0 (for the checkpoints and
+    # profiles), which is drawn or assigned by wandb without --name
+    run_name = None
+    if get_rank()==0:
+        run_name = init_metrics(metrics_backend, run_name=params["name"], config=params, project="HAC", entity=wandb_user,
+            log_dir=log_dir)
+    run_name = broadcast_object(run_name)
+    if get_rank()!=0:
+        init_metrics("none", run_name=run_name)
+    if profile or profile_ops>0:
+        start_profiling()
 
     # Fix all random seeds
     torch.manual_seed(random_seed)
@@ -400,7 +471,8 @@ def superpixel_with_pix_data(
         parent_dir = f"{dataset_dir}/{ds}/"
         print("h5_filename", h5_filename)
 
-        if not (os.path.isfile(h5_filename) and os.path.isfile(train_var_filename_f) and os.path.isfile(train_var_filename_c) \
+        # rank 0 prepares the files of a distributed training
+        if get_rank()==0 and not (os.path.isfile(h5_filename) and os.path.isfile(train_var_filename_f) and os.path.isfile(train_var_filename_c) \
             and os.path.isfile(eval_var_filename) and os.path.isfile(eval_disag_filename)):
             Path(parent_dir).mkdir(parents=True, exist_ok=True)
 
@@ -417,10 +489,22 @@ def superpixel_with_pix_data(
             del this_disaggregation_data, this_validation_data
             del this_dataset 
 
+        # set the no-data values to zero and store the buildings mask, once per file
+        if get_rank()==0:
+            sanitize_hdf5_file(h5_filename, silent_mode=silent_mode)
+
         datalocations[ds] = {"features": h5_filename, "train_vars_f": train_var_filename_f, "train_vars_c": train_var_filename_c,
             "eval_vars": eval_var_filename, "disag": eval_disag_filename}
+    barrier()
 
-    if eval_5fold is None and eval_model is None:
+    if train_all_folds:
+        res, log_dict = TrainAllFolds_PixAdminTransform(
+            datalocations=datalocations,
+            train_dataset_name=train_dataset_name,
+            test_dataset_names=test_dataset_name,
+            params=params, 
+        )
+    elif eval_5fold is None and eval_model is None:
         res, log_dict = PixAdminTransform(
             datalocations=datalocations,
             train_dataset_name=train_dataset_name,
@@ -450,13 +534,13 @@ def superpixel_with_pix_data(
         )
 
     # save as geoTIFF files
-    save_files = True
+    save_files = get_rank()==0
     if save_files:
         for name in test_dataset_name:
             print("started saving files for", name)
 
             #Prepate the output folder
-            dest_folder = '../../../viz/outputs/{}'.format(wandb.run.name)
+            dest_folder = '../../../viz/outputs/{}'.format(get_run_name())
             if not os.path.exists(dest_folder):
                 os.makedirs(dest_folder)
             print("dest_folder {}".format(dest_folder))
@@ -497,7 +581,15 @@ def superpixel_with_pix_data(
                 geo_metadata["geo_transform"], geo_metadata["projection"] )
             write_geolocated_image( cr_map.numpy(), dest_folder+'/{}_cr_map.tiff'.format(name),
                 geo_metadata["geo_transform"], geo_metadata["projection"] )
-            write_geolocated_image( predicted_target_img.numpy(), dest_folder+'/{}_predicted_target_img.tiff'.format(name),
+            if name+'/mc_dropout_mean' in list(res.keys()):
+                # band 1: prediction, band 2: Monte Carlo dropout mean, band 3: Monte Carlo dropout variance
+                mc_bands = [res[name+'/'+key].clone() for key in ['mc_dropout_mean', 'mc_dropout_variance']]
+                for band in mc_bands:
+                    band[~valid_data_mask] = np.nan
+                predicted_target_bands = torch.stack([predicted_target_img] + mc_bands).numpy()
+            else:
+                predicted_target_bands = predicted_target_img.numpy()
+            write_geolocated_image( predicted_target_bands, dest_folder+'/{}_predicted_target_img.tiff'.format(name),
                 geo_metadata["geo_transform"], geo_metadata["projection"] )
             write_geolocated_image( predicted_target_img_adjusted.numpy(), dest_folder+'/{}_predicted_target_img_adjusted.tiff'.format(name),
                 geo_metadata["geo_transform"], geo_metadata["projection"] )
@@ -519,12 +611,23 @@ def superpixel_with_pix_data(
                 #id_map[~valid_data_mask]= np.nan
                 write_geolocated_image( id_map.numpy(), dest_folder+'/{}_id_map.tiff'.format(name),
                     geo_metadata["geo_transform"], geo_metadata["projection"] )
+            for key in ['ensemble_mean', 'ensemble_variance']:
+                if name+'/'+key in list(res.keys()):
+                    ensemble_img = res[name+'/'+key].float()
+                    ensemble_img[~valid_data_mask] = np.nan
+                    write_geolocated_image( ensemble_img.numpy(), dest_folder+'/{}_{}.tiff'.format(name, key),
+                        geo_metadata["geo_transform"], geo_metadata["projection"] )
             if name+'/fold_map' in list(res.keys()):
                 fold_map = res[name+'/fold_map']
                 #fold_map[~valid_data_mask]= np.nan
                 write_geolocated_image( fold_map.numpy(), dest_folder+'/{}_fold_map.tiff'.format(name),
                     geo_metadata["geo_transform"], geo_metadata["projection"] )
 
+    profile_name = get_run_name() if get_rank()==0 else "{}_rank{}".format(get_run_name(), get_rank())
+    phase_totals = stop_profiling("profiles", profile_name)
+    if phase_totals is not None:
+        log_metrics({"profile/"+key: value for key, value in phase_totals.items()})
+    finish_metrics()
     return
 
 
@@ -545,19 +648,27 @@ def main():
     parser.add_argument("--train_dataset_name", "-train", type=str, help="Train Dataset name (separated by commas)", required=True)
     parser.add_argument("--train_level", "-train_lvl", type=str,  default='c', help="ordered by --train_dataset_name [f:finest, c: coarser level] (separated by commas) ")
     parser.add_argument("--test_dataset_name", "-test", type=str, help="Test Dataset name (separated by commas)", required=True)
+    parser.add_argument("--train_all_folds", "-taf", type=lambda x: bool(strtobool(x)), default=False, help="Trains the models of the 5 validation folds in one process (features loaded once, steps interleaved) and evaluates them as --eval_5fold with --e5f_metric. --validation_fold is ignored")
+    parser.add_argument("--distributed", "-dist", type=lambda x: bool(strtobool(x)), default=False, help="Data-parallel training over the processes started by torchrun (gloo backend), e.g. torchrun --nproc_per_node 4 superpixel_disagg_model.py ... --distributed True")
+    parser.add_argument("--pixel_budget", "-pxb", type=int, default=None, help="Maximal number of pixels evaluated per training sample. The sums of larger regions are estimated from a random subset of their pixels, weighted with the inverse sampling rate. Only for 1x1 kernels")
+    parser.add_argument("--stratified_pixels", "-spx", type=lambda x: bool(strtobool(x)), default=False, help="Stratify the pixel subsets of --pixel_budget by building count")
     parser.add_argument("--eval_5fold", "-e5f", type=str, default=None, help="Evaluates 5 fold cross with the 5 pretrained models specified in a comma sparated list. \
                             Example: '-e5f fine-shape-1418,morning-blaze-1415,volcanic-shadow-1416,devoted-snowball-1417,eternal-donkey-1419', for the folds 0,1,2,3,4 respectively")
     parser.add_argument("--eval_model", "-em", type=str, default=None, help="Evaluates the model on the specified test dataset(s).")
     parser.add_argument("--eval_feat_importance", "-efi", type=int, default=0, help="Evaluates feature importance give as a parameter the number of permutations to perform")
 
-    parser.add_argument("--sampler", "-sap", type=str, default=None, help="Options: natural (not recommended yet), custom (see --custom_sampler_weights), <blank> (no sampler)")
+    parser.add_argument("--sampler", "-sap", type=str, default=None, help="Options: natural (not recommended yet), custom (see --custom_sampler_weights), importance (custom weights, adapted to the running loss of the samples), <blank> (no sampler)")
     parser.add_argument("--custom_sampler_weights", "-csw", type=str,  default='1', help="ordered by --train_dataset_name weight for the sampler (separated by commas) ")
+    parser.add_argument("--importance_smoothing", "-ism", type=float, default=0.2, help="Share of the custom weights in the sampling probabilities of --sampler importance, the importance weights are at most 1/importance_smoothing")
+    parser.add_argument("--country_quotas", "-cqt", type=str, default=None, help="ordered by --train_dataset_name share of the samples drawn from each country (separated by commas), for the weighted samplers")
 
     parser.add_argument("--optimizer", "-optim", type=str, default="adam", help="adam, adamw ")
     parser.add_argument("--loss", "-l", type=str, default="NormL1", help="NormL1, NormL2, gaussNLL, laplaceNLL")
     parser.add_argument("--train_weight", "-train_w", type=str,  default='1', help="ordered by --train_dataset_name weighting of the samples in the datasets (separated by commas) ")
     parser.add_argument("--learning_rate", "-lr", type=float, default=0.00001, help=" ")
     parser.add_argument("--grad_clip", "-gc", type=float, default=10., help="Gradient norm clipping value")
+    parser.add_argument("--accumulation_steps", "-acc", type=int, default=1, help="Number of samples whose gradients are accumulated per optimizer step. log_step, max_step and the lr scheduler step count optimizer steps")
+    parser.add_argument("--memory_policy", "-memp", type=str, default="logstep", help="When the cuda cache is released during training: step (every optimizer step, as before), logstep (only at the log steps/validation) or never")
     parser.add_argument("--lr_scheduler_step", "-lrs", type=float, default=np.inf, help="How many interations until LR is reduced to 10%.")
     parser.add_argument("--lr_scheduler_gamma", "-lrg", type=float, default=0.5, help="How many interations until LR is reduced to 10%.")
     parser.add_argument("--weights_regularizer", "-wr", type=float, default=0., help=" ")
@@ -575,7 +686,13 @@ def main():
     parser.add_argument("--random_seed", "-rs", type=int, default=1610, help="Random seed for this run. This does not (!) affect the random split of the validation/heldout/test-fold.")
     parser.add_argument("--random_seed_folds", "-rsf", type=int, default=1610, help=" This does only affect the random split of the validation/heldout/test-fold.")
     parser.add_argument("--full_ceval", type=lambda x: bool(strtobool(x)), default=True, help="Doing full evaluation during training?")
+    parser.add_argument("--full_val_every", "-fve", type=int, default=1, help="Full validation (and full_ceval, best scores and checkpoints) every N-th log step and at the max_step, the other log steps only validate on a fixed random subset of the validation regions")
+    parser.add_argument("--val_subset", "-vsub", type=float, default=0.1, help="Fraction of the validation regions of the light log steps, see --full_val_every")
+    parser.add_argument("--async_validation", "-av", type=lambda x: bool(strtobool(x)), default=False, help="Run the validation of the log steps in a background process on a snapshot of the weights, the training continues meanwhile")
+    parser.add_argument("--validation_threads", "-vt", type=int, default=None, help="Torch threads of the background validation process, default: torch default")
 
+    parser.add_argument("--checkpoint_retention", "-ckr", type=int, default=1, help="Number of replaced checkpoint states kept in checkpoints/store/<run name>, the states of the best_* checkpoints are always kept")
+    parser.add_argument("--resume", type=lambda x: bool(strtobool(x)), default=False, help="Continue the run --name from its training state in checkpoints/Resume (written at every log step), starts a new run if there is none")
     parser.add_argument("--load_state", "-load", type=str, default=None, help="Loading from a specific state. Attention: 5fold evaluation not implmented yet!")
     parser.add_argument("--eval_only", "-eval", type=bool, default=False, help="Just evaluate the model and save results. Attention: 5fold evaluation not implmented yet! ")
 
@@ -588,15 +705,27 @@ def main():
     parser.add_argument("--e5f_metric", "-e5fmt", type=str, default="final", help="metric final, best_r2, best_mae, best_mape")
     
     parser.add_argument("--admin_augment", "-adm_aug", type=lambda x: bool(strtobool(x)), default=True, help="Use data augmentation by merging administrative regions")
+    parser.add_argument("--merged_forward", "-mfw", type=lambda x: bool(strtobool(x)), default=True, help="Evaluate the regions of a merged training sample in one forward pass (1x1 kernels)")
     
     parser.add_argument("--population_target", "-pop_target", type=lambda x: bool(strtobool(x)), default=False, help="Use population as target")
     
     parser.add_argument("--num_epochs", "-ep", type=int, default=2000, help="Number of epochs")
     
     parser.add_argument("--wandb_user", "-wandbu", type=str, default="nandometzger", help="Wandb username")
+    parser.add_argument("--metrics_backend", "-mb", type=str, default="wandb", help="Where the metrics are logged. Options: wandb, jsonl, sqlite (local files in --log_dir, written in the background), none")
+    parser.add_argument("--log_dir", type=str, default="logs", help="Directory of the jsonl and sqlite metrics")
+    parser.add_argument("--profile", "-prof", type=lambda x: bool(strtobool(x)), default=False, help="Time the phases of the training and evaluation, writes a summary table and a Chrome trace to profiles/<name>.*")
+    parser.add_argument("--profile_ops", "-profops", type=int, default=0, help="Number of training steps (after 7 steps) traced operator by operator with torch.profiler, Chrome trace in profiles/<name>.ops.trace.json")
     parser.add_argument("--name", type=str, default=None, help="short name for the run to identify it")
     
     parser.add_argument("--remove_feat_idxs", "-rmfi", type=str, default=None, help="Comaseparated list of indexes of features to be removed")
+    parser.add_argument("--sparse_inference", "-si", type=lambda x: bool(strtobool(x)), default=False, help="Full map predictions only evaluate pixels with buildings and valid data.")
+    parser.add_argument("--frozen_inference", "-frz", type=str, default=None, help="Full map predictions with a network frozen per country (scalings folded into the weights). Options: script, compile, eager")
+    parser.add_argument("--quantized_inference", "-qi", type=str, default=None, help="Full map predictions with an int8 network per country on CPU, logs a quantization report. Options: dynamic, static (calibrated on the training regions)")
+    parser.add_argument("--precision", "-prec", type=str, default="fp32", help="Autocast precision of the occratenet for training and inference. Options: fp32, bf16, fp16 (with loss scaling)")
+    parser.add_argument("--mc_dropout_samples", "-mcd", type=int, default=0, help="Number of Monte Carlo dropout samples for the full map predictions, 0 disables. Mean and variance are written as extra bands of predicted_target_img.tiff")
+    parser.add_argument("--inference_workers", "-iw", type=int, default=0, help="Full map predictions on the cpu with a read/infer/write pipeline over strips of rows, split over this number of worker processes. 0 disables")
+    parser.add_argument("--threads_per_worker", "-tpw", type=int, default=None, help="Torch threads per inference worker, default: the cores split evenly. With OMP_PROC_BIND the workers are bound to disjoint cores")
 
     args = parser.parse_args()  
 
@@ -620,6 +749,17 @@ def main():
     args.custom_sampler_weights = [ float(el) for el in args.custom_sampler_weights ]
     args.custom_sampler_weights =  [ el/sum(args.custom_sampler_weights) for el in args.custom_sampler_weights ]
 
+    if args.country_quotas is not None:
+        args.country_quotas = unroll_arglist(args.country_quotas, '1', len(args.train_dataset_name))
+        args.country_quotas = [ float(el) for el in args.country_quotas ]
+        args.country_quotas =  [ el/sum(args.country_quotas) for el in args.country_quotas ]
+        if args.sampler not in ['custom', 'natural', 'importance']:
+            raise Exception("--country_quotas needs a weighted --sampler")
+    if args.full_val_every<1 or not 0.<args.val_subset<=1.:
+        raise Exception("--full_val_every has to be at least 1 and --val_subset in (0,1]")
+    # fails before the data is loaded, the pinned torch of requirements.txt only supports fp32
+    check_precision(args.precision, "cuda" if torch.cuda.is_available() else "cpu")
+
     args.kernel_size = unroll_arglist(args.kernel_size, '1', 4)
     args.kernel_size = [ int(el) for el in args.kernel_size ] 
 
@@ -675,7 +815,33 @@ def main():
         args.kernel_size,
         args.eval_model,
         args.full_ceval,
-        args.remove_feat_idxs
+        args.remove_feat_idxs,
+        args.sparse_inference,
+        args.frozen_inference,
+        args.quantized_inference,
+        args.precision,
+        args.mc_dropout_samples,
+        args.inference_workers,
+        args.threads_per_worker,
+        args.accumulation_steps,
+        args.memory_policy,
+        args.async_validation,
+        args.validation_threads,
+        args.checkpoint_retention,
+        args.resume,
+        args.train_all_folds,
+        args.distributed,
+        args.pixel_budget,
+        args.stratified_pixels,
+        args.importance_smoothing,
+        args.country_quotas,
+        args.merged_forward,
+        args.metrics_backend,
+        args.log_dir,
+        args.profile,
+        args.profile_ops,
+        args.val_subset,
+        args.full_val_every
     )
 
 
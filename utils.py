@@ -15,9 +15,9 @@ from pylab import figure, imshow, matshow, grid, savefig
 import torch
 import pickle
 import h5py
-import wandb
 import psutil
 import os
+import zlib
 import pdb
 import config_pop as cfg
 
@@ -241,16 +241,54 @@ def compute_performance_metrics(preds_dict, gt_dict):
 
 
 def write_geolocated_image(image, output_path, src_geo_transform, src_projection):
+    # images of shape (bands,h,w) are written as multi-band GeoTIFF
+    bands = image[None] if len(image.shape)==2 else image
     driver = gdal.GetDriverByName("GTiff")
-    outdata = driver.Create(output_path, image.shape[1], image.shape[0], 1, gdal.GDT_Float32, options=['COMPRESS=LZW'])
+    outdata = driver.Create(output_path, bands.shape[2], bands.shape[1], bands.shape[0], gdal.GDT_Float32, options=['COMPRESS=LZW'])
     outdata.SetGeoTransform(src_geo_transform)
     outdata.SetProjection(src_projection)
-    outdata.GetRasterBand(1).WriteArray(image)
+    for b in range(bands.shape[0]):
+        outdata.GetRasterBand(b+1).WriteArray(bands[b])
     outdata.FlushCache()
     outdata = None
     ds = None
 
 
+def sanitize_hdf5_file(h5_filename, rows_per_chunk=512, silent_mode=True):
+    """
+    Sets the no-data values (>1e32) of the features in a data.hdf5 file to zero and stores the mask of the pixels with
+    buildings as "buildings_mask" of shape (h,w). Runs once per file, files of older runs are upgraded.
+    The sanitized file is written next to the original (<h5_filename>.sanitizing, needs the disk space of a second
+    copy), marked as sanitized after all data is written and then swapped in atomically. An interrupted run leaves the
+    original file unchanged.
+    """
+    with h5py.File(h5_filename, "r") as f:
+        if f.attrs.get("sanitized", False):
+            return
+
+    tmp_filename = h5_filename + ".sanitizing"
+    with h5py.File(h5_filename, "r") as f, h5py.File(tmp_filename, "w") as out:
+        for key, value in f.attrs.items():
+            out.attrs[key] = value
+        for key in f.keys():
+            if key not in ["features", "buildings_mask"]:
+                f.copy(f[key], out, name=key)
+
+        features = f["features"]
+        _, _, h, w = features.shape
+        sanitized = out.create_dataset("features", features.shape, dtype=features.dtype, chunks=features.chunks,
+            compression=features.compression, compression_opts=features.compression_opts)
+        buildings_mask = out.create_dataset("buildings_mask", (h, w), dtype=bool, fillvalue=False, chunks=(min(h,512),min(w,512)))
+        for hi in tqdm(range(0, h, rows_per_chunk), disable=silent_mode):
+            strip = features[:, :, hi:hi+rows_per_chunk]
+            strip[strip>1e32] = 0
+            sanitized[:, :, hi:hi+rows_per_chunk] = strip
+            buildings_mask[hi:hi+rows_per_chunk] = strip[0,0]>0
+        out.flush()
+        out.attrs["sanitized"] = True
+    os.replace(tmp_filename, h5_filename)
+
+
 def convert_str_to_int_keys(data_dict_orig):
     data_dict = {}
     for k in data_dict_orig.keys():
@@ -437,7 +475,11 @@ class MultiPatchDataset(torch.utils.data.Dataset):
     """Patch dataset."""
     def __init__(self, datalocations, train_dataset_name, train_level, memory_mode, device,
         validation_split, validation_fold, loss_weights, sampler_weights, val_valid_ids={}, build_pairs=True, random_seed_folds=1610,
-        index_permutation_feat=None, permutation_random_seed=42, remove_feat_idxs=None):
+        index_permutation_feat=None, permutation_random_seed=42, remove_feat_idxs=None, shared_dataset=None):
+        """
+        shared_dataset: MultiPatchDataset of another validation fold with the same data options, its features and
+            evaluation variables are reused instead of being loaded again
+        """
 
         self.device = device    
         print("Preparing dataloader for: ", list(datalocations.keys()))
@@ -455,10 +497,12 @@ class MultiPatchDataset(torch.utils.data.Dataset):
         self.weight_list = {}
         self.memory_disag, self.memory_disag_val, self.feature_names = {},{},{}
         self.memory_disag_hout = {}
+        self.buildings_mask = {}
         self.val_valid_ids = val_valid_ids
         self.memory_vars = {}
         self.source_census_val = {}
         self.source_census_hout = {}
+        self.region_pixels_cache = {}
         process = psutil.Process(os.getpid())
         
         for i, (name, rs) in tqdm(enumerate(datalocations.items())):
@@ -482,7 +526,10 @@ class MultiPatchDataset(torch.utils.data.Dataset):
             self.feature_names[name] = feature_names
             # print("After loading trainvars",process.memory_info().rss/1000/1000,"mb used")
 
-            if name not in self.val_valid_ids.keys():          
+            if shared_dataset is not None and name in shared_dataset.memory_vars.keys():
+                self.memory_vars[name] = shared_dataset.memory_vars[name]
+                self.val_valid_ids[name] = self.memory_vars[name][4]
+            elif name not in self.val_valid_ids.keys():          
                 with open(rs['eval_vars'], "rb") as f:
                     self.memory_vars[name] = pickle.load(f)
                     self.val_valid_ids[name] = self.memory_vars[name][4]
@@ -492,7 +539,9 @@ class MultiPatchDataset(torch.utils.data.Dataset):
 
             # print("After loading of disag memory",process.memory_info().rss/1000/1000,"mb used")
 
-            if memory_mode[i]=='m':
+            if shared_dataset is not None and name in shared_dataset.features.keys():
+                self.features[name] = shared_dataset.features[name]
+            elif memory_mode[i]=='m':
                 #self.features[name] = h5py.File(rs["features"], 'r', driver='core')["features"]
                 features = h5py.File(rs["features"], 'r')["features"][:]
                 if index_permutation_feat is not None:
@@ -526,6 +575,12 @@ class MultiPatchDataset(torch.utils.data.Dataset):
                 self.features[name] = h5py.File(rs["features"], 'r')["features"]
             else:
                 raise Exception(f"Wrong memory mode for {name}. It should be 'd' or 'm' in a comma separated list. No spaces!")
+
+            # features and mask are prepared once by sanitize_hdf5_file, the networks expect clean inputs
+            with h5py.File(rs["features"], 'r') as f:
+                if not f.attrs.get("sanitized", False):
+                    raise Exception(f"Features of {name} are not sanitized, run utils.sanitize_hdf5_file on {rs['features']}")
+                self.buildings_mask[name] = torch.from_numpy(f["buildings_mask"][:])
             # print("After loading of features",process.memory_info().rss/1000/1000,"mb used")
             
             # Validation split strategy:
@@ -840,6 +895,65 @@ class MultiPatchDataset(torch.utils.data.Dataset):
         else:
             return X, Y, Mask, name, census_id
 
+    def split_regions(self, split="val"):
+        # bounding boxes, masks and census ids of the regions of a split
+        return {"val": (self.BBox_val, self.Masks_val, self.tregid_val), "all": (self.BBox, self.Masks, self.tregid),
+            "hout": (self.BBox_hout, self.Masks_hout, self.tregid_hout)}[split]
+
+    def get_region_pixels(self, name, split="val", buildings_only=True, regions=None):
+        """
+        Pixels of all regions of a split ("val", "all" or "hout") of the country "name" as one pixel matrix, for the
+        batched evaluation of the regions. Only the pixels in the region masks (and with buildings, if buildings_only).
+        regions: indices of a subset of the regions of the split (see val_subset), None for all.
+        Cached if the features are in memory.
+        Returns:
+            - pixels : tensor of shape (N,C)
+            - segments : index of the region of each pixel (in the subset), tensor of shape (N,)
+            - census_ids : census id of each region, tensor of shape (num_regions,)
+        """
+        key = (name, split, buildings_only, None if regions is None else tuple(regions))
+        if key in self.region_pixels_cache.keys():
+            return self.region_pixels_cache[key]
+
+        BBox, Masks, tregid = self.split_regions(split)
+        if regions is None:
+            regions = range(len(BBox[name]))
+        pixels, segments = [], []
+        for i, k in enumerate(regions):
+            rmin, rmax, cmin, cmax = BBox[name][k]
+            X = torch.as_tensor(self.features[name][0,:,rmin:rmax, cmin:cmax])
+            selection = torch.as_tensor(Masks[name][k], dtype=torch.bool)
+            if buildings_only:
+                selection = selection & (X[0]>0)
+            pixels.append(X[:,selection].t())
+            segments.append(torch.full((pixels[-1].shape[0],), i, dtype=torch.long))
+        pixels = torch.cat(pixels, 0).float() if len(pixels)>0 else torch.zeros((0,self.dims), dtype=torch.float32)
+        segments = torch.cat(segments, 0) if len(segments)>0 else torch.zeros((0,), dtype=torch.long)
+        region_pixels = pixels, segments, torch.as_tensor(np.asarray(tregid[name])[list(regions)], dtype=torch.long)
+
+        if isinstance(self.features[name], np.ndarray):
+            self.region_pixels_cache[key] = region_pixels
+        return region_pixels
+
+    def val_subset(self, name, fraction, seed=0):
+        """
+        Indices of a fixed random subset (fraction, at least two regions for the r2) of the validation regions of "name",
+        the same for a seed in every call and process.
+        """
+        num_regions = len(self.BBox_val[name])
+        size = min(num_regions, max(2, int(round(fraction*num_regions))))
+        rng = np.random.default_rng([seed, zlib.crc32(name.encode())])
+        return np.sort(rng.choice(num_regions, size=size, replace=False))
+
+    def sample_countries(self):
+        # country of each training sample (of its first region)
+        return [self.loc_list_train[idxs[0]][0] for idxs in self.all_sample_ids]
+
+    def sample_has_pixels(self):
+        # training samples with pixels in the mask of at least one region, forward_one_or_more skips the others
+        return np.array([any(np.any(self.Masks_train[name][k]) for name, k in [self.loc_list_train[i] for i in idxs])
+            for idxs in self.all_sample_ids], dtype=bool)
+
     def __getitem__(self,idx):
         idxs = self.all_sample_ids[idx] 
         sample = []
@@ -849,6 +963,216 @@ class MultiPatchDataset(torch.utils.data.Dataset):
         return sample
 
 
+class DistributedWeightedSampler(torch.utils.data.Sampler):
+    """
+    Sampler of one rank in data-parallel training. All ranks draw the order of an epoch with the same generator
+    (seed + epoch), weighted without replacement as WeightedRandomSampler (uniform if weights is None), and each rank
+    takes every num_replicas-th sample starting at its rank. The order is padded with its first samples, such that all
+    ranks get the same number of samples and step together. Samples without pixels (skipped in training) are left out,
+    they would only be skipped on some of the ranks.
+    """
+
+    def __init__(self, dataset, weights, num_replicas, rank, seed=0):
+        valid = torch.as_tensor(dataset.sample_has_pixels(), dtype=torch.bool)
+        if weights is None:
+            weights = torch.ones(len(valid), dtype=torch.double)
+        self.weights = torch.as_tensor(weights, dtype=torch.double) * valid
+        self.num_valid = int((self.weights>0).sum())
+        self.num_replicas, self.rank, self.seed = num_replicas, rank, seed
+        self.num_samples = -(-self.num_valid // num_replicas)
+        self.epoch = 0
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        order = torch.multinomial(self.weights, self.num_valid, replacement=False, generator=generator).tolist()
+        order = (order * self.num_replicas)[:self.num_samples*self.num_replicas]
+        return iter(order[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return self.num_samples
+
+
+def apply_country_quotas(weights, countries, quotas):
+    """
+    Rescales the sampling weights such that the samples of each country get the share quotas[country] of the total
+    weight. countries: country of each sample. Returns the normalized weights, tensor of shape (N,).
+    """
+    weights = torch.as_tensor(weights, dtype=torch.double).clone()
+    countries = np.asarray(countries)
+    for name, quota in quotas.items():
+        this_country = torch.from_numpy(countries==name)
+        if this_country.any():
+            weights[this_country] *= quota/weights[this_country].sum()
+    return weights/weights.sum()
+
+
+class ImportanceSampler(torch.utils.data.Sampler):
+    """
+    Loss-aware sampler: the samples are drawn (with replacement) with probabilities proportional to the target weights
+    times their running loss, such that hard regions are seen more often. update() records the loss of the last drawn
+    sample and returns its importance weight p_target/p_sampled, which keeps the weighted loss an unbiased estimate of
+    the loss under the target weights. The probabilities are refreshed every "refresh" draws (one host synchronization)
+    and mixed with the target weights ("smoothing"), which bounds the importance weights by 1/smoothing.
+    Samples without a loss yet get the mean loss of the seen samples.
+    quotas: share of each country among the draws (dict country -> quota, countries: country of each sample), applied
+        to the target weights and to the loss-aware probabilities.
+    Only for loaders without workers, where each sample is fetched right after its index is drawn.
+    """
+
+    def __init__(self, weights, countries=None, quotas=None, smoothing=0.2, decay=0.9, refresh=256, seed=0):
+        self.countries, self.quotas = countries, quotas
+        self.target = self.with_quotas(torch.as_tensor(weights, dtype=torch.double))
+        self.num_samples = len(self.target)
+        self.smoothing, self.decay, self.refresh = smoothing, decay, refresh
+        self.losses = torch.zeros(self.num_samples, dtype=torch.float32)
+        self.seen = torch.zeros(self.num_samples, dtype=torch.bool)
+        self.generator = torch.Generator().manual_seed(seed)
+        self.block, self.block_weights, self.block_position = [], [], 0
+        self.position, self.current = 0, None
+
+    def with_quotas(self, weights):
+        if self.quotas is None:
+            return weights/weights.sum()
+        return apply_country_quotas(weights, self.countries, self.quotas)
+
+    def probabilities(self):
+        losses, seen = self.losses.cpu().double(), self.seen.cpu()
+        scores = torch.where(seen, losses, losses[seen].mean() if seen.any() else torch.ones_like(losses)).clamp(min=1e-8)
+        return (1-self.smoothing)*self.with_quotas(self.target*scores) + self.smoothing*self.target
+
+    def __iter__(self):
+        if self.position>=self.num_samples:
+            self.position = 0
+        while self.position<self.num_samples:
+            if self.block_position>=len(self.block):
+                probabilities = self.probabilities()
+                block = torch.multinomial(probabilities, self.refresh, replacement=True, generator=self.generator)
+                self.block, self.block_weights = block.tolist(), (self.target[block]/probabilities[block]).tolist()
+                self.block_position = 0
+            self.current = (self.block[self.block_position], self.block_weights[self.block_position])
+            self.block_position += 1
+            self.position += 1
+            yield self.current[0]
+
+    def __len__(self):
+        return self.num_samples
+
+    def update(self, loss):
+        """
+        Running loss of the last drawn sample, loss: detached scalar tensor (stays on its device). Returns the
+        importance weight of the sample.
+        """
+        idx, weight = self.current
+        if self.losses.device!=loss.device:
+            self.losses, self.seen = self.losses.to(loss.device), self.seen.to(loss.device)
+        self.losses[idx] = torch.where(self.seen[idx], self.decay*self.losses[idx] + (1-self.decay)*loss, loss)
+        self.seen[idx] = True
+        return weight
+
+    def state_dict(self):
+        return {"losses": self.losses.cpu(), "seen": self.seen.cpu(), "generator": self.generator.get_state(),
+            "block": list(self.block), "block_weights": list(self.block_weights), "block_position": self.block_position,
+            "position": self.position}
+
+    def load_state_dict(self, state_dict):
+        self.losses, self.seen = state_dict["losses"].clone(), state_dict["seen"].clone()
+        self.generator.set_state(state_dict["generator"])
+        self.block, self.block_weights = list(state_dict["block"]), list(state_dict["block_weights"])
+        self.block_position, self.position = state_dict["block_position"], state_dict["position"]
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Wraps the sampler of the training loader. The order of each epoch is drawn from the wrapped sampler as before (same
+    random numbers) and recorded with the position in it, such that an interrupted epoch can be continued with
+    load_state_dict. Only for loaders without workers, where each sample is fetched when it is consumed.
+    """
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.order, self.position = [], 0
+        self.resume = None
+
+    def __iter__(self):
+        if self.resume is not None:
+            self.order, self.position = self.resume
+            self.resume = None
+        else:
+            self.order, self.position = list(self.sampler), 0
+        while self.position<len(self.order):
+            self.position += 1
+            yield self.order[self.position-1]
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def state_dict(self):
+        return {"order": list(self.order), "position": self.position}
+
+    def load_state_dict(self, state_dict):
+        self.resume = (list(state_dict["order"]), state_dict["position"])
+
+
+def subsample_pixels(buildings, num_pixels, stratified=False, num_strata=4):
+    """
+    Random subset of at most num_pixels pixels (without replacement) with the inverse sampling rates as weights, such
+    that the weighted sum of the predictions of the subset is an unbiased estimate of the sum over all pixels.
+    stratified: the pixels are split into num_strata strata of equal size by building count, the budget is allocated
+        proportional to the buildings of the strata (at least one pixel each) and each stratum is sampled on its own.
+    Inputs:
+        - buildings : building counts of the pixels, tensor of shape (N,)
+    Returns:
+        - idxs : indices of the subset, tensor of shape (n,)
+        - weights : tensor of shape (n,)
+    """
+    N = len(buildings)
+    if N<=num_pixels:
+        return torch.arange(N), torch.ones(N)
+    if not stratified:
+        return torch.randperm(N)[:num_pixels], torch.full((num_pixels,), N/num_pixels)
+
+    strata = torch.tensor_split(torch.argsort(buildings), num_strata)
+    mass = torch.stack([buildings[stratum].double().sum() for stratum in strata])
+    share = mass/mass.sum() if mass.sum()>0 else torch.tensor([len(stratum)/N for stratum in strata])
+    idxs, weights = [], []
+    for stratum, this_share in zip(strata, share):
+        if len(stratum)==0:
+            continue
+        n = min(len(stratum), max(1, int(round(num_pixels*this_share.item()))))
+        idxs.append(stratum[torch.randperm(len(stratum))[:n]])
+        weights.append(torch.full((n,), len(stratum)/n))
+    return torch.cat(idxs), torch.cat(weights)
+
+
+def weighted_sample_sums(y_pred_list, sample):
+    """
+    Weighted sums of the predicted and the census counts over the regions of a training sample (a region, a pair or a
+    triplet). Both stay on the device of the predictions, without synchronizing with the host.
+    """
+    device = y_pred_list[0].device
+    y_pred = torch.stack([pred*samp[4].to(device) for pred,samp in zip(y_pred_list, sample)]).sum(0)
+    y_gt = torch.stack([samp[1]*samp[4] for samp in sample]).sum(0).to(device)
+    return y_pred, y_gt
+
+
+memory_policies = ["step", "logstep", "never"]
+
+
+def release_cached_memory(policy, event="step"):
+    """
+    Returns the cached blocks of the CUDA allocator to the device according to the memory policy:
+    "step" after every training step and evaluated region (as in older versions), "logstep" only after the evaluations
+    at the log steps, "never" leaves the cache to the allocator. event: "step" or "logstep"
+    """
+    if policy not in memory_policies:
+        raise Exception("unknown memory policy {}".format(policy))
+    if not torch.cuda.is_available():
+        return
+    if policy=="step" or (policy=="logstep" and event=="logstep"):
+        torch.cuda.empty_cache()
+
+
 def NormL1(outputs, targets, eps=1e-8):
     loss = torch.abs(outputs - targets) / torch.clamp(outputs + targets, min=eps)
     return loss.mean()